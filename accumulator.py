@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Accumulate area per (country, column) in a dense numpy array."""
+
+import numpy as np
+import pandas as pd
+
+
+class Accumulator:
+    """Dense float array of area indexed by (row, column).
+
+       Rows are typically countries and are added as they are first seen, columns are fixed when
+       the Accumulator is created. Block loops add numpy vectors to a row; pandas is only used by
+       to_dataframe() once processing is finished.
+    """
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.names = []
+        self.index = {}
+        self.data = np.zeros((16, len(self.columns)))
+
+    def row(self, name):
+        """Return the row number for name, adding a row of zeros if it is not present."""
+        idx = self.index.get(name)
+        if idx is None:
+            idx = len(self.names)
+            if idx == self.data.shape[0]:
+                grown = np.zeros((2 * self.data.shape[0], len(self.columns)))
+                grown[:idx] = self.data
+                self.data = grown
+            self.names.append(name)
+            self.index[name] = idx
+        return idx
+
+    def add(self, row, values):
+        """Add a vector of len(columns) values to a row."""
+        self.data[row] += values
+
+    def merge(self, other):
+        """Add all rows of another Accumulator with the same columns into this one."""
+        assert other.columns == self.columns
+        for idx, name in enumerate(other.names):
+            self.data[self.row(name)] += other.data[idx]
+
+    def to_dataframe(self, index_name='Country'):
+        """Return a pandas DataFrame with a row per name and the same columns."""
+        df = pd.DataFrame(self.data[:len(self.names)].copy(), index=list(self.names),
+                columns=self.columns)
+        df.index.name = index_name
+        return df
@@ -0,0 +1,347 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Benchmark each stage of the pipeline on a deterministic synthetic world.
+
+   Synthetic GeoTIFFs are generated on the real 1km and 333m grids, scaled down by --scale, in a
+   directory laid out like this repository (data/, masks/, results/). Each stage then runs in a
+   fresh process within that directory so its peak RSS can be measured on its own, and the
+   timings are written to a JSON file which can be compared between commits.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import os.path
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import osgeo.gdal
+import osgeo.ogr
+import osgeo.osr
+
+import accumulator
+import extract_country_data as ecd
+import geoutil
+import prepare_feature_masks
+import process_imagery
+
+
+# (ADMIN, SOV_A3, (west, south, east, north)) of the features in the synthetic shapefile.
+countries = [
+        ('France', 'FR1', (-5.0, 42.0, 8.0, 51.0)),
+        ('Brazil', 'BRA', (-74.0, -33.0, -35.0, 5.0)),
+        ('India', 'IND', (68.0, 8.0, 97.0, 35.0)),
+        ('Australia', 'AU1', (113.0, -39.0, 153.0, -11.0)),
+        ('Kenya', 'KEN', (34.0, -5.0, 42.0, 5.0)),
+        ('Canada', 'CAN', (-141.0, 42.0, -53.0, 83.0)),
+        ]
+
+kg_filename = 'data/Beck_KG_V1/Beck_KG_V1_present_0p0083.tif'
+lc_filename = 'data/copernicus/C3S-LC-L4-LCCS-Map-300m-P1Y-2018-v2.1.1.tif'
+sl_filename = 'data/ConsolidatedSlope.tif'
+wk_filename = 'data/FAO/workability_FAO_sq7_1km.tif'
+lpd_filename = 'data/lpd_int2/lpd_int2.tif'
+shapefilename = 'data/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
+
+# size of the real 1km grid, the 333m grid is 3 times finer.
+x_siz_1km, y_siz_1km = (43200, 21600)
+
+
+def grid(scale, factor=1):
+    """Return (x_siz, y_siz, geotransform) of the world at 1km/factor, shrunk by scale."""
+    x_siz = x_siz_1km * factor // scale
+    y_siz = y_siz_1km * factor // scale
+    return (x_siz, y_siz, (-180.0, 360.0 / x_siz, 0.0, 90.0, 0.0, -180.0 / y_siz))
+
+
+def create_raster(filename, x_siz, y_siz, gt, nbands=1, etype=osgeo.gdal.GDT_Byte):
+    """Create a tiled, compressed GeoTIFF like the inputs in data/."""
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    drv = osgeo.gdal.GetDriverByName('GTiff')
+    img = drv.Create(filename, xsize=x_siz, ysize=y_siz, bands=nbands, eType=etype,
+            options=['COMPRESS=DEFLATE', 'TILED=YES'])
+    srs = osgeo.osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    img.SetProjection(srs.ExportToWkt())
+    img.SetGeoTransform(gt)
+    return img
+
+
+def patches(rng, nrows, ncols, values, patch=16):
+    """Return a (nrows, ncols) block of values in square patches, so it compresses like a map."""
+    coarse = rng.choice(values, size=(nrows // patch + 1, ncols // patch + 1))
+    return np.repeat(np.repeat(coarse, patch, axis=0), patch, axis=1)[:nrows, :ncols]
+
+
+def write_strips(img, seed, fill):
+    """Write img in strips of 256 rows, calling fill(rng, nrows, ncols) for each band's data.
+
+       fill returns a list of arrays, one per band. Each strip gets its own seeded generator
+       so the output does not depend on anything but seed.
+    """
+    x_siz = img.RasterXSize
+    y_siz = img.RasterYSize
+    for y in range(0, y_siz, 256):
+        nrows = geoutil.blklim(coord=y, blksiz=256, totsiz=y_siz)
+        rng = np.random.default_rng([seed, y])
+        for b, data in enumerate(fill(rng, nrows, x_siz), start=1):
+            img.GetRasterBand(b).WriteArray(data, 0, y)
+
+
+def slope_bands(rng, nrows, ncols):
+    """Return 8 blocks of slope class percentages which sum to 100 in each pixel."""
+    weights = patches(rng, nrows, ncols, values=np.arange(64)) + 1
+    shares = [(weights * (b + 1)) % 17 for b in range(8)]
+    total = sum(shares) + 1
+    bands = [(100 * s // total).astype(np.uint8) for s in shares]
+    bands[0] += (100 - sum(b.astype(np.int32) for b in bands)).astype(np.uint8)
+    return bands
+
+
+def generate_world(scale, seed):
+    """Write the synthetic datasets and shapefile into the current directory."""
+    x_siz, y_siz, gt = grid(scale)
+    x3_siz, y3_siz, gt3 = grid(scale, factor=3)
+
+    img = create_raster(kg_filename, x_siz, y_siz, gt)
+    colors = osgeo.gdal.ColorTable()
+    colors.SetColorEntry(0, (255, 255, 255))
+    for idx, rgb in enumerate(ecd.KGlookup.kg_colors.keys(), start=1):
+        colors.SetColorEntry(idx, rgb)
+    img.GetRasterBand(1).SetRasterColorTable(colors)
+    write_strips(img, seed=[seed, 1],
+            fill=lambda rng, r, c: [patches(rng, r, c, values=np.arange(31))])
+    img = None
+
+    lccs = [0] + list(np.flatnonzero(
+            process_imagery.land_use_lut != process_imagery.C_LUS_BLNK))
+    img = create_raster(lc_filename, x3_siz, y3_siz, gt3)
+    write_strips(img, seed=[seed, 2], fill=lambda rng, r, c: [patches(rng, r, c, values=lccs)])
+    img = None
+
+    img = create_raster(sl_filename, x_siz, y_siz, gt, nbands=8)
+    write_strips(img, seed=[seed, 3], fill=slope_bands)
+    img = None
+    for i in range(1, 9):
+        img = create_raster(f"data/FAO/GloSlopesCl{i}_30as.tif", x_siz, y_siz, gt)
+        write_strips(img, seed=[seed, 3],
+                fill=lambda rng, r, c: [slope_bands(rng, r, c)[i - 1]])
+        img = None
+
+    img = create_raster(wk_filename, x_siz, y_siz, gt)
+    write_strips(img, seed=[seed, 4],
+            fill=lambda rng, r, c: [patches(rng, r, c, values=np.arange(1, 8))])
+    img = None
+
+    img = create_raster(lpd_filename, x_siz, y_siz, gt)
+    write_strips(img, seed=[seed, 5],
+            fill=lambda rng, r, c: [patches(rng, r, c, values=np.arange(0, 6))])
+    img = None
+
+    os.makedirs(os.path.dirname(shapefilename), exist_ok=True)
+    shp_drv = osgeo.ogr.GetDriverByName("ESRI Shapefile")
+    data_source = shp_drv.CreateDataSource(shapefilename)
+    srs = osgeo.osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    layer = data_source.CreateLayer("countries", geom_type=osgeo.ogr.wkbPolygon, srs=srs)
+    layer.CreateField(osgeo.ogr.FieldDefn("ADMIN", osgeo.ogr.OFTString))
+    layer.CreateField(osgeo.ogr.FieldDefn("SOV_A3", osgeo.ogr.OFTString))
+    for admin, a3, (west, south, east, north) in countries:
+        feature = osgeo.ogr.Feature(layer.GetLayerDefn())
+        feature.SetField("ADMIN", admin)
+        feature.SetField("SOV_A3", a3)
+        wkt = (f"POLYGON (({west} {south}, {east} {south}, {east} {north}, {west} {north}, "
+               f"{west} {south}))")
+        feature.SetGeometry(osgeo.ogr.CreateGeometryFromWkt(wkt))
+        layer.CreateFeature(feature)
+        feature = None
+    data_source = None
+
+    os.makedirs('masks', exist_ok=True)
+    os.makedirs('results', exist_ok=True)
+
+
+def stage_rasterize_one_feature():
+    shapefile = osgeo.ogr.Open(shapefilename)
+    layer = shapefile.GetLayerByIndex(0)
+    pixels = 0
+    for maskdim, filename in [('1km', kg_filename), ('333m', lc_filename)]:
+        img = osgeo.gdal.Open(filename, osgeo.gdal.GA_ReadOnly)
+        for idx, feature in enumerate(layer):
+            a3 = feature.GetField("SOV_A3")
+            outfile = f'masks/{a3}_{idx}_{maskdim}_mask._tif'
+            prepare_feature_masks.rasterize_one_feature(img=img, feature=feature, layer=layer,
+                    outfile=outfile)
+            pixels += img.RasterXSize * img.RasterYSize
+        layer.ResetReading()
+    return pixels
+
+
+def stage_km2_block():
+    img = osgeo.gdal.Open(kg_filename, osgeo.gdal.GA_ReadOnly)
+    x_siz = img.RasterXSize
+    y_siz = img.RasterYSize
+    for x, y, ncols, nrows in geoutil.windows(x_siz=x_siz, y_siz=y_siz, x_winsiz=256,
+            y_winsiz=256):
+        geoutil.km2_block(nrows=nrows, ncols=ncols, y_off=y, img=img)
+    return x_siz * y_siz
+
+
+lookups = {
+        'KGlookup': lambda: ecd.KGlookup(kg_filename),
+        'ESA_LC_lookup': lambda: ecd.ESA_LC_lookup(lc_filename),
+        'GeomorphoLookup': lambda: ecd.GeomorphoLookup(mapfilename=sl_filename),
+        'FaoSlopeLookup': lambda: ecd.FaoSlopeLookup(),
+        'WorkabilityLookup': lambda: ecd.WorkabilityLookup(wk_filename),
+        'DegradedLandLookup': lambda: ecd.DegradedLandLookup(lpd_filename),
+        }
+
+
+def stage_lookup(name):
+    """Time lookup.km2 over the whole grid, as if every pixel were within the mask."""
+    lookupobj = lookups[name]()
+    img = osgeo.gdal.Open(lc_filename if lookupobj.maskdim == '333m' else kg_filename)
+    acc = accumulator.Accumulator(columns=lookupobj.get_columns())
+    row = acc.row('World')
+    x_siz = img.RasterXSize
+    y_siz = img.RasterYSize
+    for x, y, ncols, nrows in geoutil.windows(x_siz=x_siz, y_siz=y_siz, x_winsiz=256,
+            y_winsiz=256):
+        maskblock = np.ones((nrows, ncols), dtype=np.uint8)
+        km2block = geoutil.km2_block(nrows=nrows, ncols=ncols, y_off=y, img=img)
+        lookupobj.km2(x=x, y=y, ncols=ncols, nrows=nrows, maskblock=maskblock,
+                km2block=km2block, acc=acc, row=row)
+    return x_siz * y_siz
+
+
+def mask_pixels(maskdim):
+    """Return the number of pixels in populated blocks of all masks of maskdim."""
+    pixels = 0
+    for idx, a3, admin in ecd.feature_list():
+        maskfilename = ecd.mask_filename(idx=idx, a3=a3, maskdim=maskdim)
+        band = osgeo.gdal.Open(maskfilename, osgeo.gdal.GA_ReadOnly).GetRasterBand(1)
+        pixels += sum(ncols * nrows
+                for x, y, ncols, nrows, full in geoutil.populated_blocks(maskfilename, band))
+    return pixels
+
+
+def stage_process_map():
+    ecd.process_map(lookupobj=ecd.KGlookup(kg_filename), csvfilename='benchmark-kg.csv')
+    return mask_pixels('1km')
+
+
+def stage_produce_CSV():
+    process_imagery.produce_CSV()
+    return mask_pixels('1km')
+
+
+def stage_produce_GeoTIFF():
+    process_imagery.produce_GeoTIFF()
+    img = osgeo.gdal.Open(lc_filename, osgeo.gdal.GA_ReadOnly)
+    return img.RasterXSize * img.RasterYSize
+
+
+stages = {
+        'rasterize_one_feature': stage_rasterize_one_feature,
+        'km2_block': stage_km2_block,
+        **{f"{name}.km2": (lambda name=name: stage_lookup(name)) for name in lookups},
+        'process_map': stage_process_map,
+        'produce_CSV': stage_produce_CSV,
+        'produce_GeoTIFF': stage_produce_GeoTIFF,
+        }
+
+
+def run_stage(name, workdir):
+    """Run one stage in workdir, return its timing. Runs in a fresh worker process."""
+    os.chdir(workdir)
+    osgeo.gdal.PushErrorHandler("CPLQuietErrorHandler")
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        pixels = stages[name]()
+        seconds = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return {'seconds': seconds, 'pixels': pixels, 'pixels_per_second': pixels / seconds,
+            'peak_rss_mb': peak_rss_mb}
+
+
+def git_commit():
+    """Return the commit of this checkout, or None."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(names, workdir, scale, seed):
+    """Generate the world in workdir if needed and run each stage, returning the results."""
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        if not os.path.exists(shapefilename):
+            print(f"Generating synthetic world at 1/{scale} scale in {workdir}")
+            generate_world(scale=scale, seed=seed)
+    finally:
+        os.chdir(cwd)
+
+    results = {}
+    ctx = multiprocessing.get_context('spawn')
+    for name in names:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+            result = executor.submit(run_stage, name, workdir).result()
+        print(f"{name:<28} {result['seconds']:9.3f}s {result['pixels_per_second']:14.0f} px/s "
+              f"{result['peak_rss_mb']:9.1f} MB")
+        results[name] = result
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on a synthetic world')
+    parser.add_argument('--scale', default=16, required=False, type=int,
+                        help='shrink the real grids by this factor')
+    parser.add_argument('--seed', default=0, required=False, type=int,
+                        help='seed for the synthetic datasets')
+    parser.add_argument('--stages', default=None, required=False, nargs='+',
+                        choices=list(stages.keys()), help='stages to run, default all')
+    parser.add_argument('--workdir', default=None, required=False,
+                        help='directory for the synthetic world, reused if it exists')
+    parser.add_argument('--output', default='benchmark.json', required=False,
+                        help='JSON file to write results to')
+    args = parser.parse_args()
+
+    # masks are produced by the first stage, so it always runs when starting a new world.
+    names = args.stages if args.stages else list(stages.keys())
+    tmpdir = None
+    workdir = args.workdir
+    if workdir is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        workdir = tmpdir.name
+    workdir = os.path.abspath(workdir)
+    os.makedirs(workdir, exist_ok=True)
+    if 'rasterize_one_feature' not in names and not os.path.exists(os.path.join(workdir,
+            'masks', f"{countries[0][1]}_0_1km_mask._tif")):
+        names = ['rasterize_one_feature'] + names
+
+    results = run_benchmarks(names=names, workdir=workdir, scale=args.scale, seed=args.seed)
+    report = {
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'gdal': osgeo.gdal.__version__,
+            'scale': args.scale,
+            'seed': args.seed,
+            'stages': results,
+            }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
@@ -27,7 +27,7 @@ if not os.path.exists(outfilename):
     out.SetGeoTransform(modelimg.GetGeoTransform())
     out.SetMetadata({
             'TIFFTAG_ARTIST': 'Derived from the Harmonized World Soil Database',
-            'TIFFTAG_DATETIME': '2019',
+            'TIFFTAG_DATETIME': '2019'})
     out.GetRasterBand(1).SetNoDataValue(0)
     out = None
 
@@ -55,12 +55,13 @@ x_siz = in_f[1].RasterXSize
 y_siz = in_f[1].RasterYSize
 x_blksiz = y_blksiz = 256
 
+# every block is read into the same buffer, rather than allocating a new array per read.
+data = np.empty((y_blksiz, x_blksiz), dtype=np.uint8)
 for y in range(0, y_siz, y_blksiz):
     for x in range(0, x_siz, x_blksiz):
-        data = {}
         for i in range(1, 9):
-            data[i] = in_band[i].ReadAsArray(x, y, x_blksiz, y_blksiz)
-            if not np.all(data[i][data == 255]):
-                out_band[i].WriteArray(data[i], xoff=x, yoff=y)
+            in_band[i].ReadAsArray(x, y, x_blksiz, y_blksiz, buf_obj=data)
+            if not np.all(data == 255):
+                out_band[i].WriteArray(data, xoff=x, yoff=y)
 
 out = None
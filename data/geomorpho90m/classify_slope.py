@@ -36,6 +36,10 @@ if not os.path.exists(outfilename):
 out = gdal.Open(outfilename, gdal.GA_Update)
 out_xmin, out_xsiz, _, out_ymin, _, out_ysiz = out.GetGeoTransform()
 
+# the output bands and the read buffer are reused for every tile of the same size.
+outbands = None
+data = None
+
 f = open('slope_files.txt', 'r')
 for filename in f:
     if filename.strip().startswith('#'):
@@ -49,19 +53,16 @@ for filename in f:
     slp_x_blksiz = slp_y_blksiz = 60
 
     shape = (int(slp_x_siz/10), int(slp_y_siz/10))
-    outband1 = np.empty(shape, dtype=np.uint8)
-    outband2 = np.empty(shape, dtype=np.uint8)
-    outband3 = np.empty(shape, dtype=np.uint8)
-    outband4 = np.empty(shape, dtype=np.uint8)
-    outband5 = np.empty(shape, dtype=np.uint8)
-    outband6 = np.empty(shape, dtype=np.uint8)
-    outband7 = np.empty(shape, dtype=np.uint8)
-    outband8 = np.empty(shape, dtype=np.uint8)
-    outband9 = np.empty(shape, dtype=np.uint8)
+    if outbands is None or outbands.shape[1:] != shape:
+        outbands = np.empty((9,) + shape, dtype=np.uint8)
+    outband1, outband2, outband3, outband4, outband5, outband6, outband7, outband8, outband9 = (
+            outbands)
+    if data is None:
+        data = slp_band.ReadAsArray(0, 0, slp_x_blksiz, slp_y_blksiz)
 
     for slp_y in range(0, slp_y_siz, slp_y_blksiz):
         for slp_x in range(0, slp_x_siz, slp_x_blksiz):
-            data = slp_band.ReadAsArray(slp_x, slp_y, slp_x_blksiz, slp_y_blksiz)
+            slp_band.ReadAsArray(slp_x, slp_y, slp_x_blksiz, slp_y_blksiz, buf_obj=data)
             for n in range(slp_y, slp_y+slp_y_blksiz, 10):
                 out_y = int(n / 10)
                 p_y = int(n - slp_y)
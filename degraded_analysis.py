@@ -2,6 +2,7 @@
 # vim: set fileencoding=utf-8 :
 
 import argparse
+import fractions
 import math
 import os.path
 import pdb
@@ -16,8 +17,10 @@ import osgeo.ogr
 import numpy as np
 import pandas as pd
 
+import accumulator
 import admin_names
 import geoutil
+import instrument
 
 
 pd.set_option("display.max_rows", 500)
@@ -27,45 +30,229 @@ osgeo.gdal.PushErrorHandler("CPLQuietErrorHandler")
 np.set_printoptions(threshold=sys.maxsize)
 
 
+columns = [
+        'forest:good:degraded', 'forest:marginal:degraded',
+        'forest:poor:degraded', 'forest:verypoor:degraded',
+        'forest:good:nondegraded', 'forest:marginal:nondegraded',
+        'forest:poor:nondegraded', 'forest:verypoor:nondegraded',
+        'cropland:good:degraded', 'cropland:marginal:degraded',
+        'cropland:poor:degraded', 'cropland:verypoor:degraded',
+        'cropland:good:nondegraded', 'cropland:marginal:nondegraded',
+        'cropland:poor:nondegraded', 'cropland:verypoor:nondegraded',
+        'grassland:good:degraded', 'grassland:marginal:degraded',
+        'grassland:poor:degraded', 'grassland:verypoor:degraded',
+        'grassland:good:nondegraded', 'grassland:marginal:nondegraded',
+        'grassland:poor:nondegraded', 'grassland:verypoor:nondegraded',
+        'bare:good:degraded', 'bare:marginal:degraded',
+        'bare:poor:degraded', 'bare:verypoor:degraded',
+        'bare:good:nondegraded', 'bare:marginal:nondegraded',
+        'bare:poor:nondegraded', 'bare:verypoor:nondegraded',
+        'urban:good:degraded', 'urban:marginal:degraded',
+        'urban:poor:degraded', 'urban:verypoor:degraded',
+        'urban:good:nondegraded', 'urban:marginal:nondegraded',
+        'urban:poor:nondegraded', 'urban:verypoor:nondegraded',
+        'water:good:degraded', 'water:marginal:degraded',
+        'water:poor:degraded', 'water:verypoor:degraded',
+        'water:good:nondegraded', 'water:marginal:nondegraded',
+        'water:poor:nondegraded', 'water:verypoor:nondegraded',
+        'ice:good:degraded', 'ice:marginal:degraded',
+        'ice:poor:degraded', 'ice:verypoor:degraded',
+        'ice:good:nondegraded', 'ice:marginal:nondegraded',
+        'ice:poor:nondegraded', 'ice:verypoor:nondegraded',
+        ]
+column_index = {column: idx for idx, column in enumerate(columns)}
+
+# Land cover classes for each cover, used by block_km2_fractions
+covers = ['forest', 'cropland', 'grassland', 'bare', 'urban', 'water', 'ice']
+cover_classes = {
+        'forest': (12, 50, 60, 61, 62, 70, 71, 72, 80, 81, 82, 90, 160, 170),
+        'cropland': (10, 30, 20),
+        'grassland': (11, 40, 100, 110, 120, 121, 122, 130, 150, 151, 152, 153, 180),
+        'bare': (140, 200, 201, 202),
+        'urban': (190,),
+        'water': (210,),
+        'ice': (220,),
+        }
+cover_lut = np.full(256, len(covers), dtype=np.uint8)
+for code, cover in enumerate(covers):
+    cover_lut[list(cover_classes[cover])] = code
+soils = ['good', 'marginal', 'poor', 'verypoor']
+degradations = ['degraded', 'nondegraded']
+# label_columns[cover][nondegraded * len(soils) + soil] is the column index
+label_columns = np.array([[column_index[f'{cover}:{soil}:{degraded}']
+        for degraded in degradations for soil in soils] for cover in covers])
+
+
 def start_pdb(sig, frame):
     """Start PDB on a signal."""
     pdb.Pdb().set_trace(frame)
 
 
-def produce_CSV():
-    """Produce a CSV file of degraded land for {forest, cropland, grassland}."""
-    columns = [
-            'forest:good:degraded', 'forest:marginal:degraded',
-            'forest:poor:degraded', 'forest:verypoor:degraded',
-            'forest:good:nondegraded', 'forest:marginal:nondegraded',
-            'forest:poor:nondegraded', 'forest:verypoor:nondegraded',
-            'cropland:good:degraded', 'cropland:marginal:degraded',
-            'cropland:poor:degraded', 'cropland:verypoor:degraded',
-            'cropland:good:nondegraded', 'cropland:marginal:nondegraded',
-            'cropland:poor:nondegraded', 'cropland:verypoor:nondegraded',
-            'grassland:good:degraded', 'grassland:marginal:degraded',
-            'grassland:poor:degraded', 'grassland:verypoor:degraded',
-            'grassland:good:nondegraded', 'grassland:marginal:nondegraded',
-            'grassland:poor:nondegraded', 'grassland:verypoor:nondegraded',
-            'bare:good:degraded', 'bare:marginal:degraded',
-            'bare:poor:degraded', 'bare:verypoor:degraded',
-            'bare:good:nondegraded', 'bare:marginal:nondegraded',
-            'bare:poor:nondegraded', 'bare:verypoor:nondegraded',
-            'urban:good:degraded', 'urban:marginal:degraded',
-            'urban:poor:degraded', 'urban:verypoor:degraded',
-            'urban:good:nondegraded', 'urban:marginal:nondegraded',
-            'urban:poor:nondegraded', 'urban:verypoor:nondegraded',
-            'water:good:degraded', 'water:marginal:degraded',
-            'water:poor:degraded', 'water:verypoor:degraded',
-            'water:good:nondegraded', 'water:marginal:nondegraded',
-            'water:poor:nondegraded', 'water:verypoor:nondegraded',
-            'ice:good:degraded', 'ice:marginal:degraded',
-            'ice:poor:degraded', 'ice:verypoor:degraded',
-            'ice:good:nondegraded', 'ice:marginal:nondegraded',
-            'ice:poor:nondegraded', 'ice:verypoor:nondegraded',
-            ]
-    df = pd.DataFrame(columns=columns, dtype='float')
-    df.index.name = 'Country'
+def classify_upsampled(x, y, ncols, nrows, lc_band, lpd_band, wk_band):
+    """Return dict of the cover, degradation and workability masks of one 1km block at 333m."""
+    pool = geoutil.buffer_pool
+    shape = (3*nrows, 3*ncols)
+    lc_blk = lc_band.ReadAsArray(3*x, 3*y, 3*ncols, 3*nrows)
+    lc = {}
+    lc['forest'] = np.logical_or.reduce((lc_blk == 12, lc_blk == 50,
+            lc_blk == 60, lc_blk == 61, lc_blk == 62,
+            lc_blk == 70, lc_blk == 71, lc_blk == 72,
+            lc_blk == 80, lc_blk == 81, lc_blk == 82,
+            lc_blk == 90, lc_blk == 160, lc_blk == 170))
+    lc['cropland'] = np.logical_or.reduce((lc_blk == 10, lc_blk == 30,
+            lc_blk == 20))
+    lc['grassland'] = np.logical_or.reduce((lc_blk == 11, lc_blk == 40,
+            lc_blk == 100, lc_blk == 110, lc_blk == 120, lc_blk == 121, lc_blk == 122,
+            lc_blk == 130, lc_blk == 150, lc_blk == 151, lc_blk == 152, lc_blk == 153,
+            lc_blk == 180))
+    lc['bare'] = np.logical_or.reduce((lc_blk == 140, lc_blk == 200,
+            lc_blk == 201, lc_blk == 202))
+    lc['urban'] = (lc_blk == 190)
+    lc['water'] = (lc_blk == 210)
+    lc['ice'] = (lc_blk == 220)
+
+    k = lpd_band.ReadAsArray(x, y, ncols, nrows)
+    lpd = {}
+    lpd_blk = geoutil.upsample(k, 3, out=pool.scratch('lpd', shape, k.dtype))
+    lpd['degraded'] = (lpd_blk != 0.0)
+    lpd['nondegraded'] = (lpd_blk == 0.0)
+
+    k = wk_band.ReadAsArray(x, y, ncols, nrows)
+    wk_blk = geoutil.upsample(k, 3, out=pool.scratch('wk', shape, k.dtype))
+    work = {}
+    work['good'] = (wk_blk == 1)
+    work['marginal'] = (wk_blk == 2)
+    work['poor'] = (wk_blk == 3)
+    work['verypoor'] = (wk_blk == 4)
+    return {'lc': lc, 'lpd': lpd, 'work': work}
+
+
+def km2_upsampled(classes, km2_blk):
+    """Return the area of each column of a block from classify_upsampled, given 1km areas."""
+    lc, lpd, work = classes['lc'], classes['lpd'], classes['work']
+    km2_blk = geoutil.upsample(km2_blk, 3, out=geoutil.buffer_pool.scratch('km2',
+            lpd['degraded'].shape, np.float64))
+    km2_blk /= 9.0
+
+    km2 = np.zeros(len(columns))
+    for cover in lc.keys():
+        for degraded in lpd.keys():
+            for soil in work.keys():
+                col = column_index[f'{cover}:{soil}:{degraded}']
+                km2[col] = (np.logical_and.reduce((lc[cover], lpd[degraded],
+                    work[soil])) * km2_blk).sum()
+    return km2
+
+
+def block_km2_upsampled(x, y, ncols, nrows, km2_blk, lc_band, lpd_band, wk_band):
+    """Return the area of each column for one 1km block, upsampling the 1km inputs to 333m."""
+    classes = classify_upsampled(x=x, y=y, ncols=ncols, nrows=nrows, lc_band=lc_band,
+            lpd_band=lpd_band, wk_band=wk_band)
+    return km2_upsampled(classes=classes, km2_blk=km2_blk)
+
+
+def classify_fractions(x, y, ncols, nrows, lc_band, lpd_band, wk_band):
+    """Return dict of the cover counts and column labels of one 1km block.
+
+       Each 3x3 window of 333m land cover is reduced to a count of pixels of each cover.
+    """
+    lc_blk = lc_band.ReadAsArray(3*x, 3*y, 3*ncols, 3*nrows)
+    codes = np.take(cover_lut, lc_blk,
+            out=geoutil.buffer_pool.scratch('cover', lc_blk.shape, np.uint8))
+    counts = geoutil.class_counts(codes=codes, nclasses=len(covers), factor=3)
+    lpd_blk = lpd_band.ReadAsArray(x, y, ncols, nrows)
+    wk_blk = wk_band.ReadAsArray(x, y, ncols, nrows)
+    valid = (wk_blk >= 1) & (wk_blk <= len(soils))
+    label = (lpd_blk == 0.0) * len(soils) + np.where(valid, wk_blk, 1).astype(np.intp) - 1
+    return {'counts': counts, 'label': label, 'valid': valid}
+
+
+def km2_fractions(classes, km2_blk):
+    """Return the area of each column of a block from classify_fractions, given its areas."""
+    counts, label, valid = classes['counts'], classes['label'], classes['valid']
+    subpixel_km2 = np.where(valid, km2_blk, 0.0).ravel() / 9.0
+
+    km2 = np.zeros(len(columns))
+    for idx in range(len(covers)):
+        count = counts[idx].ravel()
+        if not count.any():
+            continue
+        km2 += np.bincount(np.take(label_columns[idx], label.ravel()),
+                weights=count * subpixel_km2, minlength=len(columns))
+    return km2
+
+
+def block_km2_fractions(x, y, ncols, nrows, km2_blk, lc_band, lpd_band, wk_band):
+    """Return the same vector as block_km2_upsampled, computed at 1km."""
+    classes = classify_fractions(x=x, y=y, ncols=ncols, nrows=nrows, lc_band=lc_band,
+            lpd_band=lpd_band, wk_band=wk_band)
+    return km2_fractions(classes=classes, km2_blk=km2_blk)
+
+
+def accumulate_block_major(acc, features, bands, inputs, lc_fractions=False, decodes=None,
+        instruments=instrument.disabled):
+    """Accumulate the degraded areas of every country into acc, reading each input block once.
+
+       bands is the dict of lc_band, lpd_band and wk_band. Each window populated in any
+       country mask is classified once and then reduced for every mask within it.
+    """
+    masks = {}
+    maskimgs = []
+    for idx, feature in enumerate(features):
+        admin = admin_names.lookup(feature.GetField("ADMIN"))
+        if admin is None:
+            continue
+        a3 = feature.GetField("SOV_A3")
+        maskfilename = f"masks/{a3}_{idx}_1km_mask._tif"
+        maskimg = osgeo.gdal.Open(maskfilename, osgeo.gdal.GA_ReadOnly)
+        maskimgs.append(maskimg)
+        masks[(idx, admin)] = (maskfilename, instruments.band(maskimg.GetRasterBand(1)),
+                geoutil.geometry_envelopes(feature.GetGeometryRef()))
+    rows = {key: acc.row(key[1]) for key in masks}
+
+    print(f"Processing {len(masks)} 1km masks")
+    maskfilename, mask_band, _ = next(iter(masks.values()))
+    x_winsiz, y_winsiz = geoutil.plan_window(inputs=[(mask_band, 1)] + inputs,
+            x_siz=mask_band.XSize, y_siz=mask_band.YSize)
+    with instruments.stage('populated'):
+        windows = geoutil.shared_windows(masks=masks, x_winsiz=x_winsiz, y_winsiz=y_winsiz)
+    instruments.count('blocks', len(windows))
+    instruments.count('blocks_skipped', math.ceil(mask_band.XSize / x_winsiz) *
+            math.ceil(mask_band.YSize / y_winsiz) - len(windows))
+    classify = classify_fractions if lc_fractions else classify_upsampled
+    km2_fn = km2_fractions if lc_fractions else km2_upsampled
+    with instruments.profile():
+        for x, y, ncols, nrows, members in windows:
+            if decodes is not None:
+                decodes.add(inputs=inputs, x=x, y=y, ncols=ncols, nrows=nrows)
+            with instruments.stage('classify'):
+                classes = classify(x=x, y=y, ncols=ncols, nrows=nrows, **bands)
+            km2_blk = geoutil.km2_block(nrows=nrows, ncols=ncols, y_off=y, img=maskimgs[0])
+            out = geoutil.buffer_pool.scratch('mask', (nrows, ncols), np.uint8)
+            for key, full in members:
+                with instruments.stage('km2'):
+                    mask_blk = geoutil.read_mask_block(band=masks[key][1], x=x, y=y,
+                            ncols=ncols, nrows=nrows, full=full, out=out)
+                    k = geoutil.mask_km2(mask_blk=mask_blk, km2_blk=km2_blk)
+                with instruments.stage('classify'):
+                    km2 = km2_fn(classes=classes, km2_blk=k)
+                with instruments.stage('accumulate'):
+                    acc.add(rows[key], km2)
+            instruments.count('masks_applied', len(members))
+
+
+def produce_CSV(lc_fractions=False, decodes=None, instruments=instrument.disabled,
+        block_major=False):
+    """Produce a CSV file of degraded land for {forest, cropland, grassland}.
+
+       With lc_fractions, each 3x3 window of 333m land cover is reduced to counts of each cover
+       and all arithmetic is done on the 1km grid, rather than upsampling the 1km inputs.
+       Tile decompressions of the inputs are counted in decodes, if given, and stage timings
+       and block counts are recorded in instruments. Decoded input tiles are kept in
+       geoutil.tile_cache, as neighbouring countries share many of them. With block_major,
+       the inputs are traversed once for all countries, see accumulate_block_major().
+    """
+    acc = accumulator.Accumulator(columns=columns)
 
     shapefilename = 'data/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
     shapefile = osgeo.ogr.Open(shapefilename)
@@ -73,84 +260,69 @@ def produce_CSV():
     features = shapefile.GetLayerByIndex(0)
     lc_filename = 'data/copernicus/ESACCI-LC-L4-LCCS-Map-300m-P1Y-2015-v2.0.7.tif'
     lc_img = osgeo.gdal.Open(lc_filename, osgeo.gdal.GA_ReadOnly)
-    lc_band = lc_img.GetRasterBand(1)
+    lc_band = instruments.band(geoutil.PooledBand(lc_img.GetRasterBand(1),
+            cache=geoutil.tile_cache))
 
     lpd_filename = 'data/lpd_int2/lpd_int2.tif'
     lpd_img = osgeo.gdal.Open(lpd_filename, osgeo.gdal.GA_ReadOnly)
-    lpd_band = lpd_img.GetRasterBand(1)
+    lpd_band = instruments.band(geoutil.PooledBand(lpd_img.GetRasterBand(1),
+            cache=geoutil.tile_cache))
 
     wk_filename = 'data/FAO/workability_FAO_sq7_1km.tif'
     wk_img = osgeo.gdal.Open(wk_filename, osgeo.gdal.GA_ReadOnly)
-    wk_band = wk_img.GetRasterBand(1)
+    wk_band = instruments.band(geoutil.PooledBand(wk_img.GetRasterBand(1),
+            cache=geoutil.tile_cache))
+    inputs = [(lc_band, fractions.Fraction(1, 3)), (lpd_band, 1), (wk_band, 1)]
+    allocations = geoutil.buffer_pool.allocations
+    tiles = geoutil.tile_cache.stats()
 
-    for idx, feature in enumerate(features):
-        admin = admin_names.lookup(feature.GetField("ADMIN"))
-        if admin is None:
-            continue
-        a3 = feature.GetField("SOV_A3")
-        if admin not in df.index:
-            df.loc[admin] = [0] * len(df.columns)
+    if block_major:
+        bands = {'lc_band': lc_band, 'lpd_band': lpd_band, 'wk_band': wk_band}
+        accumulate_block_major(acc=acc, features=features, bands=bands, inputs=inputs,
+                lc_fractions=lc_fractions, decodes=decodes, instruments=instruments)
+    else:
+        for idx, feature in enumerate(features):
+            admin = admin_names.lookup(feature.GetField("ADMIN"))
+            if admin is None:
+                continue
+            a3 = feature.GetField("SOV_A3")
+            row = acc.row(admin)
 
-        print(f"Processing {admin:<41} #{a3}_{idx}")
-        maskfilename = f"masks/{a3}_{idx}_1km_mask._tif"
-        maskimg = osgeo.gdal.Open(maskfilename, osgeo.gdal.GA_ReadOnly)
-        mask_band = maskimg.GetRasterBand(1)
-        x_siz = mask_band.XSize
-        y_siz = mask_band.YSize
-        x_blksiz, y_blksiz = mask_band.GetBlockSize()
-        for y in range(0, y_siz, y_blksiz):
-            nrows = geoutil.blklim(coord=y, blksiz=y_blksiz, totsiz=y_siz)
-            for x in range(0, x_siz, x_blksiz):
-                ncols = geoutil.blklim(coord=x, blksiz=x_blksiz, totsiz=x_siz)
-                if geoutil.is_sparse(band=mask_band, x=x, y=y, ncols=ncols, nrows=nrows):
-                    # sparse hole in image, no data to process
-                    continue
-
-                mask_blk = mask_band.ReadAsArray(x, y, ncols, nrows)
-                k = geoutil.km2_block(nrows=nrows, ncols=ncols, y_off=y, img=maskimg)
-                k[np.logical_not(mask_blk)] = 0.0
-                km2_blk = (np.repeat(np.repeat(k, 3, axis=1), 3, axis=0)) / 9.0
-
-                lc_blk = lc_band.ReadAsArray(3*x, 3*y, 3*ncols, 3*nrows)
-                lc = {}
-                lc['forest'] = np.logical_or.reduce((lc_blk == 12, lc_blk == 50,
-                        lc_blk == 60, lc_blk == 61, lc_blk == 62,
-                        lc_blk == 70, lc_blk == 71, lc_blk == 72,
-                        lc_blk == 80, lc_blk == 81, lc_blk == 82,
-                        lc_blk == 90, lc_blk == 160, lc_blk == 170))
-                lc['cropland'] = np.logical_or.reduce((lc_blk == 10, lc_blk == 30,
-                        lc_blk == 20))
-                lc['grassland'] = np.logical_or.reduce((lc_blk == 11, lc_blk == 40,
-                        lc_blk == 100, lc_blk == 110, lc_blk == 120, lc_blk == 121, lc_blk == 122,
-                        lc_blk == 130, lc_blk == 150, lc_blk == 151, lc_blk == 152, lc_blk == 153,
-                        lc_blk == 180))
-                lc['bare'] = np.logical_or.reduce((lc_blk == 140, lc_blk == 200,
-                        lc_blk == 201, lc_blk == 202))
-                lc['urban'] = (lc_blk == 190)
-                lc['water'] = (lc_blk == 210)
-                lc['ice'] = (lc_blk == 220)
-
-                k = lpd_band.ReadAsArray(x, y, ncols, nrows)
-                lpd = {}
-                lpd_blk = np.repeat(np.repeat(k, 3, axis=1), 3, axis=0)
-                lpd['degraded'] = (lpd_blk != 0.0)
-                lpd['nondegraded'] = (lpd_blk == 0.0)
-
-                k = wk_band.ReadAsArray(x, y, ncols, nrows)
-                wk_blk = np.repeat(np.repeat(k, 3, axis=1), 3, axis=0)
-                work = {}
-                work['good'] = (wk_blk == 1)
-                work['marginal'] = (wk_blk == 2)
-                work['poor'] = (wk_blk == 3)
-                work['verypoor'] = (wk_blk == 4)
-
-                for cover in lc.keys():
-                    for degraded in lpd.keys():
-                        for soil in work.keys():
-                            key = f'{cover}:{soil}:{degraded}'
-                            df.loc[admin, key] += (np.logical_and.reduce((lc[cover], lpd[degraded],
-                                work[soil])) * km2_blk).sum()
+            print(f"Processing {admin:<41} #{a3}_{idx}")
+            maskfilename = f"masks/{a3}_{idx}_1km_mask._tif"
+            with instruments.country(admin), instruments.profile():
+                maskimg = osgeo.gdal.Open(maskfilename, osgeo.gdal.GA_ReadOnly)
+                mask_band = instruments.band(geoutil.PooledBand(maskimg.GetRasterBand(1)))
+                x_winsiz, y_winsiz = geoutil.plan_window(inputs=[(mask_band, 1)] + inputs,
+                        x_siz=mask_band.XSize, y_siz=mask_band.YSize)
+                with instruments.stage('populated'):
+                    windows = geoutil.populated_windows(maskfilename, mask_band,
+                            x_winsiz=x_winsiz, y_winsiz=y_winsiz,
+                            envelopes=geoutil.geometry_envelopes(feature.GetGeometryRef()))
+                instruments.count('blocks', len(windows))
+                instruments.count('blocks_skipped', math.ceil(mask_band.XSize / x_winsiz) *
+                        math.ceil(mask_band.YSize / y_winsiz) - len(windows))
+                for x, y, ncols, nrows, full in windows:
+                    if decodes is not None:
+                        decodes.add(inputs=inputs, x=x, y=y, ncols=ncols, nrows=nrows)
+                    with instruments.stage('km2'):
+                        mask_blk = geoutil.read_mask_block(band=mask_band, x=x, y=y, ncols=ncols,
+                                nrows=nrows, full=full)
+                        k = geoutil.km2_block(nrows=nrows, ncols=ncols, y_off=y, img=maskimg)
+                        k = geoutil.mask_km2(mask_blk=mask_blk, km2_blk=k)
+                    with instruments.stage('classify'):
+                        block_km2 = block_km2_fractions if lc_fractions else block_km2_upsampled
+                        km2 = block_km2(x=x, y=y, ncols=ncols, nrows=nrows, km2_blk=k,
+                                lc_band=lc_band, lpd_band=lpd_band, wk_band=wk_band)
+                    with instruments.stage('accumulate'):
+                        acc.add(row, km2)
+    instruments.count('buffer_allocations', geoutil.buffer_pool.allocations - allocations)
+    tiles = geoutil.tile_cache.stats(since=tiles)
+    geoutil.tile_cache.report(tiles)
+    for name, n in tiles.items():
+        instruments.count(f'tile_cache_{name}', n)
 
+    df = acc.to_dataframe()
     csvfilename = 'results/degraded-cover-by-country.csv'
     df.sort_index(axis='index').to_csv(csvfilename, float_format='%.2f')
 
@@ -168,5 +340,43 @@ def produce_CSV():
 
 if __name__ == '__main__':
     signal.signal(signal.SIGUSR1, start_pdb)
+    # GDAL may have read GDAL_CACHEMAX already, so set it directly as well.
     os.environ['GDAL_CACHEMAX'] = '128'
-    produce_CSV()
+    osgeo.gdal.SetCacheMax(128 * 1024 * 1024)
+
+    parser = argparse.ArgumentParser(description='Produce degraded land CSV files')
+    parser.add_argument('--lc-fractions', default=False, required=False,
+                        action='store_true', help='compute at 1km using counts of each '
+                        'land cover within the 1km pixel, instead of upsampling to 333m')
+    parser.add_argument('--window-budget', default=None, required=False, type=int,
+                        help='MiB of input data to read per processing window')
+    parser.add_argument('--tile-cache', default=None, required=False, type=int,
+                        help='MiB of decoded input tiles to keep across countries, 0 to disable')
+    parser.add_argument('--decode-report', default=False, required=False,
+                        action='store_true', help='report decompressions per input tile')
+    parser.add_argument('--instrument', default=None, required=False,
+                        help='write stage timings and block counts to this JSON or .csv file')
+    parser.add_argument('--profile', default=None, required=False,
+                        help='write cProfile statistics of the block loop to this file')
+    parser.add_argument('--block-major', default=False, required=False,
+                        action='store_true', help='read each input block once for all '
+                        'countries, instead of once per country')
+    args = parser.parse_args()
+
+    if args.window_budget is not None:
+        geoutil.window_budget = args.window_budget * 1024 * 1024
+    if args.tile_cache is not None:
+        geoutil.tile_cache.budget = args.tile_cache * 1024 * 1024
+    instruments = instrument.disabled
+    if args.instrument or args.profile:
+        instruments = instrument.Instruments(profile=bool(args.profile))
+
+    decodes = geoutil.TileDecodes() if args.decode_report else None
+    produce_CSV(lc_fractions=args.lc_fractions, decodes=decodes, instruments=instruments,
+            block_major=args.block_major)
+    if decodes is not None:
+        decodes.report()
+    if args.instrument:
+        instruments.write(args.instrument)
+    if args.profile:
+        instruments.write_profile(args.profile)
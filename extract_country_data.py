@@ -4,7 +4,13 @@
 """Extract counts of each Köppen-Geiger/slope/land cover/soil health for each country,
    for use in Project Drawdown solution models."""
 import argparse
+import concurrent.futures
+import fractions
+import functools
+import hashlib
+import inspect
 import math
+import multiprocessing
 import os.path
 import pdb
 import signal
@@ -17,8 +23,10 @@ import osgeo.ogr
 import numpy as np
 import pandas as pd
 
+import accumulator
 import admin_names
 import geoutil
+import instrument
 
 
 pd.set_option("display.max_rows", 500)
@@ -30,7 +38,59 @@ np.seterr(all='raise')
 
 
 
-class KGlookup:
+class Lookup:
+    """Behavior shared by the dataset lookup classes.
+
+       Each lookup implements read(), which decodes a block of its dataset into the classes
+       of its pixels, reduce(), which reduces such a block to the area of each of its columns
+       within each label in one pass, and get_columns(). A block which has been read once can
+       be reduced for any number of masks, see process_map_blocks().
+    """
+    def km2_by_label(self, x, y, ncols, nrows, labelblock, km2block, nlabels):
+        """Return (nlabels, ncolumns) numpy array of area per class within each label."""
+        block = self.read(x=x, y=y, ncols=ncols, nrows=nrows)
+        return self.reduce(block=block, labelblock=labelblock, km2block=km2block,
+                nlabels=nlabels)
+
+    def km2(self, x, y, ncols, nrows, maskblock, km2block, acc, row):
+        """Add the area of each class within the mask block to row of Accumulator acc."""
+        km2 = self.km2_by_label(x=x, y=y, ncols=ncols, nrows=nrows, labelblock=(maskblock != 0),
+                km2block=km2block, nlabels=2)
+        acc.add(row, km2[1])
+
+    def bands(self):
+        """Return list of the GDAL bands this lookup reads, for planning windows."""
+        return [self.band]
+
+    def digest(self):
+        """Return a digest of the code, class mapping and datasets of this lookup.
+
+           This keys the results of the lookup in the result cache, see result_filename(), so
+           changing any of them recomputes the results of this lookup and of no other. The
+           shared code in result_cache_functions is included as well, so a fix to any of it
+           recomputes every lookup.
+        """
+        h = hashlib.sha1()
+        h.update(str(result_cache_version).encode('utf-8'))
+        for obj in list(type(self).__mro__[:-1]) + result_cache_functions():
+            h.update(inspect.getsource(obj).encode('utf-8'))
+        h.update(repr(list(self.get_columns())).encode('utf-8'))
+        if getattr(self, 'lut', None) is not None:
+            h.update(self.lut.tobytes())
+        for filename in sorted(set(b.GetDataset().GetDescription() for b in self.bands())):
+            h.update(geoutil.file_digest(filename).encode('utf-8'))
+        return h.hexdigest()
+
+    def __reduce__(self):
+        """Pickle as the constructor arguments, so a copy in another process opens its own
+           GDAL handles."""
+        kwargs = {'maskdim': self.maskdim}
+        if getattr(self, 'mapfilename', None) is not None:
+            kwargs['mapfilename'] = self.mapfilename
+        return (functools.partial(self.__class__, **kwargs), ())
+
+
+class KGlookup(Lookup):
     """Lookup table of pixel color to Köppen-Geiger class.
 
        Mappings come from legend.txt file in ZIP archive from
@@ -52,29 +112,33 @@ class KGlookup:
 
     def __init__(self, mapfilename, maskdim='1km'):
         self.maskdim = maskdim
+        self.mapfilename = mapfilename
         self.img = osgeo.gdal.Open(mapfilename, osgeo.gdal.GA_ReadOnly)
-        self.band = self.img.GetRasterBand(1)
+        self.band = geoutil.PooledBand(self.img.GetRasterBand(1), cache=geoutil.tile_cache)
         self.ctable = self.band.GetColorTable()
-
-    def km2(self, x, y, ncols, nrows, maskblock, km2block, df, admin):
-        block = self.band.ReadAsArray(x, y, ncols, nrows)
-        masked = np.ma.masked_array(block, mask=np.logical_not(maskblock))
-        for label in np.unique(masked):
-            if label is np.ma.masked:
-                continue
-            r, g, b, a = self.ctable.GetColorEntry(int(label))
-            color = (r, g, b)
-            if color == (255, 255, 255) or color == (0, 0, 0):
-                # blank pixel == masked off, just skip it.
-                continue
-            typ = self.kg_colors[color]
-            df.loc[admin, typ] += km2block[masked == label].sum()
+        self.columns = list(self.kg_colors.values())
+        # palette index to column, blank and unknown colors map to len(columns) and are skipped.
+        self.lut = np.full(256, len(self.columns), dtype=np.uint8)
+        for idx in range(min(self.ctable.GetCount(), 256)):
+            r, g, b, a = self.ctable.GetColorEntry(idx)
+            typ = self.kg_colors.get((r, g, b))
+            if typ is not None:
+                self.lut[idx] = self.columns.index(typ)
+
+    def read(self, x, y, ncols, nrows):
+        """Return the column index of each pixel of a block."""
+        return geoutil.lookup_block(self.lut, self.band.ReadAsArray(x, y, ncols, nrows))
+
+    def reduce(self, block, labelblock, km2block, nlabels):
+        """Return (nlabels, ncolumns) numpy array of area per class within each label."""
+        return geoutil.km2_by_label(labels=labelblock, classes=block, km2block=km2block,
+                nlabels=nlabels, nclasses=len(self.columns))
 
     def get_columns(self):
         return self.kg_colors.values()
 
 
-class ESA_LC_lookup:
+class ESA_LC_lookup(Lookup):
     """Pixel color to Land Cover class in C3S-LC-L4-LCCS-Map-300m-P1Y-2018-v2.1.1.tif
 
        There are legends of LCCS<->color swatch in both
@@ -97,16 +161,22 @@ class ESA_LC_lookup:
 
     def __init__(self, mapfilename, maskdim='333m'):
         self.maskdim = maskdim
+        self.mapfilename = mapfilename
         self.img = osgeo.gdal.Open(mapfilename, osgeo.gdal.GA_ReadOnly)
-        self.band = self.img.GetRasterBand(1)
+        self.band = geoutil.PooledBand(self.img.GetRasterBand(1), cache=geoutil.tile_cache)
+        columns = self.get_columns()
+        # LCCS class to column, 0 and 255 (no data) map to len(columns) and are skipped.
+        self.lut = np.full(256, len(columns), dtype=np.uint8)
+        self.lut[columns] = np.arange(len(columns))
 
-    def km2(self, x, y, ncols, nrows, maskblock, km2block, df, admin):
-        block = self.band.ReadAsArray(x, y, ncols, nrows)
-        masked = np.ma.masked_array(block, mask=np.logical_not(maskblock)).filled(-1)
-        for label in np.unique(masked):
-            if label is np.ma.masked or label == 0 or label == 255:
-                continue
-            df.loc[admin, label] += km2block[masked == label].sum()
+    def read(self, x, y, ncols, nrows):
+        """Return the column index of each pixel of a block."""
+        return geoutil.lookup_block(self.lut, self.band.ReadAsArray(x, y, ncols, nrows))
+
+    def reduce(self, block, labelblock, km2block, nlabels):
+        """Return (nlabels, ncolumns) numpy array of area per class within each label."""
+        return geoutil.km2_by_label(labels=labelblock, classes=block, km2block=km2block,
+                nlabels=nlabels, nclasses=len(self.get_columns()))
 
     def get_columns(self):
         """Return list of LCCS classes present in this dataset."""
@@ -114,7 +184,7 @@ class ESA_LC_lookup:
                 121, 122, 130, 140, 150, 151, 152, 153, 160, 170, 180, 190, 200, 201, 202, 210, 220]
 
 
-class GeomorphoLookup:
+class GeomorphoLookup(Lookup):
     """Geomorpho90m pre-processed slope file in data/geomorpho90m/classified_*.tif.
        There is a band in the TIF for each slope class defined in GAEZ 3.0.
     """
@@ -122,22 +192,31 @@ class GeomorphoLookup:
 
     def __init__(self, mapfilename, maskdim='1km'):
         self.maskdim = maskdim
+        self.mapfilename = mapfilename
         self.img = osgeo.gdal.Open(mapfilename, osgeo.gdal.GA_ReadOnly)
+        self.stack = geoutil.BandStack(self.img, cache=geoutil.tile_cache)
+
+    def read(self, x, y, ncols, nrows):
+        """Return (8, nrows, ncols) block of the percentage of each pixel in each class."""
+        block = self.stack.ReadAsArray(x, y, ncols, nrows)
+        # the block may be a read-only view of the input cache, so zero nodata in a copy.
+        out = geoutil.buffer_pool.scratch('geomorpho', block.shape, block.dtype)
+        return np.multiply(block, block != 127, out=out)
 
-    def km2(self, x, y, ncols, nrows, maskblock, km2block, df, admin):
-        for b in range(1, 9):
-            block = self.img.GetRasterBand(b).ReadAsArray(x, y, ncols, nrows).astype(np.float)
-            mask = np.logical_or(np.logical_not(maskblock), block == 127)
-            masked = np.ma.masked_array(block, mask=mask, fill_value=0.0)
-            typ = self.gaez_slopes[b - 1]
-            df.loc[admin, typ] += (km2block * (masked / 100.0)).sum()
+    def reduce(self, block, labelblock, km2block, nlabels):
+        """Return (nlabels, ncolumns) numpy array of area per class within each label."""
+        return geoutil.km2_by_label_percent(labels=labelblock, percents=block,
+                km2block=km2block, nlabels=nlabels)
+
+    def bands(self):
+        return [self.img.GetRasterBand(b) for b in range(1, 9)]
 
     def get_columns(self):
         """Return list of GAEZ slope classes."""
         return self.gaez_slopes
 
 
-class FaoSlopeLookup:
+class FaoSlopeLookup(Lookup):
     """FAO GAEZ 3.0 slope files in data/FAO/GloSlopesCl*_30as.tif.
     """
     gaez_slopes = ["0-0.5%", "0.5-2%", "2-5%", "5-8%", "8-15%", "15-30%", "30-45%", ">45%"]
@@ -148,58 +227,73 @@ class FaoSlopeLookup:
         for i in range(1, 9):
             mapfilename = f"data/FAO/GloSlopesCl{i}_30as.tif"
             self.img[i] = osgeo.gdal.Open(mapfilename, osgeo.gdal.GA_ReadOnly)
+        # one read of the stack fetches all eight classes.
+        self.stack = geoutil.BandStack(geoutil.stack_files(
+                [self.img[i].GetDescription() for i in range(1, 9)]), cache=geoutil.tile_cache)
 
-    def km2(self, x, y, ncols, nrows, maskblock, km2block, df, admin):
-        for i in range(1, 9):
-            block = self.img[i].GetRasterBand(1).ReadAsArray(x, y, ncols, nrows).astype(np.float)
-            mask = np.logical_or(np.logical_not(maskblock), block == 255)
-            masked = np.ma.masked_array(block, mask=mask).filled(0.0)
-            typ = self.gaez_slopes[i - 1]
-            df.loc[admin, typ] += np.nansum(km2block * (masked / 100.0))
+    def read(self, x, y, ncols, nrows):
+        """Return (8, nrows, ncols) block of the percentage of each pixel in each class."""
+        block = self.stack.ReadAsArray(x, y, ncols, nrows)
+        # the block may be a read-only view of the input cache, so zero nodata in a copy.
+        out = geoutil.buffer_pool.scratch('fao_slope', block.shape, block.dtype)
+        return np.multiply(block, block != 255, out=out)
+
+    def reduce(self, block, labelblock, km2block, nlabels):
+        """Return (nlabels, ncolumns) numpy array of area per class within each label."""
+        return geoutil.km2_by_label_percent(labels=labelblock, percents=block,
+                km2block=km2block, nlabels=nlabels)
+
+    def bands(self):
+        return [self.img[i].GetRasterBand(1) for i in range(1, 9)]
 
     def get_columns(self):
         """Return list of GAEZ slope classes."""
         return self.gaez_slopes
 
 
-class WorkabilityLookup:
+class WorkabilityLookup(Lookup):
     """Workability TIF has been pre-processed, pixel values are workability class.
     """
     def __init__(self, mapfilename, maskdim='1km'):
         self.maskdim = maskdim
+        self.mapfilename = mapfilename
         self.img = osgeo.gdal.Open(mapfilename, osgeo.gdal.GA_ReadOnly)
-        self.band = self.img.GetRasterBand(1)
+        self.band = geoutil.PooledBand(self.img.GetRasterBand(1), cache=geoutil.tile_cache)
+        # workability classes 1..7 are columns 0..6, anything else maps to 7 and is skipped.
+        self.lut = np.full(256, 7, dtype=np.uint8)
+        self.lut[1:8] = np.arange(7)
 
-    def km2(self, x, y, ncols, nrows, maskblock, km2block, df, admin):
-        block = self.band.ReadAsArray(x, y, ncols, nrows)
-        masked = np.ma.masked_array(block, mask=np.logical_not(maskblock))
-        for label in np.unique(masked):
-            if label is np.ma.masked or label == 0 or label == 255:
-                # label 0 (black) == no land cover (like water), just skip it.
-                continue
-            df.loc[admin, label] += km2block[masked == label].sum()
+    def read(self, x, y, ncols, nrows):
+        """Return the column index of each pixel of a block."""
+        return geoutil.lookup_block(self.lut, self.band.ReadAsArray(x, y, ncols, nrows))
+
+    def reduce(self, block, labelblock, km2block, nlabels):
+        """Return (nlabels, ncolumns) numpy array of area per class within each label."""
+        return geoutil.km2_by_label(labels=labelblock, classes=block, km2block=km2block,
+                nlabels=nlabels, nclasses=7)
 
     def get_columns(self):
         return range(1, 8)
 
 
-class DegradedLandLookup:
+class DegradedLandLookup(Lookup):
     """Binary indication of soil in LDPclass 1, 2, or 3."""
     def __init__(self, mapfilename, maskdim='1km'):
         self.maskdim = maskdim
+        self.mapfilename = mapfilename
         self.img = osgeo.gdal.Open(mapfilename, osgeo.gdal.GA_ReadOnly)
-        self.band = self.img.GetRasterBand(1)
+        self.band = geoutil.PooledBand(self.img.GetRasterBand(1), cache=geoutil.tile_cache)
 
-    def km2(self, x, y, ncols, nrows, maskblock, km2block, df, admin):
+    def read(self, x, y, ncols, nrows):
+        """Return the column index of each pixel of a block."""
         block = self.band.ReadAsArray(x, y, ncols, nrows)
-        masked = np.ma.masked_array(block, mask=np.logical_not(maskblock))
-        for label in np.unique(masked):
-            if label is np.ma.masked:
-                continue
-            if label == 0.0:
-                df.loc[admin, "nondegraded"] += km2block[masked == label].sum()
-            else:
-                df.loc[admin, "degraded"] += km2block[masked == label].sum()
+        out = geoutil.buffer_pool.scratch('nondegraded', block.shape, np.bool_)
+        return np.equal(block, 0, out=out).view(np.uint8)
+
+    def reduce(self, block, labelblock, km2block, nlabels):
+        """Return (nlabels, ncolumns) numpy array of area per class within each label."""
+        return geoutil.km2_by_label(labels=labelblock, classes=block, km2block=km2block,
+                nlabels=nlabels, nclasses=2)
 
     def get_columns(self):
         return ["degraded", "nondegraded"]
@@ -210,42 +304,507 @@ def start_pdb(sig, frame):
     pdb.Pdb().set_trace(frame)
 
 
-def process_map(lookupobj, csvfilename):
-    """Produce a CSV file of areas per country from a dataset."""
+def feature_list():
+    """Return list of (idx, a3, admin) for each feature with a Drawdown country name."""
     shapefilename = 'data/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
-    df = pd.DataFrame(columns=lookupobj.get_columns(), dtype=float)
-    df.index.name = 'Country'
     shapefile = osgeo.ogr.Open(shapefilename)
     assert shapefile.GetLayerCount() == 1
     layer = shapefile.GetLayerByIndex(0)
 
+    features = []
     for idx, feature in enumerate(layer):
         admin = admin_names.lookup(feature.GetField("ADMIN"))
         if admin is None:
             continue
-        a3 = feature.GetField("SOV_A3")
-        if admin not in df.index:
-            df.loc[admin] = [0] * len(df.columns)
+        features.append((idx, feature.GetField("SOV_A3"), admin))
+    return features
+
+
+def feature_envelopes():
+    """Return dict of feature index to the geoutil.geometry_envelopes() of the feature."""
+    shapefilename = 'data/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
+    shapefile = osgeo.ogr.Open(shapefilename)
+    assert shapefile.GetLayerCount() == 1
+    layer = shapefile.GetLayerByIndex(0)
+    return {idx: geoutil.geometry_envelopes(feature.GetGeometryRef())
+            for idx, feature in enumerate(layer)}
+
+
+# Directory holding the area of each lookup within each feature, see result_filename().
+results_cache_dirname = 'cache/results'
+
+# Bump to invalidate every cached result, for changes result_cache_functions() cannot see.
+result_cache_version = 1
+
+
+def result_cache_functions():
+    """Return list of the shared functions the per-feature results depend on, see digest()."""
+    return [geoutil.km2_by_label, geoutil.km2_by_label_percent, geoutil.lookup_block,
+            geoutil.km2_block, geoutil.km2_rows, geoutil._km2_compute, geoutil.km2_table,
+            geoutil.read_mask_block, geoutil.mask_km2, geoutil.plan_window, geoutil._lcm,
+            geoutil.populated_windows, geoutil.populated_blocks, geoutil.PooledBand,
+            geoutil.BandStack, process_feature]
 
-        print(f"Processing {admin:<41} #{a3}_{idx}")
-        maskfilename = f"masks/{a3}_{idx}_{lookupobj.maskdim}_mask._tif"
+# Lookups at a finer mask resolution which can share the traversal of a coarser one, and the
+# ratio between them: each 1km block is fed to a 333m lookup as the matching 3x window.
+fused_grids = {'333m': ('1km', 3)}
+
+
+def mask_filename(idx, a3, maskdim):
+    return f"masks/{a3}_{idx}_{maskdim}_mask._tif"
+
+
+def group_lookups(lookupobjs):
+    """Return dict of traversal maskdim to list of indexes into lookupobjs.
+
+       A lookup in fused_grids joins the traversal of the coarser grid, but only if some other
+       lookup needs that grid anyway.
+    """
+    maskdims = set(lookupobj.maskdim for lookupobj in lookupobjs)
+    groups = {}
+    for n, lookupobj in enumerate(lookupobjs):
+        maskdim = lookupobj.maskdim
+        if maskdim in fused_grids and fused_grids[maskdim][0] in maskdims:
+            maskdim = fused_grids[maskdim][0]
+        groups.setdefault(maskdim, []).append(n)
+    return groups
+
+
+def fused_blocks(masks, maskdim, x_blksiz, y_blksiz, envelopes=None):
+    """Return sorted list of (x, y, ncols, nrows, full) windows of maskdim to traverse.
+
+       This is the union of the populated windows of the maskdim mask and, mapped down to the
+       maskdim grid, of the populated blocks of any finer masks in the same traversal. Windows
+       are x_blksiz by y_blksiz, a multiple of the maskdim mask's block size. envelopes of the
+       feature limit the blocks probed in masks without a manifest, see populated_blocks().
+    """
+    maskfilename, maskimg, maskband = masks[maskdim]
+    x_siz = maskband.XSize
+    y_siz = maskband.YSize
+    blocks = {}
+    for x, y, ncols, nrows, full in geoutil.populated_windows(maskfilename, maskband,
+            x_winsiz=x_blksiz, y_winsiz=y_blksiz, envelopes=envelopes):
+        blocks[(x, y)] = full
+    for finedim, (finefilename, fineimg, fineband) in masks.items():
+        if finedim == maskdim:
+            continue
+        scale = fused_grids[finedim][1]
+        for x, y, ncols, nrows, full in geoutil.populated_blocks(finefilename, fineband,
+                envelopes=envelopes):
+            for by in range((y // scale) // y_blksiz, ((y + nrows - 1) // scale) // y_blksiz + 1):
+                for bx in range((x // scale) // x_blksiz,
+                        ((x + ncols - 1) // scale) // x_blksiz + 1):
+                    blocks.setdefault((bx * x_blksiz, by * y_blksiz), False)
+    return [(x, y, geoutil.blklim(coord=x, blksiz=x_blksiz, totsiz=x_siz),
+             geoutil.blklim(coord=y, blksiz=y_blksiz, totsiz=y_siz), full)
+            for (x, y), full in sorted(blocks.items(), key=lambda b: (b[0][1], b[0][0]))]
+
+
+def process_feature(lookupobjs, idx, a3, admin, accs, decodes=None,
+        instruments=instrument.disabled, envelopes=None):
+    """Add the areas of one feature to accs[n] for each lookupobjs[n].
+
+       The masks of the feature are traversed once for all of the lookups, reading the mask and
+       computing the pixel areas of each block once no matter how many lookups use it. Windows
+       are aligned to the tiles of the masks and datasets, see geoutil.plan_window(), and tile
+       decompressions of the datasets are counted in decodes if given. The time spent in each
+       lookup, the blocks processed and skipped and the arrays allocated by the buffer pool are
+       recorded in instruments. envelopes are those of the feature, see fused_blocks().
+    """
+    rows = [acc.row(admin) for acc in accs]
+    print(f"Processing {admin:<41} #{a3}_{idx}")
+    with instruments.country(admin), instruments.profile():
+        allocations = geoutil.buffer_pool.allocations
+        for maskdim, group in group_lookups(lookupobjs).items():
+            masks = {}
+            for dim in set([maskdim] + [lookupobjs[n].maskdim for n in group]):
+                maskfilename = mask_filename(idx=idx, a3=a3, maskdim=dim)
+                maskimg = osgeo.gdal.Open(maskfilename, osgeo.gdal.GA_ReadOnly)
+                masks[dim] = (maskfilename, maskimg,
+                        instruments.band(geoutil.PooledBand(maskimg.GetRasterBand(1))))
+
+            # the coarse mask comes first so that windows stay aligned with its blocks, finer
+            # masks and datasets are read at fused_grids scale of the coarse grid.
+            maskband = masks[maskdim][2]
+            maskinputs = [(maskband, 1)]
+            for dim, (_, _, band) in masks.items():
+                if dim != maskdim:
+                    maskinputs.append((band, fractions.Fraction(1, fused_grids[dim][1])))
+            inputs = []
+            for n in group:
+                dim = lookupobjs[n].maskdim
+                ratio = 1 if dim == maskdim else fractions.Fraction(1, fused_grids[dim][1])
+                inputs.extend((band, ratio) for band in lookupobjs[n].bands())
+            x_winsiz, y_winsiz = geoutil.plan_window(inputs=maskinputs + inputs,
+                    x_siz=maskband.XSize, y_siz=maskband.YSize)
+
+            # lookups read their datasets directly, so their reads are counted as the bytes of
+            # one pixel of each of their bands per pixel of the block.
+            pixel_bytes = [sum(osgeo.gdal.GetDataTypeSize(band.DataType) // 8
+                               for band in lookupobjs[n].bands()) for n in group]
+            with instruments.stage('populated'):
+                windows = fused_blocks(masks=masks, maskdim=maskdim, x_blksiz=x_winsiz,
+                        y_blksiz=y_winsiz, envelopes=envelopes)
+            instruments.count('blocks', len(windows))
+            instruments.count('blocks_skipped', math.ceil(maskband.XSize / x_winsiz) *
+                    math.ceil(maskband.YSize / y_winsiz) - len(windows))
+            for x, y, ncols, nrows, full in windows:
+                if decodes is not None:
+                    decodes.add(inputs=inputs, x=x, y=y, ncols=ncols, nrows=nrows)
+                blocks = {}
+                for n, nbytes in zip(group, pixel_bytes):
+                    lookupobj = lookupobjs[n]
+                    dim = lookupobj.maskdim
+                    scale = 1 if dim == maskdim else fused_grids[dim][1]
+                    if dim not in blocks:
+                        with instruments.stage('km2'):
+                            maskfilename, maskimg, maskband = masks[dim]
+                            maskblock = geoutil.read_mask_block(band=maskband, x=x * scale,
+                                    y=y * scale, ncols=ncols * scale, nrows=nrows * scale,
+                                    full=(full and scale == 1))
+                            km2block = geoutil.km2_block(nrows=nrows * scale,
+                                    ncols=ncols * scale, y_off=y * scale, img=maskimg)
+                        blocks[dim] = (maskblock, km2block)
+                    maskblock, km2block = blocks[dim]
+                    with instruments.stage(type(lookupobj).__name__):
+                        lookupobj.km2(x=x * scale, y=y * scale, ncols=ncols * scale,
+                                nrows=nrows * scale, maskblock=maskblock, km2block=km2block,
+                                acc=accs[n], row=rows[n])
+                    instruments.count('bytes_read', nbytes * ncols * nrows * scale * scale)
+        instruments.count('buffer_allocations', geoutil.buffer_pool.allocations - allocations)
+
+
+_worker_lookupobjs = None
+_worker_count_decodes = False
+_worker_instrumented = False
+
+
+def _init_worker(lookupobjs, window_budget, tile_cache_budget, count_decodes, instrumented):
+    global _worker_lookupobjs, _worker_count_decodes, _worker_instrumented
+    _worker_lookupobjs = lookupobjs
+    _worker_count_decodes = count_decodes
+    _worker_instrumented = instrumented
+    geoutil.window_budget = window_budget
+    geoutil.tile_cache.budget = tile_cache_budget
+
+
+def _process_feature_worker(idx, a3, admin, ns, envelopes):
+    lookupobjs = [_worker_lookupobjs[n] for n in ns]
+    accs = [accumulator.Accumulator(columns=lookupobj.get_columns())
+            for lookupobj in lookupobjs]
+    decodes = geoutil.TileDecodes() if _worker_count_decodes else None
+    instruments = instrument.Instruments() if _worker_instrumented else instrument.disabled
+    tiles = geoutil.tile_cache.stats()
+    process_feature(lookupobjs=lookupobjs, idx=idx, a3=a3, admin=admin, accs=accs,
+            decodes=decodes, instruments=instruments, envelopes=envelopes)
+    return (accs, decodes, (instruments if _worker_instrumented else None),
+            geoutil.tile_cache.stats(since=tiles))
+
+
+def process_features_parallel(lookupobjs, features, accs, jobs, decodes=None,
+        instruments=instrument.disabled, envelopes=None):
+    """Process features in a pool of jobs worker processes, merging the results into accs.
+
+       Each worker unpickles its own copy of lookupobjs and so opens its own GDAL handles. The
+       largest masks are submitted first so they do not leave the pool idle at the end. Workers
+       are not profiled, but their stage timings and counters are merged into instruments, and
+       the statistics of their tile caches into geoutil.tile_cache.
+       features is as returned by pending_features(), envelopes by feature_envelopes().
+    """
+    if envelopes is None:
+        envelopes = {}
+    def work(feature):
+        idx, a3, admin, ns, filenames = feature
+        maskdims = set(lookupobjs[n].maskdim for n in ns)
+        return sum(geoutil.mask_work(mask_filename(idx=idx, a3=a3, maskdim=maskdim))
+                for maskdim in maskdims)
+
+    ctx = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(lookupobjs, geoutil.window_budget, geoutil.tile_cache.budget,
+                decodes is not None, instruments is not instrument.disabled)) as executor:
+        futures = {}
+        for feature in sorted(features, key=work, reverse=True):
+            idx, a3, admin, ns, filenames = feature
+            futures[executor.submit(_process_feature_worker, idx, a3, admin, ns,
+                    envelopes.get(idx))] = feature
+        for future in concurrent.futures.as_completed(futures):
+            idx, a3, admin, ns, filenames = futures[future]
+            partials, partial_decodes, partial_instruments, tiles = future.result()
+            merge_results(accs=accs, admin=admin, ns=ns, filenames=filenames,
+                    partials=partials)
+            if decodes is not None:
+                decodes.merge(partial_decodes)
+            if partial_instruments is not None:
+                instruments.merge(partial_instruments)
+            geoutil.tile_cache.merge(tiles)
+
+
+def result_filename(lookupobj, digest, idx, a3, admin):
+    """Return the result cache file for the area of lookupobj within one feature.
+
+       The name is a hash of digest, which is lookupobj.digest(), and of the contents of the
+       feature's mask, so a change to the lookup, its datasets or the mask gets a new file.
+    """
+    maskdigest = geoutil.file_digest(mask_filename(idx=idx, a3=a3, maskdim=lookupobj.maskdim))
+    key = hashlib.sha1(repr((digest, admin, maskdigest)).encode('utf-8')).hexdigest()
+    return os.path.join(results_cache_dirname, f"{key}.npy")
+
+
+def pending_features(lookupobjs, features, accs, cache):
+    """Return list of (idx, a3, admin, ns, filenames) of the lookups to run for each feature.
+
+       ns are indexes into lookupobjs. With cache, results already in the result cache are
+       added to accs[n] rather than being returned, and filenames are the cache files for the
+       rest. Without it, every lookup is returned for every feature and filenames are None.
+    """
+    if not cache:
+        ns = list(range(len(lookupobjs)))
+        return [(idx, a3, admin, ns, [None] * len(ns)) for idx, a3, admin in features]
+
+    digests = [lookupobj.digest() for lookupobj in lookupobjs]
+    pending = []
+    for idx, a3, admin in features:
+        ns = []
+        filenames = []
+        for n, lookupobj in enumerate(lookupobjs):
+            filename = result_filename(lookupobj=lookupobj, digest=digests[n], idx=idx, a3=a3,
+                    admin=admin)
+            if os.path.exists(filename):
+                accs[n].add(accs[n].row(admin), np.load(filename))
+            else:
+                ns.append(n)
+                filenames.append(filename)
+        if ns:
+            pending.append((idx, a3, admin, ns, filenames))
+    return pending
+
+
+def merge_results(accs, admin, ns, filenames, partials):
+    """Merge the results of one feature into accs, writing any result cache files."""
+    for n, filename, partial in zip(ns, filenames, partials):
+        if filename is not None:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            tmpfilename = filename + '.tmp'
+            with open(tmpfilename, 'wb') as f:
+                np.save(f, partial.data[partial.row(admin)])
+            os.replace(tmpfilename, filename)
+        accs[n].merge(partial)
+
+
+def process_maps(lookupobjs, csvfilenames, jobs=1, decodes=None,
+        instruments=instrument.disabled, cache=False):
+    """Produce a CSV file of areas per country for each of several datasets.
+
+       All of the datasets are processed in a single traversal of the country masks, see
+       process_feature(). With cache, the area of each dataset within each country is kept in
+       the result cache and only recomputed if the dataset, its lookup or the mask changes.
+       The hit ratio of geoutil.tile_cache over the run is printed and added to instruments.
+       Returns the list of DataFrames, in the same order as lookupobjs.
+    """
+    accs = [accumulator.Accumulator(columns=lookupobj.get_columns())
+            for lookupobj in lookupobjs]
+    features = feature_list()
+    envelopes = feature_envelopes()
+    pending = pending_features(lookupobjs=lookupobjs, features=features, accs=accs,
+            cache=cache)
+    instruments.count('results_cached', len(features) * len(lookupobjs) -
+            sum(len(ns) for _, _, _, ns, _ in pending))
+    tiles = geoutil.tile_cache.stats()
+    if jobs > 1:
+        process_features_parallel(lookupobjs=lookupobjs, features=pending, accs=accs,
+                jobs=jobs, decodes=decodes, instruments=instruments, envelopes=envelopes)
+    else:
+        for idx, a3, admin, ns, filenames in pending:
+            partials = [accumulator.Accumulator(columns=lookupobjs[n].get_columns())
+                        for n in ns]
+            process_feature(lookupobjs=[lookupobjs[n] for n in ns], idx=idx, a3=a3,
+                    admin=admin, accs=partials, decodes=decodes, instruments=instruments,
+                    envelopes=envelopes.get(idx))
+            merge_results(accs=accs, admin=admin, ns=ns, filenames=filenames,
+                    partials=partials)
+    tiles = geoutil.tile_cache.stats(since=tiles)
+    geoutil.tile_cache.report(tiles)
+    for name, n in tiles.items():
+        instruments.count(f'tile_cache_{name}', n)
+
+    dfs = []
+    for acc, csvfilename in zip(accs, csvfilenames):
+        df = acc.to_dataframe()
+        outputfilename = os.path.join('results', csvfilename)
+        df.sort_index(axis='index').to_csv(outputfilename, float_format='%.2f')
+        dfs.append(df)
+    return dfs
+
+
+def process_map(lookupobj, csvfilename, labels=False, jobs=1, decodes=None,
+        instruments=instrument.disabled, cache=False, block_major=False):
+    """Produce a CSV file of areas per country from a dataset.
+
+       With labels=True the single feature ID raster is used instead of the per-country masks,
+       with block_major=True the dataset is read once for all of the per-country masks, see
+       process_map_blocks(), and with jobs > 1 countries are processed in that many worker
+       processes. jobs and cache apply to the per-country traversal only, see process_maps(),
+       so they cannot be combined with labels or block_major, nor can those two be combined.
+    """
+    if labels and block_major:
+        raise ValueError("labels cannot be combined with block_major")
+    if (labels or block_major) and (jobs > 1 or cache):
+        raise ValueError("jobs and cache cannot be combined with labels or block_major")
+    if labels:
+        return process_map_labels(lookupobj=lookupobj, csvfilename=csvfilename,
+                decodes=decodes, instruments=instruments)
+    if block_major:
+        return process_map_blocks(lookupobj=lookupobj, csvfilename=csvfilename,
+                decodes=decodes, instruments=instruments)
+    return process_maps(lookupobjs=[lookupobj], csvfilenames=[csvfilename], jobs=jobs,
+            decodes=decodes, instruments=instruments, cache=cache)[0]
+
+
+def lc_filename(year):
+    """Return the filename of the ESA CCI (up to 2015) or C3S (from 2016) land cover map."""
+    if year <= 2015:
+        return f"data/copernicus/ESACCI-LC-L4-LCCS-Map-300m-P1Y-{year}-v2.0.7.tif"
+    return f"data/copernicus/C3S-LC-L4-LCCS-Map-300m-P1Y-{year}-v2.1.1.tif"
+
+
+def long_format(years, dfs):
+    """Return a DataFrame of (Country, Year, LCCS, km2) rows from a DataFrame per year."""
+    frames = []
+    for year, df in zip(years, dfs):
+        frame = df.rename_axis(columns='LCCS').stack().rename('km2').reset_index()
+        frame.insert(1, 'Year', year)
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True).sort_values(
+            ['Country', 'Year', 'LCCS'], kind='stable').reset_index(drop=True)
+
+
+def process_lc_years(years, jobs=1, decodes=None, instruments=instrument.disabled,
+        cache=False):
+    """Produce a CSV file of land cover per country for each of years, and one of all years.
+
+       The maps of every year are applied to each mask block and pixel area block as it is
+       read, see process_maps(), so the masks are traversed once however many years there are.
+       Returns the long format DataFrame, see long_format().
+    """
+    lookupobjs = [ESA_LC_lookup(lc_filename(year)) for year in years]
+    csvfilenames = [f"Land-Cover-by-country-{year}.csv" for year in years]
+    dfs = process_maps(lookupobjs=lookupobjs, csvfilenames=csvfilenames, jobs=jobs,
+            decodes=decodes, instruments=instruments, cache=cache)
+    df = long_format(years=years, dfs=dfs)
+    df.to_csv('results/Land-Cover-by-country-years.csv', index=False, float_format='%.2f')
+    return df
+
+
+def read_feature_ids():
+    """Return dict of feature ID to Drawdown country name, from the feature ID table."""
+    table = pd.read_csv(geoutil.feature_id_table_filename, keep_default_na=False)
+    return {int(fid): country for fid, country in zip(table['FeatureID'], table['Country'])
+            if country}
+
+
+def process_map_labels(lookupobj, csvfilename, decodes=None, instruments=instrument.disabled):
+    """Produce a CSV file of areas per country from a dataset, using the feature ID raster.
+
+       Rather than sweeping the dataset once per country mask, sweep it once and accumulate
+       the area of each class for every feature ID at the same time.
+    """
+    feature_ids = read_feature_ids()
+    nlabels = max(feature_ids.keys()) + 1
+    acc = accumulator.Accumulator(columns=lookupobj.get_columns())
+    km2 = np.zeros((nlabels, len(acc.columns)))
+
+    labelfilename = geoutil.feature_id_filename(lookupobj.maskdim)
+    print(f"Processing {labelfilename}")
+    labelimg = osgeo.gdal.Open(labelfilename, osgeo.gdal.GA_ReadOnly)
+    labelband = instruments.band(geoutil.PooledBand(labelimg.GetRasterBand(1)))
+    inputs = [(band, 1) for band in lookupobj.bands()]
+    x_winsiz, y_winsiz = geoutil.plan_window(inputs=[(labelband, 1)] + inputs,
+            x_siz=labelband.XSize, y_siz=labelband.YSize)
+    pixel_bytes = sum(osgeo.gdal.GetDataTypeSize(band.DataType) // 8 for band, _ in inputs)
+    with instruments.stage('populated'):
+        windows = geoutil.populated_windows(labelfilename, labelband, x_winsiz=x_winsiz,
+                y_winsiz=y_winsiz)
+    instruments.count('blocks', len(windows))
+    instruments.count('blocks_skipped', math.ceil(labelband.XSize / x_winsiz) *
+            math.ceil(labelband.YSize / y_winsiz) - len(windows))
+    allocations = geoutil.buffer_pool.allocations
+    with instruments.profile():
+        for x, y, ncols, nrows, full in windows:
+            if decodes is not None:
+                decodes.add(inputs=inputs, x=x, y=y, ncols=ncols, nrows=nrows)
+            with instruments.stage('km2'):
+                labelblock = labelband.ReadAsArray(x, y, ncols, nrows)
+                km2block = geoutil.km2_block(nrows=nrows, ncols=ncols, y_off=y, img=labelimg)
+            with instruments.stage(type(lookupobj).__name__):
+                km2 += lookupobj.km2_by_label(x=x, y=y, ncols=ncols, nrows=nrows,
+                        labelblock=labelblock, km2block=km2block, nlabels=nlabels)
+            instruments.count('bytes_read', pixel_bytes * ncols * nrows)
+    instruments.count('buffer_allocations', geoutil.buffer_pool.allocations - allocations)
+
+    for fid, admin in feature_ids.items():
+        acc.add(acc.row(admin), km2[fid])
+    df = acc.to_dataframe()
+    outputfilename = os.path.join('results', csvfilename)
+    df.sort_index(axis='index').to_csv(outputfilename, float_format='%.2f')
+    return df
+
+
+def process_map_blocks(lookupobj, csvfilename, decodes=None, instruments=instrument.disabled):
+    """Produce a CSV file of areas per country from a dataset, reading each block of it once.
+
+       Rather than traversing the dataset once per country mask, traverse it once and reduce
+       each block for the masks of every country populated within it. The per-country masks
+       are used as they are, so unlike process_map_labels() overlapping features are each
+       counted in full.
+    """
+    acc = accumulator.Accumulator(columns=lookupobj.get_columns())
+    envelopes = feature_envelopes()
+    masks = {}
+    maskimgs = []
+    for idx, a3, admin in feature_list():
+        maskfilename = mask_filename(idx=idx, a3=a3, maskdim=lookupobj.maskdim)
         maskimg = osgeo.gdal.Open(maskfilename, osgeo.gdal.GA_ReadOnly)
-        maskband = maskimg.GetRasterBand(1)
-        x_siz = maskband.XSize
-        y_siz = maskband.YSize
-        x_blksiz, y_blksiz = maskband.GetBlockSize()
-        for y in range(0, y_siz, y_blksiz):
-            nrows = geoutil.blklim(coord=y, blksiz=y_blksiz, totsiz=y_siz)
-            for x in range(0, x_siz, x_blksiz):
-                ncols = geoutil.blklim(coord=x, blksiz=x_blksiz, totsiz=x_siz)
-                if geoutil.is_sparse(band=maskband, x=x, y=y, ncols=ncols, nrows=nrows):
-                    # sparse hole in image, no data to process
-                    continue
-
-                maskblock = maskband.ReadAsArray(x, y, ncols, nrows)
-                km2block = geoutil.km2_block(nrows=nrows, ncols=ncols, y_off=y, img=maskimg)
-                lookupobj.km2(x=x, y=y, ncols=ncols, nrows=nrows, maskblock=maskblock,
-                              km2block=km2block, df=df, admin=admin)
+        maskimgs.append(maskimg)
+        masks[(idx, admin)] = (maskfilename, instruments.band(maskimg.GetRasterBand(1)),
+                envelopes.get(idx))
+    rows = {key: acc.row(key[1]) for key in masks}
+
+    print(f"Processing {len(masks)} {lookupobj.maskdim} masks")
+    maskfilename, maskband, _ = next(iter(masks.values()))
+    maskimg = maskimgs[0]
+    inputs = [(band, 1) for band in lookupobj.bands()]
+    x_winsiz, y_winsiz = geoutil.plan_window(inputs=[(maskband, 1)] + inputs,
+            x_siz=maskband.XSize, y_siz=maskband.YSize)
+    pixel_bytes = sum(osgeo.gdal.GetDataTypeSize(band.DataType) // 8 for band, _ in inputs)
+    with instruments.stage('populated'):
+        windows = geoutil.shared_windows(masks=masks, x_winsiz=x_winsiz, y_winsiz=y_winsiz)
+    instruments.count('blocks', len(windows))
+    instruments.count('blocks_skipped', math.ceil(maskband.XSize / x_winsiz) *
+            math.ceil(maskband.YSize / y_winsiz) - len(windows))
+    allocations = geoutil.buffer_pool.allocations
+    with instruments.profile():
+        for x, y, ncols, nrows, members in windows:
+            if decodes is not None:
+                decodes.add(inputs=inputs, x=x, y=y, ncols=ncols, nrows=nrows)
+            with instruments.stage(type(lookupobj).__name__):
+                block = lookupobj.read(x=x, y=y, ncols=ncols, nrows=nrows)
+            instruments.count('bytes_read', pixel_bytes * ncols * nrows)
+            km2block = geoutil.km2_block(nrows=nrows, ncols=ncols, y_off=y, img=maskimg)
+            out = geoutil.buffer_pool.scratch('mask', (nrows, ncols), np.uint8)
+            for key, full in members:
+                with instruments.stage('km2'):
+                    maskblock = geoutil.read_mask_block(band=masks[key][1], x=x, y=y,
+                            ncols=ncols, nrows=nrows, full=full, out=out)
+                with instruments.stage(type(lookupobj).__name__):
+                    km2 = lookupobj.reduce(block=block, labelblock=(maskblock != 0),
+                            km2block=km2block, nlabels=2)
+                acc.add(rows[key], km2[1])
+            instruments.count('masks_applied', len(members))
+    instruments.count('buffer_allocations', geoutil.buffer_pool.allocations - allocations)
+
+    df = acc.to_dataframe()
     outputfilename = os.path.join('results', csvfilename)
     df.sort_index(axis='index').to_csv(outputfilename, float_format='%.2f')
     return df
@@ -265,11 +824,15 @@ def output_by_region(df, csvfilename):
 
 if __name__ == '__main__':
     signal.signal(signal.SIGUSR1, start_pdb)
+    # GDAL may have read GDAL_CACHEMAX already, the environment is for worker processes.
     os.environ['GDAL_CACHEMAX'] = '128'
+    osgeo.gdal.SetCacheMax(128 * 1024 * 1024)
 
     parser = argparse.ArgumentParser(description='Process GeoTIFF datasets for Project Drawdown')
     parser.add_argument('--lc', default=False, required=False,
                         action='store_true', help='process land cover')
+    parser.add_argument('--lc-years', default=None, required=False, type=int, nargs='+',
+                        help='process land cover for each of these years in one pass')
     parser.add_argument('--kg', default=False, required=False,
                         action='store_true', help='process Köppen-Geiger')
     parser.add_argument('--sl', default=False, required=False,
@@ -280,73 +843,107 @@ if __name__ == '__main__':
                         action='store_true', help='process degraded land')
     parser.add_argument('--all', default=False, required=False,
                         action='store_true', help='process all')
+    parser.add_argument('--labels', default=False, required=False,
+                        action='store_true', help='use feature ID rasters instead of masks')
+    parser.add_argument('--jobs', default=1, required=False, type=int,
+                        help='number of worker processes to use')
+    parser.add_argument('--fused', default=False, required=False,
+                        action='store_true', help='process all datasets in one pass')
+    parser.add_argument('--block-major', default=False, required=False,
+                        action='store_true', help='read each block of a dataset once for all '
+                        'of the countries within it, rather than once per country')
+    parser.add_argument('--window-budget', default=None, required=False, type=int,
+                        help='MiB of input data to read per processing window')
+    parser.add_argument('--tile-cache', default=None, required=False, type=int,
+                        help='MiB of decoded input tiles to keep across countries, 0 to disable')
+    parser.add_argument('--decode-report', default=False, required=False,
+                        action='store_true', help='report decompressions per input tile')
+    parser.add_argument('--instrument', default=None, required=False,
+                        help='write stage timings and block counts to this JSON or .csv file')
+    parser.add_argument('--profile', default=None, required=False,
+                        help='write cProfile statistics of the block loops to this file, '
+                        'worker processes are not profiled')
+    parser.add_argument('--result-cache', default=False, required=False,
+                        action='store_true', help='reuse unchanged results per country from '
+                        + results_cache_dirname + ' rather than recomputing every country')
     args = parser.parse_args()
-    processed = False
-
+    if args.labels and args.block_major:
+        parser.error('--labels cannot be combined with --block-major')
+    if (args.labels or args.block_major) and (args.jobs > 1 or args.fused or args.result_cache):
+        parser.error('--jobs, --fused and --result-cache cannot be combined with --labels '
+                     'or --block-major')
+
+    if args.window_budget is not None:
+        geoutil.window_budget = args.window_budget * 1024 * 1024
+    if args.tile_cache is not None:
+        geoutil.tile_cache.budget = args.tile_cache * 1024 * 1024
+    decodes = geoutil.TileDecodes() if args.decode_report else None
+    instruments = instrument.disabled
+    if args.instrument or args.profile:
+        instruments = instrument.Instruments(profile=bool(args.profile))
+
+    datasets = []
     if args.lc or args.all:
         mapfilename = 'data/copernicus/C3S-LC-L4-LCCS-Map-300m-P1Y-2018-v2.1.1.tif'
-        countrycsv = 'Land-Cover-by-country.csv'
-        regioncsv = 'Land-Cover-by-region.csv'
-        lookupobj = ESA_LC_lookup(mapfilename)
-        df = process_map(lookupobj=lookupobj, csvfilename=countrycsv)
-        output_by_region(df=df, csvfilename=regioncsv)
-        print('\n')
-        processed = True
+        datasets.append((mapfilename, ESA_LC_lookup(mapfilename),
+            'Land-Cover-by-country.csv', 'Land-Cover-by-region.csv'))
 
     if args.kg or args.all:
         mapfilename = 'data/Beck_KG_V1/Beck_KG_V1_present_0p0083.tif'
-        countrycsv = 'Köppen-Geiger-present-by-country.csv'
-        regioncsv = 'Köppen-Geiger-present-by-region.csv'
-        print(mapfilename)
-        lookupobj = KGlookup(mapfilename)
-        df = process_map(lookupobj=lookupobj, csvfilename=countrycsv)
-        output_by_region(df=df, csvfilename=regioncsv)
-        print('\n')
-
+        datasets.append((mapfilename, KGlookup(mapfilename),
+            'Köppen-Geiger-present-by-country.csv', 'Köppen-Geiger-present-by-region.csv'))
         mapfilename = 'data/Beck_KG_V1/Beck_KG_V1_future_0p0083.tif'
-        countrycsv = 'Köppen-Geiger-future-by-country.csv'
-        regioncsv = 'Köppen-Geiger-future-by-region.csv'
-        print(mapfilename)
-        lookupobj = KGlookup(mapfilename)
-        df = process_map(lookupobj=lookupobj, csvfilename=countrycsv)
-        output_by_region(df=df, csvfilename=regioncsv)
-        print('\n')
-        processed = True
+        datasets.append((mapfilename, KGlookup(mapfilename),
+            'Köppen-Geiger-future-by-country.csv', 'Köppen-Geiger-future-by-region.csv'))
 
     if args.sl or args.all:
         mapfilename = 'data/geomorpho90m/classified_slope_merit_dem_1km_s0..0cm_2018_v1.0.tif'
-        countrycsv = 'Slope-by-country.csv'
-        regioncsv = 'Slope-by-region.csv'
-        print(mapfilename)
-        lookupobj = GeomorphoLookup(mapfilename=mapfilename)
-        df = process_map(lookupobj=lookupobj, csvfilename=countrycsv)
-        output_by_region(df=df, csvfilename=regioncsv)
-        print('\n')
-        processed = True
-
-        countrycsv = 'FAO-Slope-by-country.csv'
-        regioncsv = 'FAO-Slope-by-region.csv'
-        print('data/FAO/GloSlopesCl*_30as.tif')
-        lookupobj = FaoSlopeLookup()
-        df = process_map(lookupobj=lookupobj, csvfilename=countrycsv)
-        output_by_region(df=df, csvfilename=regioncsv)
-        print('\n')
-        processed = True
+        datasets.append((mapfilename, GeomorphoLookup(mapfilename=mapfilename),
+            'Slope-by-country.csv', 'Slope-by-region.csv'))
+        datasets.append(('data/FAO/GloSlopesCl*_30as.tif', FaoSlopeLookup(),
+            'FAO-Slope-by-country.csv', 'FAO-Slope-by-region.csv'))
 
     if args.wk or args.all:
         mapfilename = 'data/FAO/workability_FAO_sq7_1km.tif'
-        countrycsv = 'Workability-by-country.csv'
-        regioncsv = 'Workability-by-region.csv'
-        print(mapfilename)
-        lookupobj = WorkabilityLookup(mapfilename)
-        df = process_map(lookupobj=lookupobj, csvfilename=countrycsv)
-        output_by_region(df=df, csvfilename=regioncsv)
+        datasets.append((mapfilename, WorkabilityLookup(mapfilename),
+            'Workability-by-country.csv', 'Workability-by-region.csv'))
+
+    processed = bool(datasets) or bool(args.lc_years)
+    if args.lc_years:
+        print(f"Land cover {' '.join(str(year) for year in args.lc_years)}")
+        process_lc_years(years=args.lc_years, jobs=args.jobs, decodes=decodes,
+                instruments=instruments.section('lc-years'), cache=args.result_cache)
+        print('\n')
+    if args.fused and datasets:
+        for mapfilename, _, _, _ in datasets:
+            print(mapfilename)
+        dfs = process_maps(lookupobjs=[d[1] for d in datasets],
+                csvfilenames=[d[2] for d in datasets], jobs=args.jobs, decodes=decodes,
+                instruments=instruments.section('fused'), cache=args.result_cache)
+        for df, (_, _, _, regioncsv) in zip(dfs, datasets):
+            output_by_region(df=df, csvfilename=regioncsv)
         print('\n')
-        processed = True
+    else:
+        for mapfilename, lookupobj, countrycsv, regioncsv in datasets:
+            print(mapfilename)
+            df = process_map(lookupobj=lookupobj, csvfilename=countrycsv, labels=args.labels,
+                             jobs=args.jobs, decodes=decodes,
+                             instruments=instruments.section(mapfilename),
+                             cache=args.result_cache, block_major=args.block_major)
+            output_by_region(df=df, csvfilename=regioncsv)
+            print('\n')
+
+    if decodes is not None and processed:
+        decodes.report()
+    if args.instrument and processed:
+        instruments.write(args.instrument)
+    if args.profile and processed:
+        instruments.write_profile(args.profile)
 
     if not processed:
         print('Select one of:')
         print('\t-lc  : Land Cover')
+        print('\t-lc-years YYYY ... : Land Cover for several years')
         print('\t-kg  : Köppen-Geiger')
         print('\t-sl  : Slope')
         print('\t-wk  : Workability')
@@ -3,28 +3,208 @@
 
 """Geo-related utilities for Project Drawdown data pipelines."""
 
+import collections
+import fractions
+import functools
+import hashlib
+import itertools
 import math
+import json
+import os.path
+import threading
+
 import numpy as np
 import osgeo.gdal
+import osgeo.gdal_array
+import osgeo.ogr
 
-def km2_block(nrows, ncols, y_off, img):
-    """Return (nrows,ncols) numpy array of pixel area in sq km."""
-    x_mindeg, x_sizdeg, x_rot, y_mindeg, y_rotdeg, y_sizdeg = img.GetGeoTransform()
+
+# Directory holding the per-grid pixel area tables written by write_km2_table().
+km2_dirname = 'cache/km2'
+_km2_tables = {}
+
+# Table mapping the values in the feature ID rasters to country names.
+feature_id_table_filename = 'masks/feature_ids.csv'
+
+# Bytes of input data plan_window() allows per processing window.
+window_budget = 64 * 1024 * 1024
+
+# Table of the content digests of input files, see file_digest().
+digests_filename = 'cache/digests.json'
+_digests = None
+
+# Directory holding the uncompressed copies of input rasters written by write_input_cache().
+input_cache_dirname = 'cache/inputs'
+_input_caches = {}
+
+def km2_table_filename(geotransform, dirname=None):
+    """Return the name of the pixel area table for an image with the given geotransform."""
+    if dirname is None:
+        dirname = km2_dirname
+    key = hashlib.sha1(repr(tuple(geotransform)).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(dirname, f'km2_{key}.npy')
+
+
+def write_km2_table(img, dirname=None):
+    """Write a 1-D table of pixel area in sq km for every row of img to a .npy file.
+
+       The table is keyed by the geotransform, so every image on the same grid (all of the
+       1km masks, say) shares it. Returns the filename written.
+    """
+    geotransform = tuple(img.GetGeoTransform())
+    filename = km2_table_filename(geotransform, dirname=dirname)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    np.save(filename, _km2_compute(geotransform, 0, img.RasterYSize))
+    _km2_tables.pop(geotransform, None)
+    return filename
+
+
+def km2_table(geotransform):
+    """Return the memory-mapped pixel area table for geotransform, or None if not built."""
+    geotransform = tuple(geotransform)
+    if geotransform not in _km2_tables:
+        filename = km2_table_filename(geotransform)
+        if os.path.exists(filename):
+            _km2_tables[geotransform] = np.load(filename, mmap_mode='r')
+        else:
+            _km2_tables[geotransform] = None
+    return _km2_tables[geotransform]
+
+
+def input_cache_filename(img, dirname=None):
+    """Return the name of the uncompressed copy of img, keyed by the files img reads."""
+    if dirname is None:
+        dirname = input_cache_dirname
+    files = [os.path.abspath(f) for f in (img.GetFileList() or [])]
+    key = hashlib.sha1(repr(files).encode('utf-8')).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(files[0]))[0] if files else 'mem'
+    return os.path.join(dirname, f'{name}_{key}.npy')
+
+
+def input_cache_metadata_filename(filename):
+    """Return the name of the metadata of an input cache, cache/inputs/X.npy -> X.json"""
+    return os.path.splitext(filename)[0] + '.json'
+
+
+def _file_stamps(filenames):
+    """Return list of [size, mtime_ns] of each of filenames."""
+    stamps = []
+    for filename in filenames:
+        st = os.stat(filename)
+        stamps.append([st.st_size, st.st_mtime_ns])
+    return stamps
+
+
+def write_input_cache(img, dirname=None):
+    """Write every band of img uncompressed to a .npy file of (nbands, nrows, ncols).
+
+       The .npy is memory-mapped by input_cache() in place of decompressing img again, and
+       its .json records the size and modification time of every file img reads, along with
+       the geotransform and block size. Returns the filename written.
+    """
+    files = [os.path.abspath(f) for f in (img.GetFileList() or [])]
+    filename = input_cache_filename(img, dirname=dirname)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    first = img.GetRasterBand(1)
+    dtype = np.dtype(osgeo.gdal_array.GDALTypeCodeToNumericTypeCode(first.DataType))
+    x_siz, y_siz = img.RasterXSize, img.RasterYSize
+    shape = (img.RasterCount, y_siz, x_siz)
+    tmpfilename = filename + '.tmp'
+    out = np.lib.format.open_memmap(tmpfilename, mode='w+', dtype=dtype, shape=shape)
+    # whole rows of native blocks, within the window budget.
+    y_blksiz = first.GetBlockSize()[1]
+    strip = max(1, window_budget // (img.RasterCount * x_siz * dtype.itemsize * y_blksiz))
+    for y in range(0, y_siz, strip * y_blksiz):
+        nrows = min(strip * y_blksiz, y_siz - y)
+        buf = out[:, y:y + nrows] if img.RasterCount > 1 else out[0, y:y + nrows]
+        img.ReadAsArray(0, y, x_siz, nrows, buf_obj=buf)
+    out.flush()
+    del out
+    os.replace(tmpfilename, filename)
+
+    metadata = {'files': files, 'stamps': _file_stamps(files), 'shape': list(shape),
+            'dtype': dtype.str, 'geotransform': list(img.GetGeoTransform()),
+            'blocksize': list(first.GetBlockSize())}
+    with open(input_cache_metadata_filename(filename), 'w') as f:
+        json.dump(metadata, f)
+    _input_caches.pop(filename, None)
+    return filename
+
+
+def input_cache(img):
+    """Return the memory-mapped (nbands, nrows, ncols) copy of img, or None.
+
+       None if write_input_cache() has not been run for img, or if any file img reads has
+       changed size or modification time since.
+    """
+    files = img.GetFileList() or []
+    if not files:
+        return None
+    filename = input_cache_filename(img)
+    if filename not in _input_caches:
+        _input_caches[filename] = None
+        try:
+            with open(input_cache_metadata_filename(filename), 'r') as f:
+                metadata = json.load(f)
+            if metadata['stamps'] != _file_stamps(metadata['files']):
+                print(f"{filename} is out of date, reading {files[0]} instead")
+            else:
+                _input_caches[filename] = np.load(filename, mmap_mode='r')
+        except (OSError, ValueError, KeyError):
+            pass
+    mapped = _input_caches[filename]
+    if mapped is None or mapped.shape != (img.RasterCount, img.RasterYSize, img.RasterXSize):
+        return None
+    return mapped
+
+
+def _km2_compute(geotransform, y_off, nrows):
+    """Return 1-D numpy array of pixel area in sq km for nrows rows starting at y_off."""
+    x_mindeg, x_sizdeg, x_rot, y_mindeg, y_rotdeg, y_sizdeg = geotransform
     yrad = math.radians(abs(y_sizdeg))
-    km2 = np.empty((nrows, ncols))
-    y = math.radians(y_mindeg + (y_off * y_sizdeg)) - (yrad / 2)
-    for i in range(nrows):
-        # https://en.wikipedia.org/wiki/Longitude#Length_of_a_degree_of_longitude
-        xlen = abs(x_sizdeg) * (math.cos(y) * math.pi * 6378.137 /
-                (180 * math.sqrt(1 - 0.00669437999014 * (math.sin(y) ** 2))))
-        # https://en.wikipedia.org/wiki/Latitude#Length_of_a_degree_of_latitude
-        ylen = abs(y_sizdeg) * (111.132954 - (0.559822 * math.cos(2 * y)) +
-                (0.001175 * math.cos(4 * y)))
-        km2[i, :] = xlen * ylen
-        y -= yrad
+    y = (math.radians(y_mindeg + (y_off * y_sizdeg)) - (yrad / 2)) - (yrad * np.arange(nrows))
+    # https://en.wikipedia.org/wiki/Longitude#Length_of_a_degree_of_longitude
+    xlen = abs(x_sizdeg) * (np.cos(y) * math.pi * 6378.137 /
+            (180 * np.sqrt(1 - 0.00669437999014 * (np.sin(y) ** 2))))
+    # https://en.wikipedia.org/wiki/Latitude#Length_of_a_degree_of_latitude
+    ylen = abs(y_sizdeg) * (111.132954 - (0.559822 * np.cos(2 * y)) +
+            (0.001175 * np.cos(4 * y)))
+    return xlen * ylen
+
+
+@functools.lru_cache(maxsize=4096)
+def _km2_rows_cached(geotransform, y_off, nrows):
+    km2 = _km2_compute(geotransform, y_off, nrows)
+    km2.flags.writeable = False
     return km2
 
 
+def km2_rows(geotransform, y_off, nrows):
+    """Return 1-D numpy array of pixel area in sq km for nrows rows starting at y_off.
+
+       Pixel area only varies by latitude, so one value per row is all that is needed. If a
+       table for this grid was written by write_km2_table() the result is a zero-copy slice of
+       it, otherwise the rows are computed and memoized per (geotransform, y_off, nrows).
+       Either way the result is shared and read-only.
+    """
+    geotransform = tuple(geotransform)
+    y_off = int(y_off)
+    table = km2_table(geotransform)
+    if table is not None and y_off + nrows <= table.shape[0]:
+        return table[y_off:y_off + nrows]
+    return _km2_rows_cached(geotransform, y_off, nrows)
+
+
+def km2_block(nrows, ncols, y_off, img):
+    """Return (nrows,ncols) numpy array of pixel area in sq km.
+
+       The result is a read-only broadcast view of the per-row areas from km2_rows, callers
+       which need to modify it should use np.where() or make a copy.
+    """
+    rows = km2_rows(tuple(img.GetGeoTransform()), y_off, nrows)
+    return np.broadcast_to(rows[:, np.newaxis], (nrows, ncols))
+
+
 def is_sparse(band, x, y, ncols, nrows):
     """Return True if the given coordinates are a sparse hole in the image."""
     (flags, pct) = band.GetDataCoverageStatus(x, y, ncols, nrows)
@@ -38,3 +218,681 @@ def blklim(coord, blksiz, totsiz):
         return blksiz
     else:
         return totsiz - coord
+
+
+def band_name(band):
+    """Return a name for band in reports: the filename, plus the band number if not band 1."""
+    name = band.GetDataset().GetDescription()
+    if band.GetBand() != 1:
+        name += f" band {band.GetBand()}"
+    return name
+
+
+def tile_size(band, ratio=1):
+    """Return (x, y) size of the native blocks of band as Fractions, in working grid pixels.
+
+       ratio is the number of working grid pixels per pixel of band: 3 for a 1km band processed
+       on the 333m grid, Fraction(1, 3) for a 333m band processed on the 1km grid.
+    """
+    x_blksiz, y_blksiz = band.GetBlockSize()
+    ratio = fractions.Fraction(ratio)
+    return (x_blksiz * ratio, y_blksiz * ratio)
+
+
+def _lcm_int(a, b):
+    """Return the least common multiple of integers a and b, math.lcm is Python 3.9+."""
+    return a * b // math.gcd(a, b)
+
+
+def _lcm(values):
+    """Return the smallest integer which is a multiple of every Fraction in values."""
+    result = fractions.Fraction(1)
+    for value in values:
+        value = fractions.Fraction(value)
+        result = fractions.Fraction(
+                _lcm_int(result.numerator * value.denominator,
+                         value.numerator * result.denominator),
+                result.denominator * value.denominator)
+    return int(result)
+
+
+def plan_window(inputs, x_siz, y_siz, budget=None):
+    """Return (x_winsiz, y_winsiz) of processing windows aligned to the tiles of every input.
+
+       inputs is a list of (band, ratio), see tile_size(). The window is the least common
+       multiple of the tile sizes of all inputs, so no native tile is decompressed by more than
+       one window. If that needs more than budget bytes of input data per window, the window is
+       reduced to a multiple of the tiles of inputs[0], giving up alignment with the others.
+       Windows are always a whole number of pixels of every input.
+    """
+    if budget is None:
+        budget = window_budget
+    tiles = [tile_size(band=band, ratio=ratio) for band, ratio in inputs]
+    ratios = [fractions.Fraction(ratio) for band, ratio in inputs]
+    bytes_per_pixel = 0.0
+    for band, ratio in inputs:
+        bytes_per_pixel += osgeo.gdal.GetDataTypeSize(band.DataType) / 8 / float(ratio) ** 2
+
+    x_winsiz = min(_lcm([t[0] for t in tiles]), x_siz)
+    y_winsiz = min(_lcm([t[1] for t in tiles]), y_siz)
+    if x_winsiz * y_winsiz * bytes_per_pixel <= budget:
+        return (x_winsiz, y_winsiz)
+
+    x_step = _lcm([tiles[0][0]] + ratios)
+    y_step = _lcm([tiles[0][1]] + ratios)
+    x_winsiz = min(_lcm([x_winsiz, x_step]), x_siz)
+    rows = int(budget // (x_winsiz * bytes_per_pixel))
+    y_winsiz = min(max(y_step, rows // y_step * y_step), y_siz)
+    if x_winsiz * y_winsiz * bytes_per_pixel > budget:
+        cols = int(budget // (y_winsiz * bytes_per_pixel))
+        x_winsiz = min(max(x_step, cols // x_step * x_step), x_siz)
+    return (x_winsiz, y_winsiz)
+
+
+def windows(x_siz, y_siz, x_winsiz, y_winsiz):
+    """Return list of (x, y, ncols, nrows) windows covering an image, row by row."""
+    result = []
+    for y in range(0, y_siz, y_winsiz):
+        nrows = blklim(coord=y, blksiz=y_winsiz, totsiz=y_siz)
+        for x in range(0, x_siz, x_winsiz):
+            ncols = blklim(coord=x, blksiz=x_winsiz, totsiz=x_siz)
+            result.append((x, y, ncols, nrows))
+    return result
+
+
+class TileDecodes:
+    """Count how many times each native tile of each input is decompressed by a run.
+
+       Reading a window decompresses every tile it touches, so a tile touched by several
+       windows is decompressed several times unless it is still in GDAL's block cache.
+    """
+    def __init__(self):
+        self.counts = {}
+
+    def add(self, inputs, x, y, ncols, nrows):
+        """Count the tiles of each (band, ratio) in inputs read by one window."""
+        for band, ratio in inputs:
+            x_tilesiz, y_tilesiz = tile_size(band=band, ratio=ratio)
+            counts = self.counts.setdefault(band_name(band), {})
+            for ty in range(y // y_tilesiz, math.ceil((y + nrows) / y_tilesiz)):
+                for tx in range(x // x_tilesiz, math.ceil((x + ncols) / x_tilesiz)):
+                    counts[(tx, ty)] = counts.get((tx, ty), 0) + 1
+
+    def merge(self, other):
+        """Add the counts of another TileDecodes into this one."""
+        for name, other_counts in other.counts.items():
+            counts = self.counts.setdefault(name, {})
+            for tile, n in other_counts.items():
+                counts[tile] = counts.get(tile, 0) + n
+
+    def report(self):
+        """Print the decompressions per tile of each input."""
+        for name, counts in sorted(self.counts.items()):
+            tiles = len(counts)
+            decodes = sum(counts.values())
+            print(f"{name}: {decodes} decompressions of {tiles} tiles, "
+                  f"{decodes / tiles:.2f} per tile, at most {max(counts.values())}")
+
+
+def feature_id_filename(maskdim):
+    """Return the name of the raster of feature IDs at the given mask resolution."""
+    return f'masks/feature_ids_{maskdim}.tif'
+
+
+def km2_by_label(labels, classes, km2block, nlabels, nclasses):
+    """Return (nlabels, nclasses) numpy array of the area of each class within each label.
+
+       labels and classes hold a label and a column index for every pixel. Pixels with a class
+       of nclasses or more are not counted, which is how lookups discard nodata values. The
+       bincount index and weights are built in scratch arrays of buffer_pool.
+    """
+    idx = buffer_pool.scratch('label_index', labels.shape, np.intp)
+    np.multiply(labels, nclasses + 1, out=idx, casting='unsafe')
+    clipped = buffer_pool.scratch('label_classes', classes.shape, classes.dtype)
+    np.minimum(classes, nclasses, out=clipped)
+    np.add(idx, clipped, out=idx, casting='unsafe')
+    weights = buffer_pool.scratch('label_weights', labels.shape, np.float64)
+    np.copyto(weights, km2block)
+    sums = np.bincount(idx.ravel(), weights=weights.ravel(), minlength=nlabels * (nclasses + 1))
+    return sums.reshape(nlabels, nclasses + 1)[:, :nclasses]
+
+
+def lookup_block(lut, block):
+    """Return lut[block] in a scratch array of buffer_pool, for a 256 entry lut.
+
+       Values outside 0..255 are clipped to the first or last entry of lut.
+    """
+    out = buffer_pool.scratch('lookup_block', block.shape, lut.dtype)
+    return np.take(lut, block, out=out, mode='clip')
+
+
+def km2_by_label_percent(labels, percents, km2block, nlabels):
+    """Return (nlabels, nclasses) numpy array of the area of each class within each label.
+
+       percents is an (nclasses, nrows, ncols) array of the percentage of every pixel in each
+       class. All classes are reduced in one bincount of label and class, weighted by the pixel
+       areas times the percentages, with the index and weights in scratch arrays of buffer_pool.
+    """
+    nclasses = percents.shape[0]
+    percents = percents.reshape(nclasses, -1)
+    idx = buffer_pool.scratch('percent_index', percents.shape, np.intp)
+    np.multiply(labels.reshape(1, -1), nclasses, out=idx, casting='unsafe')
+    np.add(idx, np.arange(nclasses).reshape(nclasses, 1), out=idx)
+    weights = buffer_pool.scratch('percent_weights', percents.shape, np.float64)
+    np.multiply(percents, np.broadcast_to(km2block, labels.shape).reshape(1, -1), out=weights)
+    sums = np.bincount(idx.ravel(), weights=weights.ravel(), minlength=nlabels * nclasses)
+    return sums[:nlabels * nclasses].reshape(nlabels, nclasses) / 100.0
+
+
+class BufferPool:
+    """Reusable numpy arrays for block reads and per-block results.
+
+       take() hands out an array of the given shape and dtype, allocating one only if none of
+       that kind has been given back with give(). scratch() returns an array which stays with
+       the calling thread under a name, for results which are done with before the next block.
+       allocations counts the arrays allocated, which stops growing once block processing
+       reaches a steady state.
+    """
+    def __init__(self):
+        self.free = {}
+        self.allocations = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def take(self, shape, dtype):
+        """Return an array of shape and dtype, to be handed back with give() when done."""
+        key = (tuple(shape), np.dtype(dtype))
+        with self._lock:
+            free = self.free.get(key)
+            if free:
+                return free.pop()
+            self.allocations += 1
+        return np.empty(key[0], dtype=key[1])
+
+    def give(self, *arrays):
+        """Hand arrays from take() back for reuse."""
+        with self._lock:
+            for array in arrays:
+                self.free.setdefault((array.shape, array.dtype), []).append(array)
+
+    def scratch(self, name, shape, dtype):
+        """Return the calling thread's array for name, reused by its next call for name."""
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        array = buffers.get(name)
+        if array is None or array.shape != tuple(shape) or array.dtype != np.dtype(dtype):
+            if array is not None:
+                self.give(array)
+            array = buffers[name] = self.take(shape, dtype)
+        return array
+
+
+# Pool shared by the block loops, per process.
+buffer_pool = BufferPool()
+
+
+class TileCache:
+    """Least recently used cache of decoded input tiles, holding at most budget bytes.
+
+       Neighbouring features read many of the same tiles of the input datasets, which would
+       otherwise be decompressed again for each feature. Tiles are keyed by (dataset, band,
+       tile column, tile row) and are read-only, as they are shared by every reader. A budget
+       of 0 disables the cache.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.tiles = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, read):
+        """Return the tile for key, calling read() to decode it if it is not cached."""
+        with self._lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+            self.misses += 1
+        tile = read()
+        tile.flags.writeable = False
+        with self._lock:
+            if key not in self.tiles and tile.nbytes <= self.budget:
+                self.tiles[key] = tile
+                self.nbytes += tile.nbytes
+                while self.nbytes > self.budget:
+                    _, evicted = self.tiles.popitem(last=False)
+                    self.nbytes -= evicted.nbytes
+                    self.evictions += 1
+        return tile
+
+    def stats(self, since=None):
+        """Return dict of hits, misses and evictions, less those of an earlier stats()."""
+        stats = {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+        if since is not None:
+            stats = {name: n - since[name] for name, n in stats.items()}
+        return stats
+
+    def merge(self, stats):
+        """Add the stats() of another cache, typically from a worker process."""
+        with self._lock:
+            self.hits += stats['hits']
+            self.misses += stats['misses']
+            self.evictions += stats['evictions']
+
+    def report(self, stats=None):
+        """Print the hit ratio and evictions of stats, or of everything so far."""
+        if stats is None:
+            stats = self.stats()
+        lookups = stats['hits'] + stats['misses']
+        if lookups:
+            print(f"Tile cache: {stats['hits']} hits of {lookups} tile reads, "
+                  f"{stats['hits'] / lookups:.1%} hit ratio, {stats['evictions']} evictions")
+
+
+# Cache of decoded input tiles shared by the block loops, per process.
+tile_cache = TileCache(budget=256 * 1024 * 1024)
+
+# Tokens keying the tiles of datasets which read no files, see dataset_key().
+_dataset_tokens = itertools.count()
+
+
+def dataset_key(img):
+    """Return a key for the tiles of img in a TileCache.
+
+       This is the driver of img and the files it reads, which for a virtual dataset are its
+       sources. A dataset with no files, such as a MEM dataset, gets a token of its own: it
+       cannot be keyed by id(), which is reused once the dataset is freed while its tiles are
+       still cached.
+    """
+    files = img.GetFileList()
+    if files:
+        return (img.GetDriver().ShortName,) + tuple(os.path.abspath(f) for f in files)
+    return ('unnamed', next(_dataset_tokens))
+
+
+class PooledBand:
+    """GDAL band whose ReadAsArray() fills a buffer from a BufferPool instead of a new array.
+
+       The buffer is reused by the next read of the same size, so callers must be done with a
+       block before reading the next one. With a TileCache, the block is copied from the cached
+       native tiles of the band rather than read from it. If there is a fresh copy of the
+       dataset from write_input_cache(), the block is instead a read-only view of it, with no
+       decompression or copy at all. Everything else is delegated to the band.
+    """
+    def __init__(self, band, pool=None, cache=None):
+        self.band = band
+        self.pool = buffer_pool if pool is None else pool
+        self.cache = cache
+        first = self.first_band()
+        self.dtype = osgeo.gdal_array.GDALTypeCodeToNumericTypeCode(first.DataType)
+        self.x_tilesiz, self.y_tilesiz = first.GetBlockSize()
+        self.key = (dataset_key(first.GetDataset()), first.GetBand())
+        self.buffer = None
+        self.mapped = self.open_mapped()
+
+    def first_band(self):
+        return self.band
+
+    def open_mapped(self):
+        mapped = input_cache(self.band.GetDataset())
+        return None if mapped is None else mapped[self.band.GetBand() - 1]
+
+    def shape(self, ncols, nrows):
+        return (nrows, ncols)
+
+    def ReadAsArray(self, x, y, ncols, nrows):
+        if self.mapped is not None:
+            return self.mapped[..., y:y + nrows, x:x + ncols]
+        shape = self.shape(ncols=ncols, nrows=nrows)
+        if self.buffer is None or self.buffer.shape != shape:
+            if self.buffer is not None:
+                self.pool.give(self.buffer)
+            self.buffer = self.pool.take(shape, self.dtype)
+        if self.cache is None or not self.cache.budget:
+            return self.band.ReadAsArray(x, y, ncols, nrows, buf_obj=self.buffer)
+
+        x_tilesiz, y_tilesiz = self.x_tilesiz, self.y_tilesiz
+        for ty in range(y // y_tilesiz, (y + nrows - 1) // y_tilesiz + 1):
+            y0 = max(y, ty * y_tilesiz)
+            y1 = min(y + nrows, (ty + 1) * y_tilesiz)
+            for tx in range(x // x_tilesiz, (x + ncols - 1) // x_tilesiz + 1):
+                x0 = max(x, tx * x_tilesiz)
+                x1 = min(x + ncols, (tx + 1) * x_tilesiz)
+                tile = self.cache.get(self.key + (tx, ty),
+                        functools.partial(self.read_tile, tx, ty))
+                self.buffer[..., y0 - y:y1 - y, x0 - x:x1 - x] = tile[...,
+                        y0 - ty * y_tilesiz:y1 - ty * y_tilesiz,
+                        x0 - tx * x_tilesiz:x1 - tx * x_tilesiz]
+        return self.buffer
+
+    def read_tile(self, tx, ty):
+        """Return the native tile at column tx, row ty, clipped to the raster."""
+        first = self.first_band()
+        x = tx * self.x_tilesiz
+        y = ty * self.y_tilesiz
+        return self.band.ReadAsArray(x, y, blklim(coord=x, blksiz=self.x_tilesiz,
+                totsiz=first.XSize), blklim(coord=y, blksiz=self.y_tilesiz, totsiz=first.YSize))
+
+    def __getattr__(self, name):
+        return getattr(self.band, name)
+
+
+class BandStack(PooledBand):
+    """Every band of a dataset read as one (nbands, nrows, ncols) array.
+
+       A window of all bands is fetched by a single ReadAsArray() of the dataset, into a pooled
+       buffer as for PooledBand. The individual bands are in bands.
+    """
+    def __init__(self, img, pool=None, cache=None):
+        self.bands = [img.GetRasterBand(b) for b in range(1, img.RasterCount + 1)]
+        super().__init__(band=img, pool=pool, cache=cache)
+        self.key = (dataset_key(img), 0)
+
+    def first_band(self):
+        return self.bands[0]
+
+    def open_mapped(self):
+        return input_cache(self.band)
+
+    def shape(self, ncols, nrows):
+        return (len(self.bands), nrows, ncols)
+
+
+def upsample(block, factor, out):
+    """Write block with each pixel repeated factor x factor times into out, and return out.
+
+       This is np.repeat() along the last two axes, into an existing array.
+    """
+    nrows, ncols = block.shape[-2:]
+    view = out.reshape(block.shape[:-2] + (nrows, factor, ncols, factor))
+    view[...] = block[..., :, np.newaxis, :, np.newaxis]
+    return out
+
+
+def stack_files(filenames):
+    """Return a virtual dataset with the first band of each file as one of its bands."""
+    return osgeo.gdal.BuildVRT('', filenames, separate=True)
+
+
+def class_counts(codes, nclasses, factor=3):
+    """Return (nclasses, nrows, ncols) numpy array counting the pixels of each class code.
+
+       codes is a block of class codes on a grid factor times finer than the result, so each
+       result pixel counts the factor x factor window of codes it covers. Codes of nclasses or
+       more are not counted. All classes are counted in one bincount of window and code, with
+       the index built in a scratch array of buffer_pool.
+    """
+    nrows = codes.shape[0] // factor
+    ncols = codes.shape[1] // factor
+    codes = codes[:nrows * factor, :ncols * factor]
+    ncodes = nclasses + 1
+    idx = buffer_pool.scratch('class_counts_index', codes.shape, np.intp)
+    window_rows = (np.arange(nrows * factor) // factor) * (ncols * ncodes)
+    window_cols = (np.arange(ncols * factor) // factor) * ncodes
+    np.add(window_rows[:, np.newaxis], window_cols[np.newaxis, :], out=idx)
+    clipped = buffer_pool.scratch('class_counts_codes', codes.shape, codes.dtype)
+    np.minimum(codes, nclasses, out=clipped)
+    np.add(idx, clipped, out=idx, casting='unsafe')
+    counts = np.bincount(idx.ravel(), minlength=nrows * ncols * ncodes)
+    return counts.reshape(nrows, ncols, ncodes)[:, :, :nclasses].transpose(2, 0, 1)
+
+
+def file_digest(filename):
+    """Return the SHA-1 of the contents of filename, as a hex string.
+
+       Digests are remembered in digests_filename along with the size and modification time of
+       the file, so a multi-GB raster is only read in full again after it has been rewritten.
+    """
+    global _digests
+    if _digests is None:
+        try:
+            with open(digests_filename, 'r') as f:
+                _digests = json.load(f)
+        except (OSError, ValueError):
+            _digests = {}
+    st = os.stat(filename)
+    stamp = [st.st_size, st.st_mtime_ns]
+    path = os.path.abspath(filename)
+    entry = _digests.get(path)
+    if entry is not None and entry['stamp'] == stamp:
+        return entry['sha1']
+
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, 16 * 1024 * 1024), b''):
+            h.update(chunk)
+    _digests[path] = {'stamp': stamp, 'sha1': h.hexdigest()}
+    os.makedirs(os.path.dirname(digests_filename) or '.', exist_ok=True)
+    tmpfilename = digests_filename + '.tmp'
+    with open(tmpfilename, 'w') as f:
+        json.dump(_digests, f)
+    os.replace(tmpfilename, digests_filename)
+    return h.hexdigest()
+
+
+def mask_manifest_filename(maskfilename):
+    """Return the name of the manifest for a mask file, masks/X_mask._tif -> masks/X_mask.json"""
+    return os.path.splitext(maskfilename)[0] + '.json'
+
+
+def read_mask_manifest(maskfilename):
+    """Return the manifest written by prepare_feature_masks for maskfilename.
+
+       Returns None if there is no manifest or it is older than the mask itself.
+    """
+    manifestfilename = mask_manifest_filename(maskfilename)
+    try:
+        if os.path.getmtime(manifestfilename) < os.path.getmtime(maskfilename):
+            return None
+        with open(manifestfilename, 'r') as f:
+            return json.load(f)
+    except OSError:
+        return None
+
+
+def mask_work(maskfilename):
+    """Return an estimate of the work needed to process a mask, for scheduling.
+
+       This is the number of populated blocks in the manifest, or the size of the mask file if
+       there is no manifest. Either way bigger countries return bigger numbers.
+    """
+    manifest = read_mask_manifest(maskfilename)
+    if manifest is not None:
+        return len(manifest['blocks'])
+    try:
+        return os.path.getsize(maskfilename)
+    except OSError:
+        return 0
+
+
+def geometry_envelopes(geometry):
+    """Return list of (x_min, x_max, y_min, y_max) of each part of an OGR geometry.
+
+       A part more than 180 degrees wide, presumably wrapping around the antimeridian, is split
+       into its eastern and western hemisphere pieces.
+    """
+    if geometry is None or geometry.IsEmpty():
+        return []
+    if osgeo.ogr.GT_Flatten(geometry.GetGeometryType()) in (osgeo.ogr.wkbMultiPolygon,
+            osgeo.ogr.wkbGeometryCollection):
+        parts = [geometry.GetGeometryRef(n) for n in range(geometry.GetGeometryCount())]
+    else:
+        parts = [geometry]
+
+    envelopes = []
+    for part in parts:
+        x_min, x_max, y_min, y_max = part.GetEnvelope()
+        if x_max - x_min <= 180.0:
+            envelopes.append((x_min, x_max, y_min, y_max))
+            continue
+        for west, east in [(-180.0, 0.0), (0.0, 180.0)]:
+            box = osgeo.ogr.CreateGeometryFromWkt(f"POLYGON (({west} -90, {east} -90, "
+                    f"{east} 90, {west} 90, {west} -90))")
+            piece = part.Intersection(box)
+            if piece is not None and not piece.IsEmpty():
+                envelopes.append(piece.GetEnvelope())
+    return envelopes
+
+
+def envelope_windows(envelopes, geotransform, x_siz, y_siz, x_blksiz, y_blksiz):
+    """Return sorted list of disjoint (x, y, ncols, nrows) windows covering the envelopes.
+
+       Each envelope, see geometry_envelopes(), is widened to whole blocks of x_blksiz by
+       y_blksiz. Windows which overlap are merged, as are windows whose combined bounding box
+       is no bigger than the two of them, so that a compact country is a single window while
+       the far flung parts of the USA, France or Russia are not one window the size of the
+       globe.
+    """
+    x_0, x_pixdeg, _, y_0, _, y_pixdeg = geotransform
+    x_nblks = math.ceil(x_siz / x_blksiz)
+    y_nblks = math.ceil(y_siz / y_blksiz)
+    rects = set()
+    for x_min, x_max, y_min, y_max in envelopes:
+        cols = sorted([(x_min - x_0) / x_pixdeg, (x_max - x_0) / x_pixdeg])
+        rows = sorted([(y_min - y_0) / y_pixdeg, (y_max - y_0) / y_pixdeg])
+        bx0 = max(0, math.floor(cols[0]) // x_blksiz)
+        by0 = max(0, math.floor(rows[0]) // y_blksiz)
+        bx1 = min(x_nblks, math.ceil(math.ceil(cols[1]) / x_blksiz))
+        by1 = min(y_nblks, math.ceil(math.ceil(rows[1]) / y_blksiz))
+        if bx0 < bx1 and by0 < by1:
+            rects.add((bx0, by0, bx1, by1))
+
+    def area(r):
+        return (r[2] - r[0]) * (r[3] - r[1])
+
+    rects = sorted(rects)
+    while True:
+        merged = []
+        for r in rects:
+            for n, m in enumerate(merged):
+                u = (min(r[0], m[0]), min(r[1], m[1]), max(r[2], m[2]), max(r[3], m[3]))
+                overlap = r[0] < m[2] and m[0] < r[2] and r[1] < m[3] and m[1] < r[3]
+                if overlap or area(u) <= area(r) + area(m):
+                    merged[n] = u
+                    break
+            else:
+                merged.append(r)
+        if len(merged) == len(rects):
+            break
+        rects = merged
+
+    windows = []
+    for bx0, by0, bx1, by1 in sorted(rects, key=lambda r: (r[1], r[0])):
+        x = bx0 * x_blksiz
+        y = by0 * y_blksiz
+        windows.append((x, y, min(bx1 * x_blksiz, x_siz) - x, min(by1 * y_blksiz, y_siz) - y))
+    return windows
+
+
+def populated_blocks(maskfilename, band, envelopes=None):
+    """Return list of (x, y, ncols, nrows, full) for each block of the mask containing data.
+
+       full is True if every pixel in the block is set. Uses the mask manifest if there is one,
+       otherwise probes the blocks of the mask with is_sparse(): every block, or with envelopes
+       of the feature only those within envelope_windows().
+    """
+    x_siz = band.XSize
+    y_siz = band.YSize
+    manifest = read_mask_manifest(maskfilename)
+    if manifest is not None:
+        x_blksiz, y_blksiz = manifest['blocksize']
+        full = set(tuple(b) for b in manifest['full'])
+        blocks = []
+        for x, y in manifest['blocks']:
+            ncols = blklim(coord=x, blksiz=x_blksiz, totsiz=x_siz)
+            nrows = blklim(coord=y, blksiz=y_blksiz, totsiz=y_siz)
+            blocks.append((x, y, ncols, nrows, (x, y) in full))
+        return blocks
+
+    blocks = []
+    x_blksiz, y_blksiz = band.GetBlockSize()
+    if envelopes is None:
+        regions = [(0, 0, x_siz, y_siz)]
+    else:
+        regions = envelope_windows(envelopes=envelopes,
+                geotransform=band.GetDataset().GetGeoTransform(), x_siz=x_siz, y_siz=y_siz,
+                x_blksiz=x_blksiz, y_blksiz=y_blksiz)
+    for x_reg, y_reg, ncols_reg, nrows_reg in regions:
+        for y in range(y_reg, y_reg + nrows_reg, y_blksiz):
+            nrows = blklim(coord=y, blksiz=y_blksiz, totsiz=y_siz)
+            for x in range(x_reg, x_reg + ncols_reg, x_blksiz):
+                ncols = blklim(coord=x, blksiz=x_blksiz, totsiz=x_siz)
+                if is_sparse(band=band, x=x, y=y, ncols=ncols, nrows=nrows):
+                    # sparse hole in image, no data to process
+                    continue
+                blocks.append((x, y, ncols, nrows, False))
+    return sorted(blocks, key=lambda b: (b[1], b[0]))
+
+
+def populated_windows(maskfilename, band, x_winsiz, y_winsiz, envelopes=None):
+    """Return list of (x, y, ncols, nrows, full) for each window of the mask containing data.
+
+       Windows are a multiple of the mask's block size, see plan_window(), and are full if every
+       block within them is full. With windows the size of a block this is populated_blocks(),
+       as are envelopes.
+    """
+    x_blksiz, y_blksiz = band.GetBlockSize()
+    blocks = populated_blocks(maskfilename, band, envelopes=envelopes)
+    if (x_winsiz, y_winsiz) == (x_blksiz, y_blksiz):
+        return blocks
+
+    x_siz = band.XSize
+    y_siz = band.YSize
+    found = {}
+    for x, y, ncols, nrows, full in blocks:
+        key = (x // x_winsiz * x_winsiz, y // y_winsiz * y_winsiz)
+        nfull, nblocks = found.get(key, (0, 0))
+        found[key] = (nfull + int(full), nblocks + 1)
+    result = []
+    for (x, y), (nfull, nblocks) in sorted(found.items(), key=lambda w: (w[0][1], w[0][0])):
+        ncols = blklim(coord=x, blksiz=x_winsiz, totsiz=x_siz)
+        nrows = blklim(coord=y, blksiz=y_winsiz, totsiz=y_siz)
+        total = math.ceil(ncols / x_blksiz) * math.ceil(nrows / y_blksiz)
+        result.append((x, y, ncols, nrows, nfull == total))
+    return result
+
+
+def shared_windows(masks, x_winsiz, y_winsiz):
+    """Return list of (x, y, ncols, nrows, members) of the windows populated in any of masks.
+
+       masks is a dict of {key: (maskfilename, band, envelopes)} of masks on the same grid, and
+       members is the list of (key, full) of the masks populated within the window, see
+       populated_windows(). Windows are sorted by row, so a sweep of them reads each window of
+       the inputs once however many masks use it.
+    """
+    found = {}
+    for key, (maskfilename, band, envelopes) in masks.items():
+        for x, y, ncols, nrows, full in populated_windows(maskfilename, band,
+                x_winsiz=x_winsiz, y_winsiz=y_winsiz, envelopes=envelopes):
+            found.setdefault((y, x, ncols, nrows), []).append((key, full))
+    return [(x, y, ncols, nrows, members)
+            for (y, x, ncols, nrows), members in sorted(found.items())]
+
+
+def read_mask_block(band, x, y, ncols, nrows, full, out=None):
+    """Return the mask block, without reading it if it is known to be fully covered.
+
+       With out, a uint8 array of (nrows, ncols), band is a GDAL band which is read into it.
+    """
+    if full:
+        block = buffer_pool.scratch('full_mask', (nrows, ncols), np.uint8)
+        block.fill(1)
+        return block
+    if out is not None:
+        return band.ReadAsArray(x, y, ncols, nrows, buf_obj=out)
+    return band.ReadAsArray(x, y, ncols, nrows)
+
+
+def mask_km2(mask_blk, km2_blk):
+    """Return np.where(mask_blk, km2_blk, 0.0), in a scratch array of buffer_pool."""
+    inside = buffer_pool.scratch('mask_km2_inside', mask_blk.shape, np.bool_)
+    np.not_equal(mask_blk, 0, out=inside)
+    out = buffer_pool.scratch('mask_km2', mask_blk.shape, np.float64)
+    out.fill(0.0)
+    np.copyto(out, km2_blk, where=inside)
+    return out
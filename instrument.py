@@ -0,0 +1,197 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""Opt-in timing and counters for the block loops of the data pipelines.
+
+   Instrumented functions take an instruments argument defaulting to disabled, which records
+   nothing, so a run without instrumentation only pays for an empty context manager per stage.
+"""
+
+import contextlib
+import cProfile
+import csv
+import json
+import threading
+import time
+
+
+class Instruments:
+    """Wall time per stage, counters and per-country durations for one run.
+
+       Stages nest: time spent in an inner stage, such as reading a band while classifying a
+       block, is not also counted in the outer stage, so the stages add up to the time spent
+       in them. Stages and counters may be updated from several threads, in which case stage
+       times are summed over the threads. Sections hold the instruments of one part of a run.
+    """
+    def __init__(self, profile=False):
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self.countries = {}
+        self.sections = {}
+        self.start = time.time()
+        self.profiler = cProfile.Profile() if profile else None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __getstate__(self):
+        """Pickle only the recorded values, to return them from worker processes."""
+        return {'seconds': self.seconds, 'calls': self.calls, 'counters': self.counters,
+                'countries': self.countries, 'sections': self.sections, 'start': self.start}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.profiler = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def section(self, name):
+        """Return the Instruments for section name, sharing this one's profiler."""
+        if name not in self.sections:
+            section = Instruments()
+            section.profiler = self.profiler
+            self.sections[name] = section
+        return self.sections[name]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Add the time spent within the context, less that of inner stages, to stage name."""
+        local = self._local
+        outer = getattr(local, 'inner', 0.0)
+        local.inner = 0.0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - local.inner
+                self.calls[name] = self.calls.get(name, 0) + 1
+            local.inner = outer + elapsed
+
+    def count(self, name, n=1):
+        """Add n to counter name."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def country(self, name):
+        """Add the time spent within the context to the duration of country name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.countries[name] = self.countries.get(name, 0.0) + elapsed
+
+    @contextlib.contextmanager
+    def profile(self):
+        """Run the profiler, if there is one, within the context."""
+        if self.profiler is None:
+            yield
+            return
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+
+    def band(self, band):
+        """Return band wrapped to record the time and bytes of every read."""
+        return InstrumentedBand(band=band, instruments=self)
+
+    def merge(self, other):
+        """Add everything recorded by other, typically from a worker process, to this one."""
+        for name, seconds in other.seconds.items():
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        for name, calls in other.calls.items():
+            self.calls[name] = self.calls.get(name, 0) + calls
+        for name, n in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + n
+        for name, seconds in other.countries.items():
+            self.countries[name] = self.countries.get(name, 0.0) + seconds
+        for name, section in other.sections.items():
+            self.section(name).merge(section)
+
+    def to_dict(self):
+        """Return everything recorded as a dict, for the JSON report."""
+        return {
+            'stages': {name: {'seconds': self.seconds[name], 'calls': self.calls[name]}
+                       for name in self.seconds},
+            'counters': dict(self.counters),
+            'countries': dict(self.countries),
+            'sections': {name: section.to_dict() for name, section in self.sections.items()},
+        }
+
+    def rows(self, section=''):
+        """Yield (section, kind, name, value) for everything recorded, for the CSV report."""
+        for name in self.seconds:
+            yield (section, 'seconds', name, self.seconds[name])
+            yield (section, 'calls', name, self.calls[name])
+        for name, n in self.counters.items():
+            yield (section, 'counter', name, n)
+        for name, seconds in self.countries.items():
+            yield (section, 'country', name, seconds)
+        for name, other in self.sections.items():
+            yield from other.rows(section=f"{section}/{name}" if section else name)
+
+    def write(self, filename):
+        """Write the report to filename, as CSV if it ends in .csv and as JSON otherwise."""
+        if filename.endswith('.csv'):
+            with open(filename, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['Section', 'Kind', 'Name', 'Value'])
+                writer.writerow(['', 'wall', 'total', time.time() - self.start])
+                writer.writerows(self.rows())
+        else:
+            report = {'wall_seconds': time.time() - self.start}
+            report.update(self.to_dict())
+            with open(filename, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    def write_profile(self, filename):
+        """Write the cProfile statistics of the profiled loops to filename."""
+        self.profiler.dump_stats(filename)
+
+
+class InstrumentedBand:
+    """GDAL band which records each ReadAsArray() in stage 'read' and counter 'bytes_read'."""
+    def __init__(self, band, instruments):
+        self.band = band
+        self.instruments = instruments
+
+    def ReadAsArray(self, *args, **kwargs):
+        with self.instruments.stage('read'):
+            block = self.band.ReadAsArray(*args, **kwargs)
+        self.instruments.count('bytes_read', block.nbytes)
+        return block
+
+    def __getattr__(self, name):
+        return getattr(self.band, name)
+
+
+class Disabled:
+    """Instruments which record nothing."""
+    _nothing = contextlib.nullcontext()
+
+    def section(self, name):
+        return self
+
+    def stage(self, name):
+        return self._nothing
+
+    def count(self, name, n=1):
+        pass
+
+    def country(self, name):
+        return self._nothing
+
+    def profile(self):
+        return self._nothing
+
+    def band(self, band):
+        return band
+
+
+disabled = Disabled()
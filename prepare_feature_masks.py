@@ -1,95 +1,375 @@
+import argparse
+import concurrent.futures
+import csv
+import glob
+import json
+import multiprocessing
 import os.path
-import tempfile
 import time
 
 import numpy as np
 import osgeo.gdal
 import osgeo.ogr
 
+import admin_names
+import geoutil
+
+def feature_windows(img, geometry, x_blksiz, y_blksiz):
+    """Return list of (x_off, y_off, ncols, nrows) windows of img covering the geometry.
+
+       See geoutil.envelope_windows(), windows are whole x_blksiz by y_blksiz blocks of img so
+       their blocks are the blocks of the output file.
+    """
+    return geoutil.envelope_windows(envelopes=geoutil.geometry_envelopes(geometry),
+            geotransform=img.GetGeoTransform(), x_siz=img.RasterXSize, y_siz=img.RasterYSize,
+            x_blksiz=x_blksiz, y_blksiz=y_blksiz)
+
+
 def rasterize_one_feature(img, feature, layer, outfile):
-    """Rasterize a shapefile to TIFF."""
-    # Step 1: extract one feature from the original, and make a new shapefile.
-    tmpdir = tempfile.TemporaryDirectory()
-    new_shapefile = os.path.join(tmpdir.name, 'feature.shp')
-    shp_drv = osgeo.ogr.GetDriverByName("ESRI Shapefile")
-    new_data_source = shp_drv.CreateDataSource(new_shapefile)
-    srs = layer.GetSpatialRef()
-    new_layer = new_data_source.CreateLayer("feature", geom_type=osgeo.ogr.wkbPolygon, srs=srs)
-    new_feat = osgeo.ogr.Feature(layer.GetLayerDefn())
-    new_feat.SetGeometry(feature.GetGeometryRef())
-    new_layer.CreateFeature(new_feat)
-
-    # Close datasets. GDAL needs this as it implements some of the work in the destructor.
-    new_feat = None
-    new_data_source = None
-    new_layer = None
+    """Rasterize one feature of a layer to a sparse mask GeoTIFF on the grid of img.
 
-    # Step 2: Rasterize the new shapefile to an in-memory buffer.
+       Only the windows of img covering the parts of the feature are rasterized, see
+       feature_windows(), so a country needs neither a globe sized buffer nor a scan of every
+       empty block of one.
+    """
     x_siz = img.RasterXSize
     y_siz = img.RasterYSize
-    mem_output = osgeo.gdal.GetDriverByName('MEM').Create('', x_siz, y_siz, 1, osgeo.gdal.GDT_Byte)
-    mem_output.SetProjection(img.GetProjection())
-    mem_output.SetGeoTransform(img.GetGeoTransform())
-    data_source = shp_drv.Open(new_shapefile, 0)
-    new_layer = data_source.GetLayer()
-    osgeo.gdal.RasterizeLayer(mem_output, [1], new_layer)
-
-    # Step 3: Copy the active pixels to the output file.
-    # The extra copy between steps 3 & 4 is needed to get a Sparse GeoTIFF file, where empty
-    # areas of the raster are omitted from the file entirely. This does reduce the size of the
-    # file, but the main reason for doing it is to allow the subsequent steps using this raster
-    # as a mask to completely skip processing the empty blocks.
+    x_blksiz = y_blksiz = 256
+    geometry = feature.GetGeometryRef()
+
+    # The output is a Sparse GeoTIFF file, where empty areas of the raster are omitted from
+    # the file entirely. This does reduce the size of the file, but the main reason for doing
+    # it is to allow the subsequent steps using this raster as a mask to completely skip
+    # processing the empty blocks.
     output = osgeo.gdal.GetDriverByName('GTiff').Create(
             outfile, x_siz, y_siz, 1, osgeo.gdal.GDT_Byte,
             # ZSTD: 2.3 Megs, DEFLATE: 3.8 Megs, LZW: 15 Megs, PACKBITS: 67 Megs
             options=['NBITS=1', 'COMPRESS=ZSTD', 'TILED=YES', 'NUM_THREADS=2', 'SPARSE_OK=TRUE'])
     output.SetProjection(img.GetProjectionRef())
     output.SetGeoTransform(img.GetGeoTransform())
+    manifest = new_manifest(outfile=outfile, x_siz=x_siz, y_siz=y_siz, x_blksiz=x_blksiz,
+            y_blksiz=y_blksiz)
 
-    # copy the active pixels.
-    x_blksiz = y_blksiz = 256
+    # Step 1: copy the feature to an in-memory layer.
+    mem_data_source = osgeo.ogr.GetDriverByName('Memory').CreateDataSource('feature')
+    mem_layer = mem_data_source.CreateLayer('feature', srs=layer.GetSpatialRef(),
+            geom_type=layer.GetGeomType())
+    new_feat = osgeo.ogr.Feature(mem_layer.GetLayerDefn())
+    new_feat.SetGeometry(geometry)
+    mem_layer.CreateFeature(new_feat)
+    new_feat = None
+
+    x_0, x_pixdeg, x_rot, y_0, y_rot, y_pixdeg = img.GetGeoTransform()
+    for x_win, y_win, x_winsiz, y_winsiz in feature_windows(img=img, geometry=geometry,
+            x_blksiz=x_blksiz, y_blksiz=y_blksiz):
+        # Step 2: rasterize it to an in-memory buffer covering just the window.
+        mem_output = osgeo.gdal.GetDriverByName('MEM').Create('', x_winsiz, y_winsiz, 1,
+                osgeo.gdal.GDT_Byte)
+        mem_output.SetProjection(img.GetProjection())
+        mem_output.SetGeoTransform((x_0 + x_win * x_pixdeg, x_pixdeg, x_rot,
+                                    y_0 + y_win * y_pixdeg, y_rot, y_pixdeg))
+        osgeo.gdal.RasterizeLayer(mem_output, [1], mem_layer)
+        buffer = mem_output.GetRasterBand(1).ReadAsArray()
+        mem_output = None
+
+        # Step 3: copy the active blocks of the window to the output file.
+        for y_off in range(y_win, y_win + y_winsiz, y_blksiz):
+            rows = geoutil.blklim(coord=y_off, blksiz=y_blksiz, totsiz=y_siz)
+            for x_off in range(x_win, x_win + x_winsiz, x_blksiz):
+                cols = geoutil.blklim(coord=x_off, blksiz=x_blksiz, totsiz=x_siz)
+                data = buffer[y_off - y_win:y_off - y_win + rows,
+                              x_off - x_win:x_off - x_win + cols]
+                if add_block_to_manifest(manifest=manifest, data=data, x_off=x_off,
+                        y_off=y_off):
+                    output.GetRasterBand(1).WriteArray(data, x_off, y_off)
+
+    output = None
+    # windows are visited one after the other, keep the manifest in row major order.
+    manifest['blocks'].sort(key=lambda b: (b[1], b[0]))
+    manifest['full'].sort(key=lambda b: (b[1], b[0]))
+    write_manifest(manifest=manifest, outfile=outfile)
+
+
+def new_manifest(outfile, x_siz, y_siz, x_blksiz, y_blksiz):
+    """Return an empty manifest of the populated blocks in a mask file.
+
+       Manifests let the processing loops visit only the blocks of a mask with data in them,
+       instead of probing every block of the globe with geoutil.is_sparse.
+    """
+    return {'mask': os.path.basename(outfile), 'size': [x_siz, y_siz],
+            'blocksize': [x_blksiz, y_blksiz], 'bbox': None, 'pixels': 0,
+            'blocks': [], 'full': []}
+
+
+def add_block_to_manifest(manifest, data, x_off, y_off):
+    """Record one block of mask data in the manifest, return True if it has any pixels set."""
+    count = int(np.count_nonzero(data))
+    if count == 0:
+        return False
+    manifest['pixels'] += count
+    manifest['blocks'].append([x_off, y_off])
+    if count == data.size:
+        manifest['full'].append([x_off, y_off])
+    rows = np.flatnonzero(data.any(axis=1))
+    cols = np.flatnonzero(data.any(axis=0))
+    bbox = [x_off + int(cols[0]), y_off + int(rows[0]),
+            x_off + int(cols[-1]) + 1, y_off + int(rows[-1]) + 1]
+    if manifest['bbox'] is not None:
+        bbox = [min(bbox[0], manifest['bbox'][0]), min(bbox[1], manifest['bbox'][1]),
+                max(bbox[2], manifest['bbox'][2]), max(bbox[3], manifest['bbox'][3])]
+    manifest['bbox'] = bbox
+    return True
+
+
+def write_manifest(manifest, outfile):
+    """Write the manifest for mask file outfile, bbox is [xmin, ymin, xmax, ymax) in pixels."""
+    with open(geoutil.mask_manifest_filename(outfile), 'w') as f:
+        json.dump(manifest, f)
+
+
+def write_mask_manifest(maskfilename):
+    """Produce the manifest for an existing mask file."""
+    maskimg = osgeo.gdal.Open(maskfilename, osgeo.gdal.GA_ReadOnly)
+    band = maskimg.GetRasterBand(1)
+    x_siz = band.XSize
+    y_siz = band.YSize
+    x_blksiz, y_blksiz = band.GetBlockSize()
+    manifest = new_manifest(outfile=maskfilename, x_siz=x_siz, y_siz=y_siz, x_blksiz=x_blksiz,
+            y_blksiz=y_blksiz)
     for y_off in range(0, y_siz, y_blksiz):
-        if y_off + y_blksiz < y_siz:
-            rows = y_blksiz
-        else:
-            rows = y_siz - y_off
+        rows = geoutil.blklim(coord=y_off, blksiz=y_blksiz, totsiz=y_siz)
         for x_off in range(0, x_siz, x_blksiz):
-            if x_off + x_blksiz < x_siz:
-                cols = x_blksiz
-            else:
-                cols = x_siz - x_off
-            data = mem_output.GetRasterBand(1).ReadAsArray(x_off, y_off, cols, rows)
-            if np.count_nonzero(data) != 0:
-                output.GetRasterBand(1).WriteArray(data, x_off, y_off)
+            cols = geoutil.blklim(coord=x_off, blksiz=x_blksiz, totsiz=x_siz)
+            if geoutil.is_sparse(band=band, x=x_off, y=y_off, ncols=cols, nrows=rows):
+                continue
+            data = band.ReadAsArray(x_off, y_off, cols, rows)
+            add_block_to_manifest(manifest=manifest, data=data, x_off=x_off, y_off=y_off)
+    write_manifest(manifest=manifest, outfile=maskfilename)
+
+
+# Reference image for each mask resolution, masks are produced on the same grid.
+grids = {
+        '1km': 'data/Beck_KG_V1/Beck_KG_V1_present_0p0083.tif',
+        '333m': 'data/copernicus/C3S-LC-L4-LCCS-Map-300m-P1Y-2018-v2.1.1.tif',
+        '0p5': 'data/Beck_KG_V1/Beck_KG_V1_present_0p5.tif',
+        }
+
+
+shapefilename = 'data/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
+
+# Input rasters copied uncompressed by --input-cache, see geoutil.write_input_cache(). A list
+# is a set of single band files read together as one stack.
+input_cache_inputs = [
+        'data/Beck_KG_V1/Beck_KG_V1_present_0p0083.tif',
+        'data/Beck_KG_V1/Beck_KG_V1_future_0p0083.tif',
+        'data/copernicus/C3S-LC-L4-LCCS-Map-300m-P1Y-2018-v2.1.1.tif',
+        'data/copernicus/ESACCI-LC-L4-LCCS-Map-300m-P1Y-2015-v2.0.7.tif',
+        'data/ConsolidatedSlope.tif',
+        'data/geomorpho90m/classified_slope_merit_dem_1km_s0..0cm_2018_v1.0.tif',
+        [f'data/FAO/GloSlopesCl{i}_30as.tif' for i in range(1, 9)],
+        'data/FAO/workability_FAO_sq7_1km.tif',
+        'data/lpd_int2/lpd_int2.tif',
+        ]
+
+
+def mask_tasks(layer, maskdims=None, features=None):
+    """Return list of (maskdim, idx, outfile, work) for each mask to produce.
+
+       maskdims limits the grids, features limits the features to those with a SOV_A3 or
+       A3_IDX name (as used in mask filenames) in the list. work is the area in pixels of the
+       feature_windows() of the feature, roughly the cost of producing its mask.
+    """
+    result = []
+    for maskdim, imgfilename in grids.items():
+        if maskdims and maskdim not in maskdims:
+            continue
+        img = osgeo.gdal.Open(imgfilename, osgeo.gdal.GA_ReadOnly)
+        for idx, feature in enumerate(layer):
+            a3 = feature.GetField("SOV_A3")
+            if features and a3 not in features and f'{a3}_{idx}' not in features:
+                continue
+            work = sum(ncols * nrows for _, _, ncols, nrows in feature_windows(img=img,
+                    geometry=feature.GetGeometryRef(), x_blksiz=256, y_blksiz=256))
+            result.append((maskdim, idx, f'masks/{a3}_{idx}_{maskdim}_mask._tif', work))
+    return result
+
+
+_worker_shapefile = None
+_worker_layer = None
+_worker_imgs = None
 
 
-def process_shapefile():
-    shapefilename = 'data/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
+def _init_worker():
+    """Open the shapefile and grids once per worker process, handles cannot be shared."""
+    global _worker_shapefile, _worker_layer, _worker_imgs
+    shp_drv = osgeo.ogr.GetDriverByName("ESRI Shapefile")
+    _worker_shapefile = shp_drv.Open(shapefilename, 0)
+    _worker_layer = _worker_shapefile.GetLayerByIndex(0)
+    _worker_imgs = {maskdim: osgeo.gdal.Open(imgfilename, osgeo.gdal.GA_ReadOnly)
+                    for maskdim, imgfilename in grids.items()}
+
+
+def _rasterize_worker(maskdim, idx, outfile):
+    feature = _worker_layer.GetFeature(idx)
+    rasterize_one_feature(img=_worker_imgs[maskdim], feature=feature, layer=_worker_layer,
+            outfile=outfile)
+    return outfile
+
+
+def process_shapefile(jobs=1, maskdims=None, features=None):
+    """Rasterize a mask per feature for each grid, see mask_tasks() for maskdims and features.
+
+       With jobs > 1 masks are produced in that many worker processes, each with its own GDAL
+       and OGR handles, largest first so they do not leave the pool idle at the end.
+    """
     shp_drv = osgeo.ogr.GetDriverByName("ESRI Shapefile")
     shapefile = shp_drv.Open(shapefilename, 0)
     layer = shapefile.GetLayerByIndex(0)
+    tasks = mask_tasks(layer=layer, maskdims=maskdims, features=features)
 
-    img = osgeo.gdal.Open('data/Beck_KG_V1/Beck_KG_V1_present_0p0083.tif', osgeo.gdal.GA_ReadOnly)
-    for idx, feature in enumerate(layer):
-        a3 = feature.GetField("SOV_A3")
-        outfile = f'masks/{a3}_{idx}_1km_mask._tif'
-        print(f'{outfile}')
-        rasterize_one_feature(img=img, feature=feature, layer=layer, outfile=outfile)
+    if jobs <= 1:
+        imgs = {}
+        for n, (maskdim, idx, outfile, work) in enumerate(tasks):
+            if maskdim not in imgs:
+                imgs[maskdim] = osgeo.gdal.Open(grids[maskdim], osgeo.gdal.GA_ReadOnly)
+            print(f'[{n + 1}/{len(tasks)}] {outfile}')
+            rasterize_one_feature(img=imgs[maskdim], feature=layer.GetFeature(idx), layer=layer,
+                    outfile=outfile)
+        return
+
+    ctx = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=ctx,
+            initializer=_init_worker) as executor:
+        futures = [executor.submit(_rasterize_worker, maskdim, idx, outfile)
+                   for maskdim, idx, outfile, work in sorted(tasks, key=lambda t: t[3],
+                       reverse=True)]
+        for n, future in enumerate(concurrent.futures.as_completed(futures)):
+            print(f'[{n + 1}/{len(tasks)}] {future.result()}')
 
-    img = osgeo.gdal.Open('data/copernicus/C3S-LC-L4-LCCS-Map-300m-P1Y-2018-v2.1.1.tif', osgeo.gdal.GA_ReadOnly)
+
+def rasterize_feature_ids(img, layer, outfile):
+    """Rasterize every feature of the layer into one raster of feature IDs.
+
+       Pixel values are the feature index + 1, with 0 outside of every feature. Where features
+       overlap the later feature wins, whereas the per-feature masks each keep those pixels.
+    """
+    mem_data_source = osgeo.ogr.GetDriverByName('Memory').CreateDataSource('feature_ids')
+    mem_layer = mem_data_source.CreateLayer('feature_ids', srs=layer.GetSpatialRef(),
+            geom_type=layer.GetGeomType())
+    mem_layer.CreateField(osgeo.ogr.FieldDefn('FEATURE_ID', osgeo.ogr.OFTInteger))
     for idx, feature in enumerate(layer):
-        a3 = feature.GetField("SOV_A3")
-        outfile = f'masks/{a3}_{idx}_333m_mask._tif'
+        new_feat = osgeo.ogr.Feature(mem_layer.GetLayerDefn())
+        new_feat.SetField('FEATURE_ID', idx + 1)
+        new_feat.SetGeometry(feature.GetGeometryRef())
+        mem_layer.CreateFeature(new_feat)
+    new_feat = None
+
+    output = osgeo.gdal.GetDriverByName('GTiff').Create(
+            outfile, img.RasterXSize, img.RasterYSize, 1, osgeo.gdal.GDT_UInt16,
+            options=['COMPRESS=ZSTD', 'TILED=YES', 'NUM_THREADS=2', 'SPARSE_OK=TRUE'])
+    output.SetProjection(img.GetProjectionRef())
+    output.SetGeoTransform(img.GetGeoTransform())
+    osgeo.gdal.RasterizeLayer(output, [1], mem_layer, options=['ATTRIBUTE=FEATURE_ID'])
+    output = None
+
+
+def write_feature_id_table(layer, outfile):
+    """Write the table of feature ID to Natural Earth names and Drawdown country name."""
+    with open(outfile, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['FeatureID', 'Index', 'SOV_A3', 'ADMIN', 'Country'])
+        for idx, feature in enumerate(layer):
+            ne_admin = feature.GetField("ADMIN")
+            admin = admin_names.lookup(ne_admin)
+            writer.writerow([idx + 1, idx, feature.GetField("SOV_A3"), ne_admin,
+                admin if admin is not None else ''])
+
+
+def process_feature_ids():
+    """Produce a single feature ID raster per resolution, instead of a mask per feature."""
+    shp_drv = osgeo.ogr.GetDriverByName("ESRI Shapefile")
+    shapefile = shp_drv.Open(shapefilename, 0)
+    layer = shapefile.GetLayerByIndex(0)
+
+    write_feature_id_table(layer=layer, outfile=geoutil.feature_id_table_filename)
+    for maskdim, imgfilename in grids.items():
+        img = osgeo.gdal.Open(imgfilename, osgeo.gdal.GA_ReadOnly)
+        outfile = geoutil.feature_id_filename(maskdim)
         print(f'{outfile}')
-        rasterize_one_feature(img=img, feature=feature, layer=layer, outfile=outfile)
+        rasterize_feature_ids(img=img, layer=layer, outfile=outfile)
 
-    img = osgeo.gdal.Open('data/Beck_KG_V1/Beck_KG_V1_present_0p5.tif', osgeo.gdal.GA_ReadOnly)
-    for idx, feature in enumerate(layer):
-        a3 = feature.GetField("SOV_A3")
-        outfile = f'masks/{a3}_{idx}_0p5_mask._tif'
+
+def process_manifests():
+    """Write a manifest for every existing mask, for masks produced before manifests existed."""
+    for maskfilename in sorted(glob.glob('masks/*_mask._tif')):
+        print(f'{geoutil.mask_manifest_filename(maskfilename)}')
+        write_mask_manifest(maskfilename)
+
+
+def process_km2_tables():
+    """Write the pixel area table for each mask grid, see geoutil.write_km2_table."""
+    for maskdim, imgfilename in grids.items():
+        img = osgeo.gdal.Open(imgfilename, osgeo.gdal.GA_ReadOnly)
+        outfile = geoutil.write_km2_table(img)
+        print(f'{maskdim}: {outfile}')
+
+
+def process_input_caches(filenames=None):
+    """Write an uncompressed copy of each input raster, see geoutil.write_input_cache.
+
+       Copies which are still up to date with their source files are left as they are, and
+       inputs which are not present are skipped. Returns the list of filenames written.
+    """
+    written = []
+    for filename in (input_cache_inputs if not filenames else filenames):
+        sources = filename if isinstance(filename, list) else [filename]
+        missing = [source for source in sources if not os.path.exists(source)]
+        if missing:
+            print(f'{missing[0]}: not found, skipped')
+            continue
+        if isinstance(filename, list):
+            img = geoutil.stack_files(filename)
+        else:
+            img = osgeo.gdal.Open(filename, osgeo.gdal.GA_ReadOnly)
+        if geoutil.input_cache(img) is not None:
+            print(f'{geoutil.input_cache_filename(img)}: up to date')
+            continue
+        outfile = geoutil.write_input_cache(img)
         print(f'{outfile}')
-        rasterize_one_feature(img=img, feature=feature, layer=layer, outfile=outfile)
+        written.append(outfile)
+    return written
 
 
 if __name__ == '__main__':
-    process_shapefile()
+    parser = argparse.ArgumentParser(description='Prepare per-feature masks and pixel areas')
+    parser.add_argument('--masks', default=False, required=False,
+                        action='store_true', help='rasterize a mask per feature')
+    parser.add_argument('--km2', default=False, required=False,
+                        action='store_true', help='write pixel area table per grid')
+    parser.add_argument('--manifests', default=False, required=False,
+                        action='store_true', help='write manifests for existing masks')
+    parser.add_argument('--feature-ids', default=False, required=False,
+                        action='store_true', help='rasterize all features into one ID raster')
+    parser.add_argument('--jobs', default=1, required=False, type=int,
+                        help='number of worker processes to rasterize masks with')
+    parser.add_argument('--grids', default=None, required=False, nargs='+',
+                        choices=list(grids.keys()), help='only rasterize masks on these grids')
+    parser.add_argument('--features', default=None, required=False, nargs='+',
+                        help='only rasterize masks of these features, by SOV_A3 or A3_IDX')
+    parser.add_argument('--input-cache', default=None, required=False, nargs='*',
+                        help='write an uncompressed, memory-mapped copy of these input rasters '
+                        '(default: every input) to skip decompressing them on each run')
+    args = parser.parse_args()
+    everything = not (args.masks or args.km2 or args.manifests or args.feature_ids or
+            args.input_cache is not None)
+
+    if args.masks or everything:
+        process_shapefile(jobs=args.jobs, maskdims=args.grids, features=args.features)
+    if args.manifests:
+        process_manifests()
+    if args.feature_ids:
+        process_feature_ids()
+    if args.km2 or everything:
+        process_km2_tables()
+    if args.input_cache is not None:
+        process_input_caches(filenames=args.input_cache)
@@ -4,6 +4,9 @@
 """Extract counts of each Köppen-Geiger/slope/land cover/soil health for each country,
    for use in Project Drawdown solution models."""
 import argparse
+import collections
+import concurrent.futures
+import fractions
 import math
 import os.path
 import pdb
@@ -11,6 +14,7 @@ import signal
 import subprocess
 import sys
 import tempfile
+import threading
 
 import osgeo.gdal
 import osgeo.gdal_array
@@ -18,8 +22,10 @@ import osgeo.ogr
 import numpy as np
 import pandas as pd
 
+import accumulator
 import admin_names
 import geoutil
+import instrument
 
 
 pd.set_option("display.max_rows", 500)
@@ -79,132 +85,362 @@ def start_pdb(sig, frame):
     pdb.Pdb().set_trace(frame)
 
 
-def populate_tmr(kg_blk):
-    regime = {}
-    regime['invalid'] = np.logical_or(kg_blk == 0, kg_blk > 30)
-    regime['tropical-humid'] = np.logical_or.reduce((kg_blk == 1, kg_blk == 2, kg_blk == 3))
-    regime['arid'] = np.logical_or(kg_blk == 4, kg_blk == 5)
-    regime['tropical-semiarid'] = np.logical_or(kg_blk == 6, kg_blk == 7)
-    regime['temperate-semiarid'] = np.logical_or.reduce((kg_blk == 8, kg_blk == 9, kg_blk == 10))
-    regime['temperate-humid'] = np.logical_or.reduce((kg_blk == 11, kg_blk == 12,
-            kg_blk == 13, kg_blk == 14, kg_blk == 15, kg_blk == 16))
-    regime['boreal-semiarid'] = np.logical_or.reduce((kg_blk == 17, kg_blk == 18,
-            kg_blk == 19, kg_blk == 20, kg_blk == 21, kg_blk == 22, kg_blk == 23, kg_blk == 24))
-    regime['boreal-humid'] = np.logical_or.reduce((kg_blk == 25,
-            kg_blk == 26, kg_blk == 27, kg_blk == 28))
-    regime['arctic'] = np.logical_or(kg_blk == 29, kg_blk == 30)
-    return regime
+def class_lut(classes, blank):
+    """Return a 256 entry lookup table mapping input pixel values to class codes.
+
+       classes is a dict of {class code: (pixel values...)}, pixel values not listed map to blank.
+    """
+    lut = np.full(256, blank, dtype=np.uint8)
+    for code, values in classes.items():
+        lut[list(values)] = code
+    return lut
+
+
+# Köppen-Geiger class to Thermal Moisture Regime
+tmr_lut = class_lut(classes={
+        C_TMR_TRHU: (1, 2, 3),
+        C_TMR_ARID: (4, 5),
+        C_TMR_TRSA: (6, 7),
+        C_TMR_TSA:  (8, 9, 10),
+        C_TMR_THU:  (11, 12, 13, 14, 15, 16),
+        C_TMR_BSA:  (17, 18, 19, 20, 21, 22, 23, 24),
+        C_TMR_BHU:  (25, 26, 27, 28),
+        C_TMR_ARTC: (29, 30),
+        }, blank=C_TMR_BLNK)
+
+# ESA CCI / Copernicus land cover class to land use
+land_use_lut = class_lut(classes={
+        C_LUS_FRST: (12, 50, 60, 61, 62, 70, 71, 72, 80, 81, 82, 90, 100, 160, 170),
+        C_LUS_CRRF: (10, 30),
+        C_LUS_CRIR: (20,),
+        C_LUS_GRSS: (11, 40, 110, 120, 121, 122, 130, 150, 151, 152, 153, 180),
+        C_LUS_BARE: (140, 200, 201, 202),
+        C_LUS_URBN: (190,),
+        C_LUS_WATR: (210,),
+        C_LUS_ICE:  (220,),
+        }, blank=C_LUS_BLNK)
+
+# FAO workability class to soil health: prime, good, marginal, barren, water
+soil_health_lut = class_lut(classes={
+        C_SLH_GOOD: (1,),
+        C_SLH_MRGN: (2,),
+        C_SLH_POOR: (3, 4, 6),
+        C_SLH_BARE: (5,),
+        C_SLH_WATR: (7,),
+        }, blank=C_SLH_BLNK)
+
+
+# Land uses which are all barren land, whatever their soil health.
+bare_land_uses = (C_LUS_BARE, C_LUS_URBN, C_LUS_ICE)
+
+
+def populate_tmr(kg_blk, out=None):
+    """Return an array of C_TMR_* codes for a block of Köppen-Geiger classes."""
+    return np.take(tmr_lut, kg_blk, out=out)
 
 
 def populate_slope(sl_blk):
+    """Return minimal, moderate and steep fractions for an (8, nrows, ncols) block of the
+       percentage of each pixel in each slope class."""
     slope = {}
-    slope['minimal'] = (sl_blk[1] + sl_blk[2] + sl_blk[3] + sl_blk[4]) / 100.0
-    slope['moderate'] = (sl_blk[5] + sl_blk[6]) / 100.0
-    slope['steep'] = (sl_blk[7] + sl_blk[8]) / 100.0
+    slope['minimal'] = sl_blk[0:4].sum(axis=0, dtype=sl_blk.dtype) / 100.0
+    slope['moderate'] = sl_blk[4:6].sum(axis=0, dtype=sl_blk.dtype) / 100.0
+    slope['steep'] = sl_blk[6:8].sum(axis=0, dtype=sl_blk.dtype) / 100.0
     return slope
 
 
-def populate_land_use(lc_blk):
-    land_use = {}
-    land_use['forest'] = np.logical_or.reduce((lc_blk == 12, lc_blk == 50,
-            lc_blk == 60, lc_blk == 61, lc_blk == 62, lc_blk == 70, lc_blk == 71, lc_blk == 72,
-            lc_blk == 80, lc_blk == 81, lc_blk == 82, lc_blk == 90, lc_blk == 100,
-            lc_blk == 160, lc_blk == 170))
-    land_use['cropland_rainfed'] = np.logical_or(lc_blk == 10, lc_blk == 30)
-    land_use['cropland_irrigated'] = (lc_blk == 20)
-    land_use['grassland'] = np.logical_or.reduce((lc_blk == 11, lc_blk == 40, lc_blk == 110,
-            lc_blk == 120, lc_blk == 121, lc_blk == 122,
-            lc_blk == 130, lc_blk == 150, lc_blk == 151, lc_blk == 152, lc_blk == 153,
-            lc_blk == 180))
-    land_use['bare'] = np.logical_or.reduce((lc_blk == 140, lc_blk == 200,
-            lc_blk == 201, lc_blk == 202))
-    land_use['urban'] = (lc_blk == 190)
-    land_use['water'] = (lc_blk == 210)
-    land_use['ice'] = (lc_blk == 220)
-    return land_use
-
-
-def populate_soil_health(wk_blk):
-    soil_health = {}
-    soil_health['prime'] = (wk_blk == 1)
-    soil_health['good'] = (wk_blk == 2)
-    soil_health['marginal'] = np.logical_or.reduce((wk_blk == 3, wk_blk == 4, wk_blk == 6))
-    soil_health['barren'] = (wk_blk == 5)
-    soil_health['water'] = (wk_blk == 7)
+def populate_land_use(lc_blk, out=None):
+    """Return an array of C_LUS_* codes for a block of land cover classes."""
+    return np.take(land_use_lut, lc_blk, out=out)
+
+
+def populate_soil_health(wk_blk, out=None):
+    """Return an array of C_SLH_* codes for a block of workability classes."""
+    return np.take(soil_health_lut, wk_blk, out=out)
+
+
+# Agro-Ecological Zone rules: (AEZ, land uses, soil healths, slope). A pixel with one of the land
+# uses and one of the soil healths contributes its share of the slope group to the AEZ, or all
+# of its area for slope 'any'. Soil health codes: C_SLH_GOOD == prime, C_SLH_MRGN == good,
+# C_SLH_POOR == marginal.
+all_land_uses = tuple(range(C_LUS_BLNK + 1))
+all_soil_healths = tuple(range(C_SLH_BLNK + 1))
+aez_rules = [
+        # Forest
+        (1,  (C_LUS_FRST,), (C_SLH_GOOD,), 'minimal'),
+        (2,  (C_LUS_FRST,), (C_SLH_MRGN,), 'minimal'),
+        (3,  (C_LUS_FRST,), (C_SLH_GOOD, C_SLH_MRGN), 'moderate'),
+        (4,  (C_LUS_FRST,), (C_SLH_GOOD, C_SLH_MRGN), 'steep'),
+        (5,  (C_LUS_FRST,), (C_SLH_POOR,), 'minimal'),
+        (6,  (C_LUS_FRST,), (C_SLH_POOR,), 'moderate'),
+        (7,  (C_LUS_FRST,), (C_SLH_POOR,), 'steep'),
+        # Grassland
+        (8,  (C_LUS_GRSS,), (C_SLH_GOOD,), 'minimal'),
+        (9,  (C_LUS_GRSS,), (C_SLH_MRGN,), 'minimal'),
+        (10, (C_LUS_GRSS,), (C_SLH_GOOD, C_SLH_MRGN), 'moderate'),
+        (11, (C_LUS_GRSS,), (C_SLH_GOOD, C_SLH_MRGN), 'steep'),
+        (12, (C_LUS_GRSS,), (C_SLH_POOR,), 'minimal'),
+        (13, (C_LUS_GRSS,), (C_SLH_POOR,), 'moderate'),
+        (14, (C_LUS_GRSS,), (C_SLH_POOR,), 'steep'),
+        # Irrigated Cropland
+        (15, (C_LUS_CRIR,), (C_SLH_GOOD,), 'minimal'),
+        (16, (C_LUS_CRIR,), (C_SLH_MRGN,), 'minimal'),
+        (17, (C_LUS_CRIR,), (C_SLH_GOOD, C_SLH_MRGN), 'moderate'),
+        (18, (C_LUS_CRIR,), (C_SLH_GOOD, C_SLH_MRGN), 'steep'),
+        (19, (C_LUS_CRIR,), (C_SLH_POOR,), 'minimal'),
+        (20, (C_LUS_CRIR,), (C_SLH_POOR,), 'moderate'),
+        (21, (C_LUS_CRIR,), (C_SLH_POOR,), 'steep'),
+        # Rainfed Cropland
+        (22, (C_LUS_CRRF,), (C_SLH_GOOD,), 'minimal'),
+        (23, (C_LUS_CRRF,), (C_SLH_MRGN,), 'minimal'),
+        (24, (C_LUS_CRRF,), (C_SLH_GOOD, C_SLH_MRGN), 'moderate'),
+        (25, (C_LUS_CRRF,), (C_SLH_GOOD, C_SLH_MRGN), 'steep'),
+        (26, (C_LUS_CRRF,), (C_SLH_POOR,), 'minimal'),
+        (27, (C_LUS_CRRF,), (C_SLH_POOR,), 'moderate'),
+        (28, (C_LUS_CRRF,), (C_SLH_POOR,), 'steep'),
+        # All Barren Land
+        (29, bare_land_uses, all_soil_healths, 'any'),
+        (29, all_land_uses, (C_SLH_BARE,), 'any'),
+        ]
+slope_groups = {'minimal': C_SLP_MIN, 'moderate': C_SLP_MOD, 'steep': C_SLP_STP, 'any': None}
+
+
+def aez_key(regime, land_use, soil_health):
+    """Combine TMR, land use and soil health code arrays into one uint16 key per pixel."""
+    key = regime.astype(np.uint16) * (C_LUS_BLNK + 1)
+    key += land_use
+    key *= (C_SLH_BLNK + 1)
+    key += soil_health
+    return key
+
+
+def compile_aez_rules(rules):
+    """Compile AEZ rules into lookup tables indexed by aez_key().
+
+       Returns (naez, column_luts, color_lut):
+       + naez is the number of AEZs per TMR.
+       + column_luts is a dict of {slope group: LUT} mapping each key to a column index of
+         tmr*naez + (AEZ - 1), or to tmr_count*naez for pixels not in any AEZ of that group.
+       + color_lut is indexed by key*4 + slope code and gives the AEZ GeoTIFF color. Where
+         several AEZs match, the highest numbered one wins.
+    """
+    naez = max(rule[0] for rule in rules)
+    nkeys = 256 * (C_LUS_BLNK + 1) * (C_SLH_BLNK + 1)
+    discard = len(tmr_state) * naez
+    column_luts = {group: np.full(nkeys, discard, dtype=np.intp) for group in slope_groups}
+    color_lut = np.full((nkeys, 4), C_TMR_BLNK, dtype=np.uint8)
+
+    for tmr_idx, tmr_code in enumerate(tmr_state.values()):
+        for aez, land_uses, soil_healths, group in rules:
+            slope_codes = [slope_groups[group]] if group != 'any' else list(range(4))
+            for lus in land_uses:
+                for slh in soil_healths:
+                    key = (tmr_code * (C_LUS_BLNK + 1) + lus) * (C_SLH_BLNK + 1) + slh
+                    column = tmr_idx * naez + aez - 1
+                    if column_luts[group][key] not in (discard, column):
+                        raise ValueError(f"AEZ rules overlap for TMR={tmr_code} land use={lus} "
+                                f"soil health={slh} slope={group}")
+                    column_luts[group][key] = column
+                    color = tmr_code + aez - 1
+                    for slp in slope_codes:
+                        if color_lut[key, slp] == C_TMR_BLNK or color_lut[key, slp] < color:
+                            color_lut[key, slp] = color
+    return naez, column_luts, color_lut.ravel()
+
+
+aez_count, aez_column_luts, aez_color_lut = compile_aez_rules(aez_rules)
+
+
+def aez_km2(regime, slope, land_use, soil_health, km2_blk):
+    """Return a vector of area per (TMR, AEZ) column in one pass over the pixels.
+
+       slope is the dict of minimal, moderate and steep fractions from populate_slope, each of
+       which is applied as the weight of its own bincount.
+    """
+    key = aez_key(regime=regime, land_use=land_use, soil_health=soil_health).ravel()
+    km2_blk = km2_blk.ravel()
+    ncolumns = len(tmr_state) * aez_count
+    km2 = np.zeros(ncolumns + 1)
+    for group, lut in aez_column_luts.items():
+        weights = km2_blk if group == 'any' else slope[group].ravel() * km2_blk
+        km2 += np.bincount(np.take(lut, key), weights=weights, minlength=ncolumns + 1)
+    return km2[:ncolumns]
+
+
+def aez_km2_fractions(regime, slope, land_use_counts, soil_health, km2_blk):
+    """Return the same vector as aez_km2, computed at 1km.
+
+       regime, slope, soil_health and km2_blk are 1km blocks. land_use_counts is the
+       (C_LUS_BLNK + 1, nrows, ncols) count of 333m pixels of each land use within each 1km
+       pixel, from geoutil.class_counts.
+    """
+    base = aez_key(regime=regime, land_use=0, soil_health=soil_health).ravel()
+    subpixel_km2 = km2_blk.ravel() / 9.0
+    ncolumns = len(tmr_state) * aez_count
+    km2 = np.zeros(ncolumns + 1)
+    for lus in range(C_LUS_BLNK + 1):
+        count = land_use_counts[lus].ravel()
+        if not count.any():
+            continue
+        key = base + lus * (C_SLH_BLNK + 1)
+        lus_km2 = count * subpixel_km2
+        for group, lut in aez_column_luts.items():
+            weights = lus_km2 if group == 'any' else slope[group].ravel() * lus_km2
+            km2 += np.bincount(np.take(lut, key), weights=weights, minlength=ncolumns + 1)
+    return km2[:ncolumns]
+
+
+def soil_health_output(soil_health, land_use):
+    """Return the SoilHealth.tif codes for soil_health, overwriting it.
+
+       SoilHealth.tif has always been written with C_SLP_BLNK for unclassified pixels, and
+       for barren soil under bare land, urban or ice, which the AEZ 29 rule used to clear
+       from the barren soil to avoid counting it twice.
+    """
+    blank = soil_health == C_SLH_BLNK
+    blank |= (soil_health == C_SLH_BARE) & np.isin(land_use, bare_land_uses)
+    soil_health[blank] = C_SLP_BLNK
     return soil_health
 
 
-def yield_AEZs(regime, tmr, slope, land_use, soil_health):
-    # AEZ1: Forest, prime, minimal
-    yield regime[tmr] * land_use['forest'] * soil_health['prime'] * slope['minimal']
-    # AEZ2: Forest, good, minimal
-    yield regime[tmr] * land_use['forest'] * soil_health['good'] * slope['minimal']
-    # AEZ3: Forest, good, moderate
-    yield regime[tmr] * land_use['forest'] * (soil_health['good'] + soil_health['prime']) * slope['moderate']
-    # AEZ4: Forest, good, steep
-    yield regime[tmr] * land_use['forest'] * (soil_health['good'] + soil_health['prime']) * slope['steep']
-    # AEZ5: Forest, marginal, minimal
-    yield regime[tmr] * land_use['forest'] * soil_health['marginal'] * slope['minimal']
-    # AEZ6: Forest, marginal, moderate
-    yield regime[tmr] * land_use['forest'] * soil_health['marginal'] * slope['moderate']
-    # AEZ7: Forest, marginal, steep
-    yield regime[tmr] * land_use['forest'] * soil_health['marginal'] * slope['steep']
-    # AEZ8: Grassland, prime, minimal
-    yield regime[tmr] * land_use['grassland'] * soil_health['prime'] * slope['minimal']
-    # AEZ9: Grassland, good, minimal
-    yield regime[tmr] * land_use['grassland'] * soil_health['good'] * slope['minimal']
-    # AEZ10: Grassland, good, moderate
-    yield regime[tmr] * land_use['grassland'] * (soil_health['good'] + soil_health['prime']) * slope['moderate']
-    # AEZ11: Grassland, good, steep
-    yield regime[tmr] * land_use['grassland'] * (soil_health['good'] + soil_health['prime']) * slope['steep']
-    # AEZ12: Grassland, marginal, minimal
-    yield regime[tmr] * land_use['grassland'] * soil_health['marginal'] * slope['minimal']
-    # AEZ13: Grassland, marginal, moderate
-    yield regime[tmr] * land_use['grassland'] * soil_health['marginal'] * slope['moderate']
-    # AEZ14: Grassland, marginal, steep
-    yield regime[tmr] * land_use['grassland'] * soil_health['marginal'] * slope['steep']
-    # AEZ15: Irrigated Cropland, prime, minimal
-    yield regime[tmr] * land_use['cropland_irrigated'] * soil_health['prime'] * slope['minimal']
-    # AEZ16: Irrigated Cropland, good, minimal
-    yield regime[tmr] * land_use['cropland_irrigated'] * soil_health['good'] * slope['minimal']
-    # AEZ17: Irrigated Cropland, good, moderate
-    yield regime[tmr] * land_use['cropland_irrigated'] * (soil_health['good'] + soil_health['prime']) * slope['moderate']
-    # AEZ18: Irrigated Cropland, good, steep
-    yield regime[tmr] * land_use['cropland_irrigated'] * (soil_health['good'] + soil_health['prime']) * slope['steep']
-    # AEZ19: Irrigated Cropland, marginal, minimal
-    yield regime[tmr] * land_use['cropland_irrigated'] * soil_health['marginal'] * slope['minimal']
-    # AEZ20: Irrigated Cropland, marginal, moderate
-    yield regime[tmr] * land_use['cropland_irrigated'] * soil_health['marginal'] * slope['moderate']
-    # AEZ21: Irrigated Cropland, marginal, steep
-    yield regime[tmr] * land_use['cropland_irrigated'] * soil_health['marginal'] * slope['steep']
-    # AEZ22: Rainfed Cropland, prime, minimal
-    yield regime[tmr] * land_use['cropland_rainfed'] * soil_health['prime'] * slope['minimal']
-    # AEZ23: Rainfed Cropland, good, minimal
-    yield regime[tmr] * land_use['cropland_rainfed'] * soil_health['good'] * slope['minimal']
-    # AEZ24: Rainfed Cropland, good, moderate
-    yield regime[tmr] * land_use['cropland_rainfed'] * (soil_health['good'] + soil_health['prime']) * slope['moderate']
-    # AEZ25: Rainfed Cropland, good, steep
-    yield regime[tmr] * land_use['cropland_rainfed'] * (soil_health['good'] + soil_health['prime']) * slope['steep']
-    # AEZ26: Rainfed Cropland, marginal, minimal
-    yield regime[tmr] * land_use['cropland_rainfed'] * soil_health['marginal'] * slope['minimal']
-    # AEZ27: Rainfed Cropland, marginal, moderate
-    yield regime[tmr] * land_use['cropland_rainfed'] * soil_health['marginal'] * slope['moderate']
-    # AEZ28: Rainfed Cropland, marginal, steep
-    yield regime[tmr] * land_use['cropland_rainfed'] * soil_health['marginal'] * slope['steep']
-    # AEZ29: All Barren Land
-    bare = land_use['bare'] + land_use['ice'] + land_use['urban']
-    barren = soil_health['barren']
-    barren[bare] = 0.0  # avoid double counting
-    yield regime[tmr] * (bare + barren)
-
-
-def produce_CSV():
-    """Produce a CSV file of Thermal Moisture Regime + Agro-Ecological Zone per country."""
+def aez_colors(regime, slope, land_use, soil_health, out=None):
+    """Return the AEZ GeoTIFF color for each pixel, given a C_SLP_* slope code array."""
+    key = aez_key(regime=regime, land_use=land_use, soil_health=soil_health)
+    key = key.astype(np.uint32) * 4 + slope
+    return np.take(aez_color_lut, key, out=out)
+
+
+def classify_upsampled(x, y, ncols, nrows, kg_band, lc_band, sl_stack, wk_band):
+    """Return dict of the classified inputs of one 1km block, upsampled to 333m."""
+    pool = geoutil.buffer_pool
+    shape = (3*nrows, 3*ncols)
+    k = kg_band.ReadAsArray(x, y, ncols, nrows)
+    kg_blk = geoutil.upsample(k, 3, out=pool.scratch('kg', shape, k.dtype))
+    regime = populate_tmr(kg_blk, out=pool.scratch('regime', shape, np.uint8))
+
+    s = sl_stack.ReadAsArray(x, y, ncols, nrows)
+    slope = populate_slope(geoutil.upsample(s, 3,
+            out=pool.scratch('slope', (s.shape[0],) + shape, s.dtype)))
+
+    lc_blk = lc_band.ReadAsArray(3*x, 3*y, 3*ncols, 3*nrows)
+    land_use = populate_land_use(lc_blk, out=pool.scratch('land_use', shape, np.uint8))
+
+    w = wk_band.ReadAsArray(x, y, ncols, nrows)
+    wk_blk = geoutil.upsample(w, 3, out=pool.scratch('wk', shape, w.dtype))
+    soil_health = populate_soil_health(wk_blk, out=pool.scratch('soil_health', shape, np.uint8))
+    return {'regime': regime, 'slope': slope, 'land_use': land_use, 'soil_health': soil_health}
+
+
+def km2_upsampled(classes, km2_blk):
+    """Return the aez_km2 vector of a block from classify_upsampled, given its 1km areas."""
+    km2_blk = geoutil.upsample(km2_blk, 3,
+            out=geoutil.buffer_pool.scratch('km2', classes['regime'].shape, np.float64))
+    km2_blk /= 9.0
+    return aez_km2(km2_blk=km2_blk, **classes)
+
+
+def block_km2_upsampled(x, y, ncols, nrows, km2_blk, kg_band, lc_band, sl_stack, wk_band):
+    """Return the aez_km2 vector for one 1km block, upsampling the 1km inputs to 333m."""
+    classes = classify_upsampled(x=x, y=y, ncols=ncols, nrows=nrows, kg_band=kg_band,
+            lc_band=lc_band, sl_stack=sl_stack, wk_band=wk_band)
+    return km2_upsampled(classes=classes, km2_blk=km2_blk)
+
+
+def classify_fractions(x, y, ncols, nrows, kg_band, lc_band, sl_stack, wk_band):
+    """Return dict of the classified inputs of one 1km block, with land use as counts."""
+    pool = geoutil.buffer_pool
+    shape = (nrows, ncols)
+    regime = populate_tmr(kg_band.ReadAsArray(x, y, ncols, nrows),
+            out=pool.scratch('regime', shape, np.uint8))
+    slope = populate_slope(sl_stack.ReadAsArray(x, y, ncols, nrows))
+    lc_blk = lc_band.ReadAsArray(3*x, 3*y, 3*ncols, 3*nrows)
+    land_use = populate_land_use(lc_blk, out=pool.scratch('land_use', lc_blk.shape, np.uint8))
+    land_use_counts = geoutil.class_counts(codes=land_use, nclasses=C_LUS_BLNK + 1, factor=3)
+    soil_health = populate_soil_health(wk_band.ReadAsArray(x, y, ncols, nrows),
+            out=pool.scratch('soil_health', shape, np.uint8))
+    return {'regime': regime, 'slope': slope, 'land_use_counts': land_use_counts,
+            'soil_health': soil_health}
+
+
+def km2_fractions(classes, km2_blk):
+    """Return the aez_km2 vector of a block from classify_fractions, given its areas."""
+    return aez_km2_fractions(km2_blk=km2_blk, **classes)
+
+
+def block_km2_fractions(x, y, ncols, nrows, km2_blk, kg_band, lc_band, sl_stack, wk_band):
+    """Return the aez_km2 vector for one 1km block, without upsampling to 333m."""
+    classes = classify_fractions(x=x, y=y, ncols=ncols, nrows=nrows, kg_band=kg_band,
+            lc_band=lc_band, sl_stack=sl_stack, wk_band=wk_band)
+    return km2_fractions(classes=classes, km2_blk=km2_blk)
+
+
+def accumulate_block_major(acc, features, bands, inputs, lc_fractions=False, decodes=None,
+        instruments=instrument.disabled):
+    """Accumulate the AEZ areas of every country into acc, reading each input block once.
+
+       bands is the dict of kg_band, lc_band, sl_stack and wk_band. Each window populated in
+       any country mask is classified once and then reduced for every mask within it.
+    """
+    masks = {}
+    maskimgs = []
+    for idx, feature in enumerate(features):
+        admin = admin_names.lookup(feature.GetField("ADMIN"))
+        if admin is None:
+            continue
+        a3 = feature.GetField("SOV_A3")
+        maskfilename = f"masks/{a3}_{idx}_1km_mask._tif"
+        maskimg = osgeo.gdal.Open(maskfilename, osgeo.gdal.GA_ReadOnly)
+        maskimgs.append(maskimg)
+        masks[(idx, admin)] = (maskfilename, instruments.band(maskimg.GetRasterBand(1)),
+                geoutil.geometry_envelopes(feature.GetGeometryRef()))
+    rows = {key: acc.row(key[1]) for key in masks}
+
+    print(f"Processing {len(masks)} 1km masks")
+    maskfilename, mask_band, _ = next(iter(masks.values()))
+    x_winsiz, y_winsiz = geoutil.plan_window(inputs=[(mask_band, 1)] + inputs,
+            x_siz=mask_band.XSize, y_siz=mask_band.YSize)
+    with instruments.stage('populated'):
+        windows = geoutil.shared_windows(masks=masks, x_winsiz=x_winsiz, y_winsiz=y_winsiz)
+    instruments.count('blocks', len(windows))
+    instruments.count('blocks_skipped', math.ceil(mask_band.XSize / x_winsiz) *
+            math.ceil(mask_band.YSize / y_winsiz) - len(windows))
+    classify = classify_fractions if lc_fractions else classify_upsampled
+    km2_fn = km2_fractions if lc_fractions else km2_upsampled
+    with instruments.profile():
+        for x, y, ncols, nrows, members in windows:
+            if decodes is not None:
+                decodes.add(inputs=inputs, x=x, y=y, ncols=ncols, nrows=nrows)
+            with instruments.stage('classify'):
+                classes = classify(x=x, y=y, ncols=ncols, nrows=nrows, **bands)
+            km2_blk = geoutil.km2_block(nrows=nrows, ncols=ncols, y_off=y, img=maskimgs[0])
+            out = geoutil.buffer_pool.scratch('mask', (nrows, ncols), np.uint8)
+            for key, full in members:
+                with instruments.stage('km2'):
+                    mask_blk = geoutil.read_mask_block(band=masks[key][1], x=x, y=y,
+                            ncols=ncols, nrows=nrows, full=full, out=out)
+                    k = geoutil.mask_km2(mask_blk=mask_blk, km2_blk=km2_blk)
+                with instruments.stage('classify'):
+                    km2 = km2_fn(classes=classes, km2_blk=k)
+                with instruments.stage('accumulate'):
+                    acc.add(rows[key], km2)
+            instruments.count('masks_applied', len(members))
+
+
+def produce_CSV(lc_fractions=False, decodes=None, instruments=instrument.disabled,
+        block_major=False):
+    """Produce a CSV file of Thermal Moisture Regime + Agro-Ecological Zone per country.
+
+       With lc_fractions, each 3x3 window of 333m land cover is reduced to counts of each land
+       use and all arithmetic is done on the 1km grid, rather than upsampling the 1km inputs.
+       Tile decompressions of the inputs are counted in decodes, if given, and stage timings
+       and block counts are recorded in instruments. Decoded input tiles are kept in
+       geoutil.tile_cache, as neighbouring countries share many of them. With block_major,
+       the inputs are traversed once for all countries, see accumulate_block_major().
+    """
     columns = []
     for tmr in tmr_state.keys():
-        columns.extend([f"{tmr}|AEZ{x}" for x in range(1, 30)])
-    df = pd.DataFrame(columns=columns, dtype='float')
-    df.index.name = 'Country'
+        columns.extend([f"{tmr}|AEZ{x}" for x in range(1, aez_count + 1)])
+    acc = accumulator.Accumulator(columns=columns)
 
     countrycsvfilename = 'results/AEZ-by-country.csv'
     shapefilename = 'data/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
@@ -216,68 +452,69 @@ def produce_CSV():
     assert shapefile.GetLayerCount() == 1
     features = shapefile.GetLayerByIndex(0)
     kg_img = osgeo.gdal.Open(kg_filename, osgeo.gdal.GA_ReadOnly)
-    kg_band = kg_img.GetRasterBand(1)
+    kg_band = instruments.band(geoutil.PooledBand(kg_img.GetRasterBand(1),
+            cache=geoutil.tile_cache))
     lc_img = osgeo.gdal.Open(lc_filename, osgeo.gdal.GA_ReadOnly)
-    lc_band = lc_img.GetRasterBand(1)
+    lc_band = instruments.band(geoutil.PooledBand(lc_img.GetRasterBand(1),
+            cache=geoutil.tile_cache))
     sl_img = osgeo.gdal.Open(sl_filename, osgeo.gdal.GA_ReadOnly)
-    sl_band = {}
-    for idx in range(1, 9):
-        sl_band[idx] = sl_img.GetRasterBand(idx)
+    sl_stack = instruments.band(geoutil.BandStack(sl_img, cache=geoutil.tile_cache))
     wk_img = osgeo.gdal.Open(wk_filename, osgeo.gdal.GA_ReadOnly)
-    wk_band = wk_img.GetRasterBand(1)
-
-    for idx, feature in enumerate(features):
-        admin = admin_names.lookup(feature.GetField("ADMIN"))
-        if admin is None:
-            continue
-        a3 = feature.GetField("SOV_A3")
-        if admin not in df.index:
-            df.loc[admin] = [0] * len(df.columns)
-
-        print(f"Processing {admin:<41} #{a3}_{idx}")
-        maskfilename = f"masks/{a3}_{idx}_1km_mask._tif"
-        maskimg = osgeo.gdal.Open(maskfilename, osgeo.gdal.GA_ReadOnly)
-        mask_band = maskimg.GetRasterBand(1)
-        x_siz = mask_band.XSize
-        y_siz = mask_band.YSize
-        x_blksiz, y_blksiz = mask_band.GetBlockSize()
-        for y in range(0, y_siz, y_blksiz):
-            nrows = geoutil.blklim(coord=y, blksiz=y_blksiz, totsiz=y_siz)
-            for x in range(0, x_siz, x_blksiz):
-                ncols = geoutil.blklim(coord=x, blksiz=x_blksiz, totsiz=x_siz)
-                if geoutil.is_sparse(band=mask_band, x=x, y=y, ncols=ncols, nrows=nrows):
-                    # sparse hole in image, no data to process
-                    continue
-
-                mask_blk = mask_band.ReadAsArray(x, y, ncols, nrows)
-                k = geoutil.km2_block(nrows=nrows, ncols=ncols, y_off=y, img=maskimg)
-                k[np.logical_not(mask_blk)] = 0.0
-                km2_blk = (np.repeat(np.repeat(k, 3, axis=1), 3, axis=0)) / 9.0
-
-                k = kg_band.ReadAsArray(x, y, ncols, nrows)
-                kg_blk = np.repeat(np.repeat(k, 3, axis=1), 3, axis=0)
-                regime = populate_tmr(kg_blk)
-
-                sl_blk = {}
-                for idx in range(1, 9):
-                    s = sl_band[idx].ReadAsArray(x, y, ncols, nrows)
-                    sl_blk[idx] = np.repeat(np.repeat(s, 3, axis=1), 3, axis=0)
-                slope = populate_slope(sl_blk)
-
-                lc_blk = lc_band.ReadAsArray(3*x, 3*y, 3*ncols, 3*nrows)
-                land_use = populate_land_use(lc_blk)
-
-                w = wk_band.ReadAsArray(x, y, ncols, nrows)
-                wk_blk = np.repeat(np.repeat(w, 3, axis=1), 3, axis=0)
-                soil_health = populate_soil_health(wk_blk)
-
-                for tmr in tmr_state.keys():
-                    n = 1
-                    for aez in yield_AEZs(regime=regime, tmr=tmr, slope=slope, land_use=land_use,
-                            soil_health=soil_health):
-                        df.loc[admin, f"{tmr}|AEZ{n}"] += (aez * km2_blk).sum()
-                        n += 1
-
+    wk_band = instruments.band(geoutil.PooledBand(wk_img.GetRasterBand(1),
+            cache=geoutil.tile_cache))
+    allocations = geoutil.buffer_pool.allocations
+    tiles = geoutil.tile_cache.stats()
+    inputs = ([(kg_band, 1), (lc_band, fractions.Fraction(1, 3))] +
+            [(band, 1) for band in sl_stack.bands] + [(wk_band, 1)])
+
+    if block_major:
+        bands = {'kg_band': kg_band, 'lc_band': lc_band, 'sl_stack': sl_stack, 'wk_band': wk_band}
+        accumulate_block_major(acc=acc, features=features, bands=bands, inputs=inputs,
+                lc_fractions=lc_fractions, decodes=decodes, instruments=instruments)
+    else:
+        for idx, feature in enumerate(features):
+            admin = admin_names.lookup(feature.GetField("ADMIN"))
+            if admin is None:
+                continue
+            a3 = feature.GetField("SOV_A3")
+            row = acc.row(admin)
+
+            print(f"Processing {admin:<41} #{a3}_{idx}")
+            maskfilename = f"masks/{a3}_{idx}_1km_mask._tif"
+            with instruments.country(admin), instruments.profile():
+                maskimg = osgeo.gdal.Open(maskfilename, osgeo.gdal.GA_ReadOnly)
+                mask_band = instruments.band(geoutil.PooledBand(maskimg.GetRasterBand(1)))
+                x_winsiz, y_winsiz = geoutil.plan_window(inputs=[(mask_band, 1)] + inputs,
+                        x_siz=mask_band.XSize, y_siz=mask_band.YSize)
+                with instruments.stage('populated'):
+                    windows = geoutil.populated_windows(maskfilename, mask_band,
+                            x_winsiz=x_winsiz, y_winsiz=y_winsiz,
+                            envelopes=geoutil.geometry_envelopes(feature.GetGeometryRef()))
+                instruments.count('blocks', len(windows))
+                instruments.count('blocks_skipped', math.ceil(mask_band.XSize / x_winsiz) *
+                        math.ceil(mask_band.YSize / y_winsiz) - len(windows))
+                for x, y, ncols, nrows, full in windows:
+                    if decodes is not None:
+                        decodes.add(inputs=inputs, x=x, y=y, ncols=ncols, nrows=nrows)
+                    with instruments.stage('km2'):
+                        mask_blk = geoutil.read_mask_block(band=mask_band, x=x, y=y, ncols=ncols,
+                                nrows=nrows, full=full)
+                        k = geoutil.km2_block(nrows=nrows, ncols=ncols, y_off=y, img=maskimg)
+                        k = geoutil.mask_km2(mask_blk=mask_blk, km2_blk=k)
+                    with instruments.stage('classify'):
+                        block_km2 = block_km2_fractions if lc_fractions else block_km2_upsampled
+                        km2 = block_km2(x=x, y=y, ncols=ncols, nrows=nrows, km2_blk=k,
+                                kg_band=kg_band, lc_band=lc_band, sl_stack=sl_stack,
+                                wk_band=wk_band)
+                    with instruments.stage('accumulate'):
+                        acc.add(row, km2)
+    instruments.count('buffer_allocations', geoutil.buffer_pool.allocations - allocations)
+    tiles = geoutil.tile_cache.stats(since=tiles)
+    geoutil.tile_cache.report(tiles)
+    for name, n in tiles.items():
+        instruments.count(f'tile_cache_{name}', n)
+
+    df = acc.to_dataframe()
     df.sort_index(axis='index').to_csv(countrycsvfilename, float_format='%.2f')
 
     regions = ['OECD90', 'Eastern Europe', 'Asia (Sans Japan)', 'Middle East and Africa',
@@ -395,22 +632,129 @@ def create_soil_health_GeoTIFF(ref_img, filename):
     return out
 
 
-def produce_GeoTIFF():
-    """Produce a GeoTIFF file of Thermal Moisture Regime + Agro-Ecological Zone."""
+class TileClassifier:
+    """Classify tiles of the land cover grid into AEZ, slope, land use and soil health.
+
+       GDAL dataset handles must not be shared between threads, so each thread which calls
+       classify() opens its own handles on first use.
+    """
+    def __init__(self, kg_filename, lc_filename, sl_filename, wk_filename,
+            instruments=instrument.disabled):
+        self.kg_filename = kg_filename
+        self.lc_filename = lc_filename
+        self.sl_filename = sl_filename
+        self.wk_filename = wk_filename
+        self.instruments = instruments
+        self.local = threading.local()
+
+    def bands(self):
+        """Return the input bands for the calling thread, with the slope classes as a BandStack."""
+        local = self.local
+        if not hasattr(local, 'kg_band'):
+            def band(b):
+                return self.instruments.band(geoutil.PooledBand(b))
+            local.kg_img = osgeo.gdal.Open(self.kg_filename, osgeo.gdal.GA_ReadOnly)
+            local.kg_band = band(local.kg_img.GetRasterBand(1))
+            local.lc_img = osgeo.gdal.Open(self.lc_filename, osgeo.gdal.GA_ReadOnly)
+            local.lc_band = band(local.lc_img.GetRasterBand(1))
+            local.sl_img = osgeo.gdal.Open(self.sl_filename, osgeo.gdal.GA_ReadOnly)
+            local.sl_stack = self.instruments.band(geoutil.BandStack(local.sl_img))
+            local.wk_img = osgeo.gdal.Open(self.wk_filename, osgeo.gdal.GA_ReadOnly)
+            local.wk_band = band(local.wk_img.GetRasterBand(1))
+        return local.kg_band, local.lc_band, local.sl_stack, local.wk_band
+
+    def classify(self, window):
+        """Return (x, y, aez, slope, land_use, soil_health) arrays for one tile."""
+        with self.instruments.stage('classify'):
+            return self._classify(window)
+
+    def _classify(self, window):
+        x, y, ncols, nrows = window
+        kg_band, lc_band, sl_stack, wk_band = self.bands()
+
+        x3 = int(x/3)
+        y3 = int(y/3)
+        ncols3 = int(ncols/3)
+        nrows3 = int(nrows/3)
+
+        pool = geoutil.buffer_pool
+        shape = (nrows, ncols)
+        k = kg_band.ReadAsArray(x3, y3, ncols3, nrows3)
+        kg_blk = geoutil.upsample(k, 3, out=pool.scratch('kg', shape, k.dtype))
+        regime = populate_tmr(kg_blk, out=pool.scratch('regime', shape, np.uint8))
+
+        s = sl_stack.ReadAsArray(x3, y3, ncols3, nrows3)
+        slope = populate_slope(geoutil.upsample(s, 3,
+                out=pool.scratch('slope', (s.shape[0],) + shape, s.dtype)))
+        plurality = {}
+        plurality['steep'] = ((slope['steep'] >= slope['moderate']) &
+                (slope['steep'] >= slope['minimal']))
+        plurality['moderate'] = ((slope['moderate'] > slope['steep']) &
+                (slope['moderate'] >= slope['minimal']))
+        plurality['minimal'] = ((slope['minimal'] > slope['steep']) &
+                (slope['minimal'] >= slope['moderate']))
+        slope = plurality
+
+        # the outputs are written after later tiles have been classified, so they are taken
+        # from the pool and given back by the writer rather than being scratch arrays.
+        lc_blk = lc_band.ReadAsArray(x, y, ncols, nrows)
+        land_use = populate_land_use(lc_blk, out=pool.take(shape, np.uint8))
+
+        k = wk_band.ReadAsArray(x3, y3, ncols3, nrows3)
+        wk_blk = geoutil.upsample(k, 3, out=pool.scratch('wk', shape, k.dtype))
+        soil_health = populate_soil_health(wk_blk, out=pool.take(shape, np.uint8))
+
+        slope_out = pool.take(shape, np.uint8)
+        slope_out.fill(C_SLP_BLNK)
+        slope_out[slope['minimal']] = C_SLP_MIN
+        slope_out[slope['moderate']] = C_SLP_MOD
+        slope_out[slope['steep']] = C_SLP_STP
+
+        aez_out = aez_colors(regime=regime, slope=slope_out, land_use=land_use,
+                soil_health=soil_health, out=pool.take(shape, np.uint8))
+
+        land_use_out = land_use
+        soil_health_out = soil_health_output(soil_health=soil_health, land_use=land_use)
+        return (x, y, aez_out, slope_out, land_use_out, soil_health_out)
+
+
+def classified_tiles(classifier, windows, threads):
+    """Yield classifier.classify(window) for each window, in order.
+
+       With threads > 1 tiles are classified concurrently, but results are still yielded in
+       the order of windows so that the output files are written exactly as in a serial run.
+       At most 2 * threads tiles are in flight at once, bounding memory use.
+    """
+    if threads <= 1:
+        for window in windows:
+            yield classifier.classify(window)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = collections.deque()
+        for window in windows:
+            pending.append(executor.submit(classifier.classify, window))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def produce_GeoTIFF(threads=1, decodes=None, instruments=instrument.disabled):
+    """Produce a GeoTIFF file of Thermal Moisture Regime + Agro-Ecological Zone.
+
+       Tiles are classified by threads worker threads, and written by the calling thread.
+       Tile decompressions of the inputs are counted in decodes, if given, and stage timings
+       and tile counts are recorded in instruments.
+    """
     kg_filename = 'data/Beck_KG_V1/Beck_KG_V1_present_0p0083.tif'
     lc_filename = 'data/copernicus/C3S-LC-L4-LCCS-Map-300m-P1Y-2018-v2.1.1.tif'
     sl_filename = 'data/ConsolidatedSlope.tif'
     wk_filename = 'data/FAO/workability_FAO_sq7_1km.tif'
-    kg_img = osgeo.gdal.Open(kg_filename, osgeo.gdal.GA_ReadOnly)
-    kg_band = kg_img.GetRasterBand(1)
-    lc_img = osgeo.gdal.Open(lc_filename, osgeo.gdal.GA_ReadOnly)
-    lc_band = lc_img.GetRasterBand(1)
-    sl_img = osgeo.gdal.Open(sl_filename, osgeo.gdal.GA_ReadOnly)
-    sl_band = {}
-    for idx in range(1, 9):
-        sl_band[idx] = sl_img.GetRasterBand(idx)
-    wk_img = osgeo.gdal.Open(wk_filename, osgeo.gdal.GA_ReadOnly)
-    wk_band = wk_img.GetRasterBand(1)
+    classifier = TileClassifier(kg_filename=kg_filename, lc_filename=lc_filename,
+            sl_filename=sl_filename, wk_filename=wk_filename, instruments=instruments)
+    kg_band, lc_band, sl_stack, wk_band = classifier.bands()
+    lc_img = lc_band.GetDataset()
 
     aez_f = create_AEZ_GeoTIFF(ref_img=lc_img, filename='results/AEZ.tif')
     slope_f = create_slope_GeoTIFF(ref_img=lc_img, filename='results/Slope.tif')
@@ -419,77 +763,29 @@ def produce_GeoTIFF():
 
     x_siz = lc_band.XSize
     y_siz = lc_band.YSize
-    x_blksiz, y_blksiz = (768, 768)
-
-    for y in range(0, y_siz, y_blksiz):
-        print('.', end='', flush=True)
-        nrows = geoutil.blklim(coord=y, blksiz=y_blksiz, totsiz=y_siz)
-        for x in range(0, x_siz, x_blksiz):
-            ncols = geoutil.blklim(coord=x, blksiz=x_blksiz, totsiz=x_siz)
-
-            x3 = int(x/3)
-            y3 = int(y/3)
-            ncols3 = int(ncols/3)
-            nrows3 = int(nrows/3)
-
-            k = kg_band.ReadAsArray(x3, y3, ncols3, nrows3)
-            kg_blk = np.repeat(np.repeat(k, 3, axis=1), 3, axis=0)
-            regime = populate_tmr(kg_blk)
-
-            sl_blk = {}
-            for idx in range(1, 9):
-                s = sl_band[idx].ReadAsArray(x3, y3, ncols3, nrows3)
-                sl_blk[idx] = np.repeat(np.repeat(s, 3, axis=1), 3, axis=0)
-
-            slope = populate_slope(sl_blk)
-            plurality = {}
-            plurality['steep'] = ((slope['steep'] >= slope['moderate']) &
-                    (slope['steep'] >= slope['minimal']))
-            plurality['moderate'] = ((slope['moderate'] > slope['steep']) &
-                    (slope['moderate'] >= slope['minimal']))
-            plurality['minimal'] = ((slope['minimal'] > slope['steep']) &
-                    (slope['minimal'] >= slope['moderate']))
-            slope = plurality
-
-            lc_blk = lc_band.ReadAsArray(x, y, ncols, nrows)
-            land_use = populate_land_use(lc_blk)
-
-            k = wk_band.ReadAsArray(x3, y3, ncols3, nrows3)
-            wk_blk = np.repeat(np.repeat(k, 3, axis=1), 3, axis=0)
-            soil_health = populate_soil_health(wk_blk)
-
-            outarray = np.full((nrows, ncols), C_TMR_BLNK)
-            for tmr, color in tmr_state.items():
-                for aez in yield_AEZs(regime=regime, tmr=tmr, slope=slope, land_use=land_use,
-                        soil_health=soil_health):
-                    outarray[aez.astype(bool)] = color
-                    color += 1
-            aez_f.GetRasterBand(1).WriteArray(outarray, xoff=x, yoff=y)
-
-            outarray = np.full((nrows, ncols), C_SLP_BLNK)
-            outarray[slope['minimal'].astype(bool)] = C_SLP_MIN
-            outarray[slope['moderate'].astype(bool)] = C_SLP_MOD
-            outarray[slope['steep'].astype(bool)] = C_SLP_STP
-            slope_f.GetRasterBand(1).WriteArray(outarray, xoff=x, yoff=y)
-
-            outarray = np.full((nrows, ncols), C_LUS_BLNK)
-            outarray[land_use['forest'].astype(bool)] = C_LUS_FRST
-            outarray[land_use['cropland_rainfed'].astype(bool)] = C_LUS_CRRF
-            outarray[land_use['cropland_irrigated'].astype(bool)] = C_LUS_CRIR
-            outarray[land_use['grassland'].astype(bool)] = C_LUS_GRSS
-            outarray[land_use['bare'].astype(bool)] = C_LUS_BARE
-            outarray[land_use['urban'].astype(bool)] = C_LUS_URBN
-            outarray[land_use['water'].astype(bool)] = C_LUS_WATR
-            outarray[land_use['ice'].astype(bool)] = C_LUS_ICE
-            land_use_f.GetRasterBand(1).WriteArray(outarray, xoff=x, yoff=y)
-
-            outarray = np.full((nrows, ncols), C_SLP_BLNK)
-            outarray[soil_health['prime'].astype(bool)] = C_SLH_GOOD
-            outarray[soil_health['good'].astype(bool)] = C_SLH_MRGN
-            outarray[soil_health['marginal'].astype(bool)] = C_SLH_POOR
-            outarray[soil_health['barren'].astype(bool)] = C_SLH_BARE
-            outarray[soil_health['water'].astype(bool)] = C_SLH_WATR
-            soil_health_f.GetRasterBand(1).WriteArray(outarray, xoff=x, yoff=y)
+    inputs = ([(lc_band, 1), (kg_band, 3)] + [(band, 3) for band in sl_stack.bands] +
+            [(wk_band, 3)])
+    x_winsiz, y_winsiz = geoutil.plan_window(inputs=[(aez_f.GetRasterBand(1), 1)] + inputs,
+            x_siz=x_siz, y_siz=y_siz)
+    windows = geoutil.windows(x_siz=x_siz, y_siz=y_siz, x_winsiz=x_winsiz, y_winsiz=y_winsiz)
+    if decodes is not None:
+        for x, y, ncols, nrows in windows:
+            decodes.add(inputs=inputs, x=x, y=y, ncols=ncols, nrows=nrows)
+
+    allocations = geoutil.buffer_pool.allocations
+    with instruments.profile():
+        for x, y, aez, slope, land_use, soil_health in classified_tiles(classifier=classifier,
+                windows=windows, threads=threads):
+            if x == 0:
+                print('.', end='', flush=True)
+            with instruments.stage('write'):
+                aez_f.GetRasterBand(1).WriteArray(aez, xoff=x, yoff=y)
+                slope_f.GetRasterBand(1).WriteArray(slope, xoff=x, yoff=y)
+                land_use_f.GetRasterBand(1).WriteArray(land_use, xoff=x, yoff=y)
+                soil_health_f.GetRasterBand(1).WriteArray(soil_health, xoff=x, yoff=y)
+            geoutil.buffer_pool.give(aez, slope, land_use, soil_health)
+            instruments.count('blocks')
+    instruments.count('buffer_allocations', geoutil.buffer_pool.allocations - allocations)
 
     aez_f = None
     slope_f = None
@@ -510,7 +806,55 @@ def produce_PNGs():
 
 if __name__ == '__main__':
     signal.signal(signal.SIGUSR1, start_pdb)
+    # GDAL may have read GDAL_CACHEMAX already, so set it directly as well.
     os.environ['GDAL_CACHEMAX'] = '128'
-    produce_CSV()
-    produce_GeoTIFF()
+    osgeo.gdal.SetCacheMax(128 * 1024 * 1024)
+
+    parser = argparse.ArgumentParser(description='Produce AEZ CSV and GeoTIFF files')
+    parser.add_argument('--threads', default=1, required=False, type=int,
+                        help='number of threads to classify GeoTIFF tiles with')
+    parser.add_argument('--lc-fractions', default=False, required=False,
+                        action='store_true', help='compute the CSV at 1km using counts of '
+                        'each land use within the 1km pixel, instead of upsampling to 333m')
+    parser.add_argument('--window-budget', default=None, required=False, type=int,
+                        help='MiB of input data to read per processing window')
+    parser.add_argument('--tile-cache', default=None, required=False, type=int,
+                        help='MiB of decoded input tiles to keep across countries, 0 to disable')
+    parser.add_argument('--decode-report', default=False, required=False,
+                        action='store_true', help='report decompressions per input tile')
+    parser.add_argument('--instrument', default=None, required=False,
+                        help='write stage timings and block counts to this JSON or .csv file')
+    parser.add_argument('--profile', default=None, required=False,
+                        help='write cProfile statistics of the block loops to this file')
+    parser.add_argument('--block-major', default=False, required=False,
+                        action='store_true', help='produce the CSV reading each input block '
+                        'once for all countries, instead of once per country')
+    args = parser.parse_args()
+
+    if args.window_budget is not None:
+        geoutil.window_budget = args.window_budget * 1024 * 1024
+    if args.tile_cache is not None:
+        geoutil.tile_cache.budget = args.tile_cache * 1024 * 1024
+    instruments = instrument.disabled
+    if args.instrument or args.profile:
+        instruments = instrument.Instruments(profile=bool(args.profile))
+
+    decodes = geoutil.TileDecodes() if args.decode_report else None
+    produce_CSV(lc_fractions=args.lc_fractions, decodes=decodes,
+            instruments=instruments.section('CSV'), block_major=args.block_major)
+    if decodes is not None:
+        print("CSV tile decompressions:")
+        decodes.report()
+
+    decodes = geoutil.TileDecodes() if args.decode_report else None
+    produce_GeoTIFF(threads=args.threads, decodes=decodes,
+            instruments=instruments.section('GeoTIFF'))
+    if decodes is not None:
+        print("\nGeoTIFF tile decompressions:")
+        decodes.report()
     produce_PNGs()
+
+    if args.instrument:
+        instruments.write(args.instrument)
+    if args.profile:
+        instruments.write_profile(args.profile)
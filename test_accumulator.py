@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+import accumulator
+
+
+def test_row():
+    acc = accumulator.Accumulator(columns=['a', 'b'])
+    assert acc.row('France') == 0
+    assert acc.row('Spain') == 1
+    assert acc.row('France') == 0
+    for n in range(100):
+        acc.row(f'country{n}')
+    assert acc.row('Spain') == 1
+    assert acc.data.shape[0] >= 102
+
+
+def test_add_and_to_dataframe():
+    acc = accumulator.Accumulator(columns=['a', 'b'])
+    row = acc.row('France')
+    acc.add(row, np.array([1.0, 2.0]))
+    acc.add(row, np.array([0.5, 0.5]))
+    acc.row('Spain')
+    df = acc.to_dataframe()
+    assert df.index.name == 'Country'
+    assert list(df.columns) == ['a', 'b']
+    assert df.loc['France', 'a'] == pytest.approx(1.5)
+    assert df.loc['France', 'b'] == pytest.approx(2.5)
+    assert df.loc['Spain'].sum() == 0.0
+
+
+def test_merge():
+    acc1 = accumulator.Accumulator(columns=[1, 2])
+    acc1.add(acc1.row('France'), np.array([1.0, 2.0]))
+    acc2 = accumulator.Accumulator(columns=[1, 2])
+    acc2.add(acc2.row('Spain'), np.array([3.0, 4.0]))
+    acc2.add(acc2.row('France'), np.array([1.0, 1.0]))
+    acc1.merge(acc2)
+    df = acc1.to_dataframe()
+    assert df.loc['France', 1] == pytest.approx(2.0)
+    assert df.loc['Spain', 2] == pytest.approx(4.0)
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+import degraded_analysis as da
+
+
+class ArrayBand:
+    """Band reading windows of a numpy array, standing in for a GDAL band."""
+    def __init__(self, array):
+        self.array = array
+
+    def ReadAsArray(self, x, y, ncols, nrows):
+        return self.array[y:y + nrows, x:x + ncols]
+
+
+def test_lc_fractions_matches_upsampled():
+    rng = np.random.default_rng(14)
+    lccs = [0, 10, 12, 20, 30, 40, 50, 100, 140, 160, 190, 200, 210, 220, 255]
+    bands = {'lc_band': ArrayBand(rng.choice(lccs, (24, 30)).astype(np.uint8)),
+            'lpd_band': ArrayBand(rng.integers(0, 4, (8, 10)).astype(np.int16)),
+            'wk_band': ArrayBand(rng.integers(0, 7, (8, 10)).astype(np.uint8))}
+    km2_blk = rng.random((5, 6))
+    upsampled = da.block_km2_upsampled(x=2, y=1, ncols=6, nrows=5, km2_blk=km2_blk, **bands)
+    fractions = da.block_km2_fractions(x=2, y=1, ncols=6, nrows=5, km2_blk=km2_blk, **bands)
+    assert upsampled.sum() > 0
+    assert fractions == pytest.approx(upsampled)
@@ -3,8 +3,10 @@ import os.path
 import pytest
 import tempfile
 
+import numpy as np
 import osgeo.gdal
 import pandas as pd
+import accumulator
 import extract_country_data as ecd
 
 import admin_names
@@ -300,6 +302,138 @@ def test_wk():
     assert 'United States of America' in df.index
     assert df['United States of America'] > 1
 
+class ArrayBand:
+    """Band reading windows of a numpy array, standing in for a GDAL band."""
+    def __init__(self, array):
+        self.array = array
+
+    def ReadAsArray(self, x, y, ncols, nrows):
+        return self.array[y:y + nrows, x:x + ncols]
+
+def test_lookup_km2():
+    rng = np.random.default_rng(5)
+    lookupobj = ecd.KGlookup.__new__(ecd.KGlookup)
+    lookupobj.columns = list(ecd.KGlookup.kg_colors.values())
+    ncolumns = len(lookupobj.columns)
+    # palette indexes 0..ncolumns-1 are the classes, the rest are blank.
+    lookupobj.lut = np.full(256, ncolumns, dtype=np.uint8)
+    lookupobj.lut[:ncolumns] = np.arange(ncolumns)
+    lookupobj.band = ArrayBand(rng.integers(0, ncolumns + 5, size=(12, 16), dtype=np.uint8))
+    x, y, ncols, nrows = 3, 2, 11, 9
+    pixels = lookupobj.band.array[y:y + nrows, x:x + ncols]
+    labels = rng.integers(0, 4, size=(nrows, ncols), dtype=np.uint16)
+    km2block = rng.uniform(0.5, 1.5, size=(nrows, ncols))
+
+    expected = np.zeros((4, ncolumns))
+    for r in range(nrows):
+        for c in range(ncols):
+            if pixels[r, c] < ncolumns:
+                expected[labels[r, c], pixels[r, c]] += km2block[r, c]
+    km2 = lookupobj.km2_by_label(x=x, y=y, ncols=ncols, nrows=nrows, labelblock=labels,
+            km2block=km2block, nlabels=4)
+    np.testing.assert_allclose(km2, expected)
+
+    acc = accumulator.Accumulator(lookupobj.columns)
+    row = acc.row('Country')
+    lookupobj.km2(x=x, y=y, ncols=ncols, nrows=nrows, maskblock=(labels == 2) * 255,
+            km2block=km2block, acc=acc, row=row)
+    lookupobj.km2(x=x, y=y, ncols=ncols, nrows=nrows, maskblock=(labels == 3),
+            km2block=km2block, acc=acc, row=row)
+    np.testing.assert_allclose(acc.data[row], expected[2] + expected[3])
+
+def test_fused():
+    lookupobjs = [ecd.WorkabilityLookup('data/FAO/test_small.tif', maskdim='0p5'),
+            ecd.KGlookup('data/Beck_KG_V1/Beck_KG_V1_present_0p5.tif', maskdim='0p5')]
+    csvfiles = [tempfile.NamedTemporaryFile(), tempfile.NamedTemporaryFile()]
+    fused = ecd.process_maps(lookupobjs=lookupobjs, csvfilenames=[f.name for f in csvfiles])
+    for lookupobj, df in zip(lookupobjs, fused):
+        csvfile = tempfile.NamedTemporaryFile()
+        expected = ecd.process_map(lookupobj=lookupobj, csvfilename=csvfile.name)
+        assert df.values.sum() > 0
+        pd.testing.assert_frame_equal(df, expected)
+
+def test_block_major():
+    mapfilename = 'data/FAO/test_small.tif'
+    lookupobj = ecd.WorkabilityLookup(mapfilename, maskdim='0p5')
+    csvfile = tempfile.NamedTemporaryFile()
+    expected = ecd.process_map(lookupobj=lookupobj, csvfilename=csvfile.name)
+    df = ecd.process_map(lookupobj=lookupobj, csvfilename=csvfile.name, block_major=True)
+    pd.testing.assert_frame_equal(df, expected)
+
+@pytest.mark.parametrize("kwargs", [{'labels': True, 'jobs': 2}, {'labels': True, 'cache': True},
+        {'block_major': True, 'jobs': 2}, {'block_major': True, 'cache': True},
+        {'labels': True, 'block_major': True}])
+def test_process_map_rejects_ignored_options(kwargs):
+    with pytest.raises(ValueError):
+        ecd.process_map(lookupobj=None, csvfilename=None, **kwargs)
+
+def test_digest_covers_shared_code(monkeypatch):
+    class FakeLookup(ecd.Lookup):
+        def get_columns(self):
+            return ['a', 'b']
+        def bands(self):
+            return []
+
+    digest = FakeLookup().digest()
+    assert FakeLookup().digest() == digest
+    monkeypatch.setattr(ecd, 'result_cache_version', ecd.result_cache_version + 1)
+    assert FakeLookup().digest() != digest
+    monkeypatch.undo()
+    monkeypatch.setattr(ecd, 'result_cache_functions', lambda: [ecd.output_by_region])
+    assert FakeLookup().digest() != digest
+
+def test_result_cache(tmp_path, monkeypatch):
+    class FakeLookup:
+        maskdim = '1km'
+        version = 'v1'
+        def digest(self):
+            return self.version
+        def get_columns(self):
+            return ['a', 'b']
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ecd.geoutil, 'digests_filename', str(tmp_path / 'digests.json'))
+    monkeypatch.setattr(ecd.geoutil, '_digests', None)
+    os.mkdir('masks')
+    with open(ecd.mask_filename(idx=0, a3='AAA', maskdim='1km'), 'wb') as f:
+        f.write(b'mask')
+    lookupobj = FakeLookup()
+    features = [(0, 'AAA', 'Aland')]
+
+    accs = [ecd.accumulator.Accumulator(columns=lookupobj.get_columns())]
+    pending = ecd.pending_features(lookupobjs=[lookupobj], features=features, accs=accs,
+            cache=True)
+    assert len(pending) == 1
+    idx, a3, admin, ns, filenames = pending[0]
+    partial = ecd.accumulator.Accumulator(columns=lookupobj.get_columns())
+    partial.add(partial.row(admin), [1.0, 2.0])
+    ecd.merge_results(accs=accs, admin=admin, ns=ns, filenames=filenames, partials=[partial])
+
+    accs = [ecd.accumulator.Accumulator(columns=lookupobj.get_columns())]
+    assert ecd.pending_features(lookupobjs=[lookupobj], features=features, accs=accs,
+            cache=True) == []
+    assert list(accs[0].to_dataframe().loc['Aland']) == [1.0, 2.0]
+
+    lookupobj.version = 'v2'
+    assert len(ecd.pending_features(lookupobjs=[lookupobj], features=features, accs=accs,
+            cache=True)) == 1
+    lookupobj.version = 'v1'
+    with open(ecd.mask_filename(idx=0, a3='AAA', maskdim='1km'), 'wb') as f:
+        f.write(b'changed mask')
+    assert len(ecd.pending_features(lookupobjs=[lookupobj], features=features, accs=accs,
+            cache=True)) == 1
+
+def test_long_format():
+    df2008 = pd.DataFrame([[1.0, 2.0], [3.0, 4.0]], index=['Spain', 'France'], columns=[10, 20])
+    df2008.index.name = 'Country'
+    df2009 = df2008 * 10
+    df = ecd.long_format(years=[2008, 2009], dfs=[df2008, df2009])
+    assert list(df.columns) == ['Country', 'Year', 'LCCS', 'km2']
+    assert len(df) == 8
+    assert list(df.iloc[0]) == ['France', 2008, 10, 3.0]
+    assert list(df.iloc[3]) == ['France', 2009, 20, 40.0]
+    assert list(df.iloc[7]) == ['Spain', 2009, 20, 20.0]
+
 
 # From https://www.cia.gov/library/publications/the-world-factbook/rankorder/2147rank.html
 expected_area = {
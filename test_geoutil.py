@@ -1,5 +1,9 @@
+import json
+import os.path
+
 import numpy as np
 import osgeo.gdal
+import osgeo.ogr
 import pytest
 
 import geoutil
@@ -28,3 +32,318 @@ def test_blklim():
     assert geoutil.blklim(coord=0, blksiz=256, totsiz=1024) == 256
     assert geoutil.blklim(coord=768, blksiz=256, totsiz=1024) == 256
     assert geoutil.blklim(coord=900, blksiz=256, totsiz=1024) == 124
+
+def test_km2_rows():
+    gt = (-180.0, 0.008333333333333, 0.0, 90.0, 0.0, -0.008333333333333)
+    rows = geoutil.km2_rows(gt, 10700, 200)
+    assert rows.shape == (200,)
+    assert not rows.flags.writeable
+    # rows get smaller moving away from the equator
+    assert rows[0] < rows[-1]
+    assert (geoutil.km2_rows(gt, 10700, 200) == rows).all()
+    img = osgeo.gdal.Open(imgfilename, osgeo.gdal.GA_ReadOnly)
+    block = geoutil.km2_block(nrows=4, ncols=3, y_off=10700, img=img)
+    assert block.shape == (4, 3)
+    assert (block[:, 0] == block[:, 2]).all()
+
+
+def test_write_km2_table(tmp_path, monkeypatch):
+    monkeypatch.setattr(geoutil, 'km2_dirname', str(tmp_path))
+    monkeypatch.setattr(geoutil, '_km2_tables', {})
+    img = osgeo.gdal.Open(imgfilename, osgeo.gdal.GA_ReadOnly)
+    gt = img.GetGeoTransform()
+    expected = geoutil.km2_rows(gt, 100, 50).copy()
+    filename = geoutil.write_km2_table(img)
+    assert os.path.exists(filename)
+    actual = geoutil.km2_rows(gt, 100, 50)
+    assert isinstance(actual, np.memmap)
+    assert actual == pytest.approx(expected)
+
+def test_populated_blocks(tmp_path):
+    img = osgeo.gdal.Open(imgfilename, osgeo.gdal.GA_ReadOnly)
+    band = img.GetRasterBand(1)
+    blocks = geoutil.populated_blocks(imgfilename, band)
+    # approximate center of the US.
+    assert any(x in (9728, 9984) and y in (5888, 6144) for x, y, _, _, _ in blocks)
+    assert (0, 0, 256, 256, False) not in blocks
+
+    maskfilename = str(tmp_path / 'XXX_0_1km_mask._tif')
+    open(maskfilename, 'w').close()
+    with open(geoutil.mask_manifest_filename(maskfilename), 'w') as f:
+        json.dump({'blocksize': [256, 256], 'blocks': [[0, 0], [43008, 21504]],
+            'full': [[0, 0]]}, f)
+    blocks = geoutil.populated_blocks(maskfilename, band)
+    assert blocks == [(0, 0, 256, 256, True), (43008, 21504, 192, 96, False)]
+
+def test_km2_by_label():
+    labels = np.array([[0, 1, 1], [2, 2, 1]])
+    classes = np.array([[0, 1, 3], [0, 2, 1]])
+    km2block = np.broadcast_to(np.array([[1.0], [10.0]]), (2, 3))
+    actual = geoutil.km2_by_label(labels=labels, classes=classes, km2block=km2block,
+            nlabels=3, nclasses=3)
+    expected = np.array([[1.0, 0.0, 0.0], [0.0, 11.0, 0.0], [10.0, 0.0, 10.0]])
+    assert actual == pytest.approx(expected)
+
+def test_lookup_block():
+    lut = np.full(256, 7, dtype=np.uint8)
+    lut[1:8] = np.arange(7)
+    block = np.array([[0, 1, 7], [8, 300, -2]], dtype=np.int16)
+    classes = geoutil.lookup_block(lut, block)
+    assert classes.dtype == np.uint8
+    assert classes.tolist() == [[7, 0, 6], [7, 7, 7]]
+    assert geoutil.lookup_block(lut, block) is classes
+
+def test_class_counts():
+    codes = np.array([[0, 0, 1, 2, 2, 2],
+                      [0, 1, 1, 2, 9, 2],
+                      [0, 0, 0, 2, 2, 2]])
+    counts = geoutil.class_counts(codes=codes, nclasses=3, factor=3)
+    assert counts.shape == (3, 1, 2)
+    assert list(counts[:, 0, 0]) == [6, 3, 0]
+    assert list(counts[:, 0, 1]) == [0, 0, 8]
+
+def test_km2_by_label_percent():
+    labels = np.array([[0, 1, 1], [2, 2, 1]])
+    percents = np.array([[[100, 50, 0], [10, 0, 25]],
+                         [[0, 50, 100], [90, 100, 75]]], dtype=np.uint8)
+    km2block = np.broadcast_to(np.array([[1.0], [10.0]]), (2, 3))
+    actual = geoutil.km2_by_label_percent(labels=labels, percents=percents, km2block=km2block,
+            nlabels=4)
+    expected = np.array([[1.0, 0.0], [3.0, 9.0], [1.0, 19.0], [0.0, 0.0]])
+    assert actual == pytest.approx(expected)
+
+def test_band_stack(tmp_path):
+    filenames = []
+    for b in range(3):
+        filename = str(tmp_path / f'class{b}.tif')
+        img = osgeo.gdal.GetDriverByName('GTiff').Create(filename, 8, 4, 1, osgeo.gdal.GDT_Byte)
+        img.GetRasterBand(1).WriteArray(np.full((4, 8), b * 10, dtype=np.uint8))
+        img = None
+        filenames.append(filename)
+    stack = geoutil.BandStack(geoutil.stack_files(filenames))
+    assert len(stack.bands) == 3
+    block = stack.ReadAsArray(2, 1, 4, 2)
+    assert block.shape == (3, 2, 4)
+    assert list(block[:, 0, 0]) == [0, 10, 20]
+    assert stack.ReadAsArray(0, 0, 4, 2) is block
+    assert stack.ReadAsArray(0, 0, 8, 4).shape == (3, 4, 8)
+
+def test_buffer_pool():
+    pool = geoutil.BufferPool()
+    a = pool.take((2, 3), np.uint8)
+    pool.give(a)
+    assert pool.take((2, 3), np.uint8) is a
+    assert pool.take((2, 3), np.float64).dtype == np.float64
+    assert pool.scratch('km2', (4, 4), np.float64) is pool.scratch('km2', (4, 4), np.float64)
+    assert pool.allocations == 3
+    pool.scratch('km2', (2, 2), np.float64)
+    assert pool.allocations == 4
+
+def test_pooled_band():
+    img = osgeo.gdal.GetDriverByName('MEM').Create('', 8, 4, 1, osgeo.gdal.GDT_UInt16)
+    img.GetRasterBand(1).WriteArray(np.arange(32, dtype=np.uint16).reshape(4, 8))
+    pool = geoutil.BufferPool()
+    band = geoutil.PooledBand(img.GetRasterBand(1), pool=pool)
+    block = band.ReadAsArray(2, 1, 3, 2)
+    assert block.dtype == np.uint16
+    assert block.tolist() == [[10, 11, 12], [18, 19, 20]]
+    assert band.ReadAsArray(0, 0, 3, 2) is block
+    assert band.XSize == 8
+    for x in range(0, 6):
+        band.ReadAsArray(x, 0, 3, 2)
+    assert pool.allocations == 1
+
+def test_tile_cache():
+    cache = geoutil.TileCache(budget=20)
+    reads = []
+    def read(n):
+        reads.append(n)
+        return np.zeros(n, dtype=np.uint8)
+    assert cache.get('a', lambda: read(8)).nbytes == 8
+    cache.get('b', lambda: read(8))
+    cache.get('a', lambda: read(8))
+    cache.get('c', lambda: read(8))
+    # 'b' was least recently used, so it was evicted to make room for 'c'.
+    assert list(cache.tiles.keys()) == ['a', 'c']
+    assert not cache.get('a', lambda: read(8)).flags.writeable
+    assert reads == [8, 8, 8]
+    assert cache.stats() == {'hits': 2, 'misses': 3, 'evictions': 1}
+    since = cache.stats()
+    cache.get('d', lambda: read(30))
+    assert 'd' not in cache.tiles
+    assert cache.stats(since=since) == {'hits': 0, 'misses': 1, 'evictions': 0}
+
+def test_pooled_band_tile_cache(tmp_path):
+    img = create_tiled(str(tmp_path / 'tiled.tif'), x_siz=40, y_siz=24, blksiz=16)
+    data = np.arange(40 * 24, dtype=np.uint8).reshape(24, 40)
+    img.GetRasterBand(1).WriteArray(data)
+    cache = geoutil.TileCache(budget=1024 * 1024)
+    band = geoutil.PooledBand(img.GetRasterBand(1), pool=geoutil.BufferPool(), cache=cache)
+    assert (band.ReadAsArray(10, 5, 25, 19) == data[5:24, 10:35]).all()
+    assert cache.stats()['misses'] == 6
+    assert (band.ReadAsArray(0, 0, 16, 16) == data[0:16, 0:16]).all()
+    assert cache.stats() == {'hits': 1, 'misses': 6, 'evictions': 0}
+
+def test_tile_cache_unnamed_datasets():
+    cache = geoutil.TileCache(budget=1024 * 1024)
+    for value in range(50):
+        img = osgeo.gdal.GetDriverByName('MEM').Create('', 16, 16, 1, osgeo.gdal.GDT_Byte)
+        img.GetRasterBand(1).Fill(value)
+        band = geoutil.PooledBand(img.GetRasterBand(1), pool=geoutil.BufferPool(), cache=cache)
+        # freed datasets may be reused at the same address, which must not alias their tiles.
+        assert (band.ReadAsArray(0, 0, 16, 16) == value).all()
+        band = img = None
+    assert cache.stats()['hits'] == 0
+
+def test_tile_cache_stacks(tmp_path):
+    filenames = []
+    for value in range(2):
+        filename = str(tmp_path / f'class{value}.tif')
+        img = create_tiled(filename, x_siz=32, y_siz=32, blksiz=16)
+        img.GetRasterBand(1).Fill(value)
+        img = None
+        filenames.append(filename)
+    cache = geoutil.TileCache(budget=1024 * 1024)
+    stack = geoutil.BandStack(geoutil.stack_files(filenames), cache=cache)
+    assert stack.ReadAsArray(0, 0, 32, 32)[:, 0, 0].tolist() == [0, 1]
+    reversed_stack = geoutil.BandStack(geoutil.stack_files(filenames[::-1]), cache=cache)
+    assert reversed_stack.ReadAsArray(0, 0, 32, 32)[:, 0, 0].tolist() == [1, 0]
+    band = geoutil.PooledBand(osgeo.gdal.Open(filenames[1]).GetRasterBand(1), cache=cache)
+    assert band.ReadAsArray(0, 0, 32, 32).shape == (32, 32)
+    assert len({stack.key, reversed_stack.key, band.key}) == 3
+
+def test_input_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(geoutil, 'input_cache_dirname', str(tmp_path / 'inputs'))
+    monkeypatch.setattr(geoutil, '_input_caches', {})
+    filename = str(tmp_path / 'slope.tif')
+    img = osgeo.gdal.GetDriverByName('GTiff').Create(filename, 40, 24, 8, osgeo.gdal.GDT_Byte,
+            options=['TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16', 'COMPRESS=DEFLATE'])
+    data = np.arange(8 * 24 * 40, dtype=np.uint8).reshape(8, 24, 40)
+    for b in range(8):
+        img.GetRasterBand(b + 1).WriteArray(data[b])
+    img = None
+    img = osgeo.gdal.Open(filename, osgeo.gdal.GA_ReadOnly)
+    assert geoutil.input_cache(img) is None
+    geoutil.write_input_cache(img)
+    assert (geoutil.input_cache(img) == data).all()
+
+    stack = geoutil.BandStack(img)
+    block = stack.ReadAsArray(3, 2, 30, 20)
+    assert (block == data[:, 2:22, 3:33]).all()
+    assert not block.flags.writeable
+    band = geoutil.PooledBand(img.GetRasterBand(3))
+    assert (band.ReadAsArray(3, 2, 30, 20) == data[2, 2:22, 3:33]).all()
+
+    # rewriting the source makes the copy stale.
+    st = os.stat(filename)
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    monkeypatch.setattr(geoutil, '_input_caches', {})
+    assert geoutil.input_cache(img) is None
+    assert geoutil.BandStack(img).mapped is None
+
+def test_upsample():
+    block = np.arange(6, dtype=np.uint8).reshape(2, 3)
+    out = np.empty((6, 9), dtype=np.uint8)
+    assert geoutil.upsample(block, 3, out=out) is out
+    assert (out == np.repeat(np.repeat(block, 3, axis=1), 3, axis=0)).all()
+    stack = np.stack([block, block + 10])
+    out = np.empty((2, 4, 6), dtype=np.uint8)
+    geoutil.upsample(stack, 2, out=out)
+    assert (out == np.repeat(np.repeat(stack, 2, axis=2), 2, axis=1)).all()
+
+def test_mask_km2():
+    mask = np.array([[0, 1, 255], [1, 0, 0]], dtype=np.uint8)
+    km2 = np.broadcast_to(np.array([[1.0], [10.0]]), (2, 3))
+    assert (geoutil.mask_km2(mask_blk=mask, km2_blk=km2) == np.where(mask, km2, 0.0)).all()
+
+def test_mask_work(tmp_path):
+    small = str(tmp_path / 'AAA_0_1km_mask._tif')
+    large = str(tmp_path / 'BBB_1_1km_mask._tif')
+    for maskfilename, nblocks in [(small, 1), (large, 3)]:
+        open(maskfilename, 'w').close()
+        with open(geoutil.mask_manifest_filename(maskfilename), 'w') as f:
+            json.dump({'blocksize': [256, 256], 'blocks': [[0, 0]] * nblocks, 'full': []}, f)
+    assert geoutil.mask_work(small) == 1
+    assert geoutil.mask_work(large) == 3
+    assert geoutil.mask_work(str(tmp_path / 'nonexistent._tif')) == 0
+
+def test_populated_windows(tmp_path):
+    img = osgeo.gdal.Open(imgfilename, osgeo.gdal.GA_ReadOnly)
+    band = img.GetRasterBand(1)
+    maskfilename = str(tmp_path / 'XXX_0_1km_mask._tif')
+    open(maskfilename, 'w').close()
+    with open(geoutil.mask_manifest_filename(maskfilename), 'w') as f:
+        json.dump({'blocksize': [256, 256],
+            'blocks': [[0, 0], [256, 0], [0, 256], [256, 256], [512, 512], [43008, 21504]],
+            'full': [[0, 0], [256, 0], [0, 256], [256, 256], [512, 512]]}, f)
+    windows = geoutil.populated_windows(maskfilename, band, x_winsiz=512, y_winsiz=512)
+    assert windows == [(0, 0, 512, 512, True), (512, 512, 512, 512, False),
+            (43008, 21504, 192, 96, False)]
+    assert (geoutil.populated_windows(maskfilename, band, x_winsiz=256, y_winsiz=256) ==
+            geoutil.populated_blocks(maskfilename, band))
+
+def test_shared_windows(tmp_path):
+    img = osgeo.gdal.Open(imgfilename, osgeo.gdal.GA_ReadOnly)
+    band = img.GetRasterBand(1)
+    masks = {}
+    for key, blocks, full in [('AAA', [[0, 0], [512, 512]], [[0, 0]]),
+            ('BBB', [[512, 512], [512, 0]], [])]:
+        maskfilename = str(tmp_path / f'{key}_0_1km_mask._tif')
+        open(maskfilename, 'w').close()
+        with open(geoutil.mask_manifest_filename(maskfilename), 'w') as f:
+            json.dump({'blocksize': [256, 256], 'blocks': blocks, 'full': full}, f)
+        masks[key] = (maskfilename, band, None)
+    windows = geoutil.shared_windows(masks=masks, x_winsiz=256, y_winsiz=256)
+    assert windows == [(0, 0, 256, 256, [('AAA', True)]), (512, 0, 256, 256, [('BBB', False)]),
+            (512, 512, 256, 256, [('AAA', False), ('BBB', False)])]
+
+def test_geometry_envelopes():
+    geometry = osgeo.ogr.CreateGeometryFromWkt('MULTIPOLYGON (((0 0, 2 0, 2 1, 0 0)),'
+            '((10 10, 11 10, 11 12, 10 10)))')
+    assert geoutil.geometry_envelopes(geometry) == [(0, 2, 0, 1), (10, 11, 10, 12)]
+    # wider than a hemisphere, split at 0 degrees.
+    geometry = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-179 0, 179 0, 179 1, -179 1, -179 0))')
+    assert sorted(geoutil.geometry_envelopes(geometry)) == [(-179, 0, 0, 1), (0, 179, 0, 1)]
+    assert geoutil.geometry_envelopes(None) == []
+
+def test_envelope_windows():
+    gt = (-180.0, 0.1, 0.0, 90.0, 0.0, -0.1)
+    # the first two overlap and are merged, the third is far away.
+    envelopes = [(10, 40, 10, 12), (30, 31, 10, 30), (-100, -99, -50, -49)]
+    windows = geoutil.envelope_windows(envelopes=envelopes, geotransform=gt, x_siz=3600,
+            y_siz=1800, x_blksiz=256, y_blksiz=256)
+    assert windows == [(1792, 512, 512, 512), (768, 1280, 256, 256)]
+    # windows are clipped to the image.
+    windows = geoutil.envelope_windows(envelopes=[(170, 180, -90, -80)], geotransform=gt,
+            x_siz=3600, y_siz=1800, x_blksiz=256, y_blksiz=256)
+    assert windows == [(3328, 1536, 272, 264)]
+
+def create_tiled(filename, x_siz, y_siz, blksiz):
+    drv = osgeo.gdal.GetDriverByName('GTiff')
+    img = drv.Create(filename, xsize=x_siz, ysize=y_siz, bands=1, eType=osgeo.gdal.GDT_Byte,
+            options=['TILED=YES', f'BLOCKXSIZE={blksiz}', f'BLOCKYSIZE={blksiz}'])
+    return img
+
+def test_plan_window(tmp_path):
+    fine = create_tiled(str(tmp_path / 'fine.tif'), x_siz=3072, y_siz=1536, blksiz=96)
+    coarse = create_tiled(str(tmp_path / 'coarse.tif'), x_siz=1024, y_siz=512, blksiz=256)
+    inputs = [(fine.GetRasterBand(1), 1), (coarse.GetRasterBand(1), 3)]
+    assert geoutil.plan_window(inputs=inputs, x_siz=3072, y_siz=1536) == (768, 768)
+    # too large for the budget, keeps alignment with the first input and whole coarse pixels.
+    x_winsiz, y_winsiz = geoutil.plan_window(inputs=inputs, x_siz=3072, y_siz=1536,
+            budget=200000)
+    assert (x_winsiz, y_winsiz) == (768, 192)
+
+def test_tile_decodes(tmp_path):
+    fine = create_tiled(str(tmp_path / 'fine.tif'), x_siz=3072, y_siz=1536, blksiz=96)
+    coarse = create_tiled(str(tmp_path / 'coarse.tif'), x_siz=1024, y_siz=512, blksiz=256)
+    inputs = [(fine.GetRasterBand(1), 1), (coarse.GetRasterBand(1), 3)]
+    decodes = geoutil.TileDecodes()
+    for x, y, ncols, nrows in geoutil.windows(x_siz=768, y_siz=768, x_winsiz=768,
+            y_winsiz=192):
+        decodes.add(inputs=inputs, x=x, y=y, ncols=ncols, nrows=nrows)
+    fine_counts = decodes.counts[geoutil.band_name(fine.GetRasterBand(1))]
+    coarse_counts = decodes.counts[geoutil.band_name(coarse.GetRasterBand(1))]
+    assert set(fine_counts.values()) == {1}
+    assert len(fine_counts) == 64
+    assert coarse_counts == {(0, 0): 4}
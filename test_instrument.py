@@ -0,0 +1,84 @@
+import csv
+import json
+import pickle
+import time
+
+import numpy as np
+
+import instrument
+
+
+class Band:
+    XSize = 4
+
+    def ReadAsArray(self, x, y, ncols, nrows):
+        time.sleep(0.01)
+        return np.zeros((nrows, ncols), dtype=np.uint16)
+
+
+def test_stages_nest():
+    instruments = instrument.Instruments()
+    band = instruments.band(Band())
+    with instruments.stage('classify'):
+        block = band.ReadAsArray(0, 0, 3, 2)
+        time.sleep(0.02)
+    assert block.shape == (2, 3)
+    assert band.XSize == 4
+    assert instruments.calls == {'read': 1, 'classify': 1}
+    assert instruments.seconds['read'] >= 0.01
+    assert instruments.seconds['classify'] >= 0.02
+    assert instruments.seconds['classify'] < 0.02 + instruments.seconds['read']
+    assert instruments.counters['bytes_read'] == 12
+
+
+def test_merge_and_pickle():
+    instruments = instrument.Instruments()
+    instruments.count('blocks', 2)
+    with instruments.country('France'):
+        pass
+    worker = instrument.Instruments()
+    worker.count('blocks', 3)
+    with worker.section('CSV').stage('accumulate'):
+        pass
+    with worker.country('France'):
+        pass
+    instruments.merge(pickle.loads(pickle.dumps(worker)))
+    assert instruments.counters['blocks'] == 5
+    assert instruments.sections['CSV'].calls['accumulate'] == 1
+    assert list(instruments.countries.keys()) == ['France']
+
+
+def test_write(tmp_path):
+    instruments = instrument.Instruments()
+    instruments.count('blocks_skipped', 7)
+    with instruments.section('GeoTIFF').stage('write'):
+        pass
+    instruments.write(str(tmp_path / 'report.json'))
+    with open(tmp_path / 'report.json') as f:
+        report = json.load(f)
+    assert report['counters'] == {'blocks_skipped': 7}
+    assert report['sections']['GeoTIFF']['stages']['write']['calls'] == 1
+
+    instruments.write(str(tmp_path / 'report.csv'))
+    with open(tmp_path / 'report.csv') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['Section', 'Kind', 'Name', 'Value']
+    assert ['', 'counter', 'blocks_skipped', '7'] in rows
+    assert ['GeoTIFF', 'calls', 'write', '1'] in rows
+
+
+def test_profile(tmp_path):
+    instruments = instrument.Instruments(profile=True)
+    with instruments.section('CSV').profile():
+        sum(range(1000))
+    instruments.write_profile(str(tmp_path / 'profile.out'))
+    assert (tmp_path / 'profile.out').exists()
+
+
+def test_disabled():
+    disabled = instrument.disabled
+    band = Band()
+    assert disabled.band(band) is band
+    assert disabled.section('CSV') is disabled
+    with disabled.country('France'), disabled.profile(), disabled.stage('read'):
+        disabled.count('blocks')
@@ -0,0 +1,101 @@
+import json
+
+import numpy as np
+import osgeo.gdal
+import osgeo.ogr
+import osgeo.osr
+
+import geoutil
+import prepare_feature_masks as pfm
+
+
+def create_grid(x_siz, y_siz):
+    img = osgeo.gdal.GetDriverByName('MEM').Create('', x_siz, y_siz, 1, osgeo.gdal.GDT_Byte)
+    srs = osgeo.osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    img.SetProjection(srs.ExportToWkt())
+    img.SetGeoTransform((-180.0, 360.0 / x_siz, 0.0, 90.0, 0.0, -180.0 / y_siz))
+    return img
+
+
+def create_layer(wkt):
+    srs = osgeo.osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    data_source = osgeo.ogr.GetDriverByName('Memory').CreateDataSource('test')
+    layer = data_source.CreateLayer('test', srs=srs, geom_type=osgeo.ogr.wkbMultiPolygon)
+    feature = osgeo.ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(osgeo.ogr.CreateGeometryFromWkt(wkt))
+    layer.CreateFeature(feature)
+    return data_source, layer, feature
+
+
+def test_feature_windows():
+    img = create_grid(x_siz=3600, y_siz=1800)
+    geometry = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((10 10, 20 10, 20 15, 10 10))')
+    # 10 pixels per degree, so x 1900..2000 and y 750..800 widened to blocks of 256.
+    assert pfm.feature_windows(img=img, geometry=geometry, x_blksiz=256, y_blksiz=256) == [
+            (1792, 512, 256, 512)]
+    geometry = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((170 -80, 180 -80, 180 -90, 170 -80))')
+    assert pfm.feature_windows(img=img, geometry=geometry, x_blksiz=256, y_blksiz=256) == [
+            (3328, 1536, 272, 264)]
+    # parts on either side of the antimeridian stay separate windows.
+    geometry = osgeo.ogr.CreateGeometryFromWkt('MULTIPOLYGON (((170 60, 180 60, 180 70, 170 60)),'
+            '((-180 60, -170 60, -170 70, -180 60)))')
+    assert pfm.feature_windows(img=img, geometry=geometry, x_blksiz=256, y_blksiz=256) == [
+            (0, 0, 256, 512), (3328, 0, 272, 512)]
+
+
+def test_rasterize_one_feature(tmp_path):
+    img = create_grid(x_siz=3600, y_siz=1800)
+    wkt = ('MULTIPOLYGON (((10.03 10.01, 40.07 12.02, 25.04 33.3, 10.03 10.01)),'
+           '((-70 -50, -60 -50, -60 -40, -70 -40, -70 -50)),'
+           '((179.5 65, 180 65, 180 66, 179.5 65)), ((-180 65, -179.2 65, -180 66, -180 65)))')
+    data_source, layer, feature = create_layer(wkt)
+    outfile = str(tmp_path / 'XXX_0_test_mask._tif')
+    pfm.rasterize_one_feature(img=img, feature=feature, layer=layer, outfile=outfile)
+
+    expected = create_grid(x_siz=3600, y_siz=1800)
+    osgeo.gdal.RasterizeLayer(expected, [1], layer)
+    mask = osgeo.gdal.Open(outfile, osgeo.gdal.GA_ReadOnly)
+    assert (mask.GetRasterBand(1).ReadAsArray() == expected.GetRasterBand(1).ReadAsArray()).all()
+
+    with open(geoutil.mask_manifest_filename(outfile)) as f:
+        manifest = json.load(f)
+    assert manifest['pixels'] == int(np.count_nonzero(expected.GetRasterBand(1).ReadAsArray()))
+    assert [1024, 1280] in manifest['blocks']
+
+
+def test_mask_tasks(tmp_path, monkeypatch):
+    gridfilename = str(tmp_path / 'grid.tif')
+    osgeo.gdal.GetDriverByName('GTiff').CreateCopy(gridfilename, create_grid(3600, 1800))
+    monkeypatch.setattr(pfm, 'grids', {'test': gridfilename})
+    data_source = osgeo.ogr.GetDriverByName('Memory').CreateDataSource('test')
+    layer = data_source.CreateLayer('test', geom_type=osgeo.ogr.wkbPolygon)
+    layer.CreateField(osgeo.ogr.FieldDefn('SOV_A3', osgeo.ogr.OFTString))
+    for wkt in ['POLYGON ((10 10, 20 10, 20 15, 10 10))', 'POLYGON ((0 0, 1 0, 1 1, 0 0))']:
+        feature = osgeo.ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('SOV_A3', 'AAA')
+        feature.SetGeometry(osgeo.ogr.CreateGeometryFromWkt(wkt))
+        layer.CreateFeature(feature)
+
+    tasks = pfm.mask_tasks(layer=layer)
+    assert [(t[0], t[1], t[2]) for t in tasks] == [('test', 0, 'masks/AAA_0_test_mask._tif'),
+            ('test', 1, 'masks/AAA_1_test_mask._tif')]
+    assert tasks[0][3] == 256 * 512
+    assert tasks[1][3] == 256 * 256
+    assert [t[1] for t in pfm.mask_tasks(layer=layer, features=['AAA_1'])] == [1]
+    assert pfm.mask_tasks(layer=layer, maskdims=['1km']) == []
+
+
+def test_process_input_caches(tmp_path, monkeypatch):
+    monkeypatch.setattr(geoutil, 'input_cache_dirname', str(tmp_path / 'inputs'))
+    monkeypatch.setattr(geoutil, '_input_caches', {})
+    filename = str(tmp_path / 'input.tif')
+    osgeo.gdal.GetDriverByName('GTiff').CreateCopy(filename, create_grid(36, 18))
+    missing = str(tmp_path / 'missing.tif')
+    monkeypatch.setattr(pfm, 'input_cache_inputs', [missing, filename, [filename, missing]])
+    written = pfm.process_input_caches()
+    assert len(written) == 1
+    img = osgeo.gdal.Open(filename, osgeo.gdal.GA_ReadOnly)
+    assert written[0] == geoutil.input_cache_filename(img)
+    assert pfm.process_input_caches() == []
@@ -0,0 +1,287 @@
+import itertools
+
+import numpy as np
+import osgeo.gdal
+import pytest
+
+import geoutil
+import process_imagery as pi
+
+
+def populate_tmr(kg_blk):
+    """The Thermal Moisture Regime classifier as originally written."""
+    regime = {}
+    regime['invalid'] = np.logical_or(kg_blk == 0, kg_blk > 30)
+    regime['tropical-humid'] = np.logical_or.reduce((kg_blk == 1, kg_blk == 2, kg_blk == 3))
+    regime['arid'] = np.logical_or(kg_blk == 4, kg_blk == 5)
+    regime['tropical-semiarid'] = np.logical_or(kg_blk == 6, kg_blk == 7)
+    regime['temperate-semiarid'] = np.logical_or.reduce((kg_blk == 8, kg_blk == 9, kg_blk == 10))
+    regime['temperate-humid'] = np.logical_or.reduce((kg_blk == 11, kg_blk == 12,
+            kg_blk == 13, kg_blk == 14, kg_blk == 15, kg_blk == 16))
+    regime['boreal-semiarid'] = np.logical_or.reduce((kg_blk == 17, kg_blk == 18,
+            kg_blk == 19, kg_blk == 20, kg_blk == 21, kg_blk == 22, kg_blk == 23, kg_blk == 24))
+    regime['boreal-humid'] = np.logical_or.reduce((kg_blk == 25,
+            kg_blk == 26, kg_blk == 27, kg_blk == 28))
+    regime['arctic'] = np.logical_or(kg_blk == 29, kg_blk == 30)
+    return regime
+
+
+def populate_land_use(lc_blk):
+    """The land use classifier as originally written."""
+    land_use = {}
+    land_use['forest'] = np.logical_or.reduce((lc_blk == 12, lc_blk == 50,
+            lc_blk == 60, lc_blk == 61, lc_blk == 62, lc_blk == 70, lc_blk == 71, lc_blk == 72,
+            lc_blk == 80, lc_blk == 81, lc_blk == 82, lc_blk == 90, lc_blk == 100,
+            lc_blk == 160, lc_blk == 170))
+    land_use['cropland_rainfed'] = np.logical_or(lc_blk == 10, lc_blk == 30)
+    land_use['cropland_irrigated'] = (lc_blk == 20)
+    land_use['grassland'] = np.logical_or.reduce((lc_blk == 11, lc_blk == 40, lc_blk == 110,
+            lc_blk == 120, lc_blk == 121, lc_blk == 122,
+            lc_blk == 130, lc_blk == 150, lc_blk == 151, lc_blk == 152, lc_blk == 153,
+            lc_blk == 180))
+    land_use['bare'] = np.logical_or.reduce((lc_blk == 140, lc_blk == 200,
+            lc_blk == 201, lc_blk == 202))
+    land_use['urban'] = (lc_blk == 190)
+    land_use['water'] = (lc_blk == 210)
+    land_use['ice'] = (lc_blk == 220)
+    return land_use
+
+
+def populate_soil_health(wk_blk):
+    """The soil health classifier as originally written."""
+    soil_health = {}
+    soil_health['prime'] = (wk_blk == 1)
+    soil_health['good'] = (wk_blk == 2)
+    soil_health['marginal'] = np.logical_or.reduce((wk_blk == 3, wk_blk == 4, wk_blk == 6))
+    soil_health['barren'] = (wk_blk == 5)
+    soil_health['water'] = (wk_blk == 7)
+    return soil_health
+
+
+tmr_codes = dict(pi.tmr_state, invalid=pi.C_TMR_BLNK)
+land_use_codes = {'forest': pi.C_LUS_FRST, 'cropland_rainfed': pi.C_LUS_CRRF,
+        'cropland_irrigated': pi.C_LUS_CRIR, 'grassland': pi.C_LUS_GRSS, 'bare': pi.C_LUS_BARE,
+        'urban': pi.C_LUS_URBN, 'water': pi.C_LUS_WATR, 'ice': pi.C_LUS_ICE}
+soil_health_codes = {'prime': pi.C_SLH_GOOD, 'good': pi.C_SLH_MRGN, 'marginal': pi.C_SLH_POOR,
+        'barren': pi.C_SLH_BARE, 'water': pi.C_SLH_WATR}
+
+
+class ArrayBand:
+    """Band reading windows of a numpy array, standing in for a GDAL band or BandStack."""
+    def __init__(self, array):
+        self.array = array
+
+    def ReadAsArray(self, x, y, ncols, nrows):
+        return self.array[..., y:y + nrows, x:x + ncols]
+
+
+def synthetic_inputs(seed):
+    """Return dict of kg_band, lc_band, sl_stack and wk_band over an 8x10 1km grid."""
+    rng = np.random.default_rng(seed)
+    lccs = [0, 10, 11, 12, 20, 30, 40, 50, 100, 110, 140, 150, 190, 200, 210, 220, 255]
+    return {'kg_band': ArrayBand(rng.integers(0, 32, (8, 10)).astype(np.uint8)),
+            'lc_band': ArrayBand(rng.choice(lccs, (24, 30)).astype(np.uint8)),
+            # percentages of the eight slope classes, summing to at most 100.
+            'sl_stack': ArrayBand(rng.integers(0, 13, (8, 8, 10)).astype(np.uint8)),
+            'wk_band': ArrayBand(rng.integers(0, 9, (8, 10)).astype(np.uint8))}
+
+
+def yield_AEZs(regime, tmr, slope, land_use, soil_health):
+    """The AEZ decision tree as originally written, the reference for the compiled rules."""
+    # AEZ1: Forest, prime, minimal
+    yield regime[tmr] * land_use['forest'] * soil_health['prime'] * slope['minimal']
+    # AEZ2: Forest, good, minimal
+    yield regime[tmr] * land_use['forest'] * soil_health['good'] * slope['minimal']
+    # AEZ3: Forest, good, moderate
+    yield regime[tmr] * land_use['forest'] * (soil_health['good'] + soil_health['prime']) * slope['moderate']
+    # AEZ4: Forest, good, steep
+    yield regime[tmr] * land_use['forest'] * (soil_health['good'] + soil_health['prime']) * slope['steep']
+    # AEZ5: Forest, marginal, minimal
+    yield regime[tmr] * land_use['forest'] * soil_health['marginal'] * slope['minimal']
+    # AEZ6: Forest, marginal, moderate
+    yield regime[tmr] * land_use['forest'] * soil_health['marginal'] * slope['moderate']
+    # AEZ7: Forest, marginal, steep
+    yield regime[tmr] * land_use['forest'] * soil_health['marginal'] * slope['steep']
+    # AEZ8: Grassland, prime, minimal
+    yield regime[tmr] * land_use['grassland'] * soil_health['prime'] * slope['minimal']
+    # AEZ9: Grassland, good, minimal
+    yield regime[tmr] * land_use['grassland'] * soil_health['good'] * slope['minimal']
+    # AEZ10: Grassland, good, moderate
+    yield regime[tmr] * land_use['grassland'] * (soil_health['good'] + soil_health['prime']) * slope['moderate']
+    # AEZ11: Grassland, good, steep
+    yield regime[tmr] * land_use['grassland'] * (soil_health['good'] + soil_health['prime']) * slope['steep']
+    # AEZ12: Grassland, marginal, minimal
+    yield regime[tmr] * land_use['grassland'] * soil_health['marginal'] * slope['minimal']
+    # AEZ13: Grassland, marginal, moderate
+    yield regime[tmr] * land_use['grassland'] * soil_health['marginal'] * slope['moderate']
+    # AEZ14: Grassland, marginal, steep
+    yield regime[tmr] * land_use['grassland'] * soil_health['marginal'] * slope['steep']
+    # AEZ15: Irrigated Cropland, prime, minimal
+    yield regime[tmr] * land_use['cropland_irrigated'] * soil_health['prime'] * slope['minimal']
+    # AEZ16: Irrigated Cropland, good, minimal
+    yield regime[tmr] * land_use['cropland_irrigated'] * soil_health['good'] * slope['minimal']
+    # AEZ17: Irrigated Cropland, good, moderate
+    yield regime[tmr] * land_use['cropland_irrigated'] * (soil_health['good'] + soil_health['prime']) * slope['moderate']
+    # AEZ18: Irrigated Cropland, good, steep
+    yield regime[tmr] * land_use['cropland_irrigated'] * (soil_health['good'] + soil_health['prime']) * slope['steep']
+    # AEZ19: Irrigated Cropland, marginal, minimal
+    yield regime[tmr] * land_use['cropland_irrigated'] * soil_health['marginal'] * slope['minimal']
+    # AEZ20: Irrigated Cropland, marginal, moderate
+    yield regime[tmr] * land_use['cropland_irrigated'] * soil_health['marginal'] * slope['moderate']
+    # AEZ21: Irrigated Cropland, marginal, steep
+    yield regime[tmr] * land_use['cropland_irrigated'] * soil_health['marginal'] * slope['steep']
+    # AEZ22: Rainfed Cropland, prime, minimal
+    yield regime[tmr] * land_use['cropland_rainfed'] * soil_health['prime'] * slope['minimal']
+    # AEZ23: Rainfed Cropland, good, minimal
+    yield regime[tmr] * land_use['cropland_rainfed'] * soil_health['good'] * slope['minimal']
+    # AEZ24: Rainfed Cropland, good, moderate
+    yield regime[tmr] * land_use['cropland_rainfed'] * (soil_health['good'] + soil_health['prime']) * slope['moderate']
+    # AEZ25: Rainfed Cropland, good, steep
+    yield regime[tmr] * land_use['cropland_rainfed'] * (soil_health['good'] + soil_health['prime']) * slope['steep']
+    # AEZ26: Rainfed Cropland, marginal, minimal
+    yield regime[tmr] * land_use['cropland_rainfed'] * soil_health['marginal'] * slope['minimal']
+    # AEZ27: Rainfed Cropland, marginal, moderate
+    yield regime[tmr] * land_use['cropland_rainfed'] * soil_health['marginal'] * slope['moderate']
+    # AEZ28: Rainfed Cropland, marginal, steep
+    yield regime[tmr] * land_use['cropland_rainfed'] * soil_health['marginal'] * slope['steep']
+    # AEZ29: All Barren Land
+    bare = land_use['bare'] + land_use['ice'] + land_use['urban']
+    barren = soil_health['barren']
+    barren[bare] = 0.0  # avoid double counting
+    yield regime[tmr] * (bare + barren)
+
+
+def code_dicts(regime, land_use, soil_health):
+    """Return the dicts of boolean arrays yield_AEZs() takes, from arrays of class codes."""
+    return ({name: (regime == code) for name, code in pi.tmr_state.items()},
+            {name: (land_use == code) for name, code in land_use_codes.items()},
+            {name: (soil_health == code) for name, code in soil_health_codes.items()})
+
+
+def all_codes():
+    """Return flat (regime, land_use, soil_health) arrays of every combination of codes."""
+    tmrs = list(pi.tmr_state.values()) + [pi.C_TMR_BLNK]
+    combos = np.array(list(itertools.product(tmrs, range(pi.C_LUS_BLNK + 1),
+            sorted(set(pi.soil_health_lut))))).astype(np.uint8)
+    return combos[:, 0], combos[:, 1], combos[:, 2]
+
+
+def test_aez_km2_matches_decision_tree():
+    regime, land_use, soil_health = all_codes()
+    rng = np.random.default_rng(11)
+    percents = rng.integers(0, 101, size=(3, regime.size))
+    slope = {'minimal': percents[0] / 100.0, 'moderate': percents[1] / 100.0,
+            'steep': percents[2] / 100.0}
+    km2_blk = rng.random(regime.size)
+
+    expected = []
+    regime_d, land_use_d, soil_health_d = code_dicts(regime, land_use, soil_health)
+    for tmr in pi.tmr_state.keys():
+        for aez in yield_AEZs(regime=regime_d, tmr=tmr, slope=slope, land_use=land_use_d,
+                soil_health=soil_health_d):
+            expected.append((aez * km2_blk).sum())
+    # one pixel per combination, so a column holds the area of the pixels in that AEZ.
+    actual = pi.aez_km2(regime=regime, slope=slope, land_use=land_use,
+            soil_health=soil_health, km2_blk=km2_blk)
+    assert actual == pytest.approx(np.array(expected))
+
+
+def test_aez_colors_match_decision_tree():
+    regime, land_use, soil_health = all_codes()
+    for slope_code, group in [(pi.C_SLP_MIN, 'minimal'), (pi.C_SLP_MOD, 'moderate'),
+            (pi.C_SLP_STP, 'steep'), (pi.C_SLP_BLNK, None)]:
+        slope = {g: np.full(regime.size, g == group) for g in ['minimal', 'moderate', 'steep']}
+        expected = np.full(regime.size, pi.C_TMR_BLNK)
+        regime_d, land_use_d, soil_health_d = code_dicts(regime, land_use, soil_health)
+        for tmr, color in pi.tmr_state.items():
+            for aez in yield_AEZs(regime=regime_d, tmr=tmr, slope=slope, land_use=land_use_d,
+                    soil_health=soil_health_d):
+                expected[aez.astype(bool)] = color
+                color += 1
+        actual = pi.aez_colors(regime=regime, slope=np.full(regime.size, slope_code, np.uint8),
+                land_use=land_use, soil_health=soil_health)
+        assert (actual == expected).all(), group
+
+
+@pytest.mark.parametrize('lut_fn, reference, codes, blank', [
+        (pi.populate_tmr, populate_tmr, tmr_codes, pi.C_TMR_BLNK),
+        (pi.populate_land_use, populate_land_use, land_use_codes, pi.C_LUS_BLNK),
+        (pi.populate_soil_health, populate_soil_health, soil_health_codes, pi.C_SLH_BLNK)])
+def test_class_luts(lut_fn, reference, codes, blank):
+    values = np.arange(256, dtype=np.uint8)
+    actual = lut_fn(values)
+    unclassified = np.ones(256, dtype=bool)
+    for name, mask in reference(values).items():
+        assert ((actual == codes[name]) == mask).all(), name
+        unclassified &= ~mask
+    assert (actual[unclassified] == blank).all()
+
+
+def test_soil_health_output():
+    # every workability class under every land cover class.
+    wk_blk, lc_blk = [a.ravel().astype(np.uint8) for a in np.meshgrid(np.arange(256),
+            np.arange(256))]
+    land_use = populate_land_use(lc_blk)
+    soil_health = populate_soil_health(wk_blk)
+    # yield_AEZs() clears barren soil under bare land before SoilHealth.tif is written.
+    for aez in yield_AEZs(regime={'arid': np.ones(wk_blk.size, dtype=bool)}, tmr='arid',
+            slope={'minimal': 1.0, 'moderate': 0.0, 'steep': 0.0}, land_use=land_use,
+            soil_health=soil_health):
+        pass
+    expected = np.full(wk_blk.size, pi.C_SLP_BLNK)
+    for name, code in soil_health_codes.items():
+        expected[soil_health[name]] = code
+
+    actual = pi.soil_health_output(soil_health=pi.populate_soil_health(wk_blk),
+            land_use=pi.populate_land_use(lc_blk))
+    assert (actual == expected).all()
+
+
+def test_lc_fractions_matches_upsampled():
+    bands = synthetic_inputs(seed=12)
+    km2_blk = np.random.default_rng(13).random((5, 6))
+    upsampled = pi.block_km2_upsampled(x=2, y=1, ncols=6, nrows=5, km2_blk=km2_blk, **bands)
+    fractions = pi.block_km2_fractions(x=2, y=1, ncols=6, nrows=5, km2_blk=km2_blk, **bands)
+    assert upsampled.sum() > 0
+    assert fractions == pytest.approx(upsampled)
+
+
+def write_input(filename, array):
+    """Write an (nrows, ncols) or (nbands, nrows, ncols) uint8 array to a GeoTIFF."""
+    array = array.reshape((-1,) + array.shape[-2:])
+    img = osgeo.gdal.GetDriverByName('GTiff').Create(filename, array.shape[2], array.shape[1],
+            array.shape[0], osgeo.gdal.GDT_Byte)
+    for b in range(array.shape[0]):
+        img.GetRasterBand(b + 1).WriteArray(array[b])
+    img = None
+    return filename
+
+
+def test_threaded_tiles_match_serial(tmp_path):
+    rng = np.random.default_rng(9)
+    lccs = [0, 10, 11, 12, 20, 30, 40, 50, 100, 110, 140, 150, 190, 200, 210, 220, 255]
+    filenames = {
+        'kg_filename': write_input(str(tmp_path / 'kg.tif'),
+            rng.integers(0, 32, (16, 20)).astype(np.uint8)),
+        'lc_filename': write_input(str(tmp_path / 'lc.tif'),
+            rng.choice(lccs, (48, 60)).astype(np.uint8)),
+        'sl_filename': write_input(str(tmp_path / 'sl.tif'),
+            rng.integers(0, 13, (8, 16, 20)).astype(np.uint8)),
+        'wk_filename': write_input(str(tmp_path / 'wk.tif'),
+            rng.integers(0, 9, (16, 20)).astype(np.uint8))}
+    windows = geoutil.windows(x_siz=60, y_siz=48, x_winsiz=12, y_winsiz=12)
+
+    def tiles(threads):
+        classifier = pi.TileClassifier(**filenames)
+        return [(x, y) + tuple(a.copy() for a in arrays) for x, y, *arrays in
+                pi.classified_tiles(classifier=classifier, windows=windows, threads=threads)]
+
+    serial = tiles(threads=1)
+    assert [(t[0], t[1]) for t in serial] == [(w[0], w[1]) for w in windows]
+    for threads in [2, 4]:
+        threaded = tiles(threads=threads)
+        assert len(threaded) == len(serial)
+        for expected, actual in zip(serial, threaded):
+            assert expected[:2] == actual[:2]
+            for e, a in zip(expected[2:], actual[2:]):
+                assert e.tobytes() == a.tobytes()